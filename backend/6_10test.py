@@ -1,26 +1,51 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, Body, Depends, Request, HTTPException, APIRouter, Header
+from fastapi import FastAPI, Body, Depends, Request, HTTPException, APIRouter, Header, Query, Response
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_chroma.vectorstores import maximal_marginal_relevance, cosine_similarity
+from langchain_core.documents import Document
 from langchain_ollama import OllamaLLM
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import time
 import json
 import os
-import torch
+import numpy as np
 from pathlib import Path
-from typing import Optional, List, Dict, Annotated
+from typing import Optional, List, Dict, Annotated, Literal
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from functools import lru_cache
+from collections import Counter, OrderedDict, deque
 import random
 import re
 import shutil
+import hashlib
+import base64
+import threading
+import sqlite3
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from filelock import FileLock, Timeout as FileLockTimeout
 from fastapi import Security, status
 from fastapi.security import APIKeyHeader
+from embedding_backends import build_embeddings, RemoteEmbeddings, EMBEDDING_BACKEND
+from tracing import span, start_trace, current_span, current_trace_id, parse_traceparent, add_trace_listener, exporter as trace_exporter
+from model_scheduler import ModelAffinityScheduler
+from ollama_pool import OllamaBackendPool, NoBackendAvailableError, normalize_ollama_url
+from model_router import ComplexityRouter, load_rules, question_signals
+from answer_rendering import COMPACT_ANSWER_SCHEMA, parse_compact_answer, render_compact_answer, compact_styles
+from chat_archive import ChatArchive
+from answer_store import AnswerStore, mine_frequent_questions
+from sharded_search import ShardedVectorStore, load_shard_layout
+from partitioned_retrieval import load_partitions, normalize_metadata_filter, combine_where, merge_partition_results
+from prompt_accounting import SECTIONS as PROMPT_SECTIONS, prompt_token_breakdown
+from profiling import SamplingProfiler, SlowRequestRecorder, MemorySampler, collapsed_text, PROFILE_MAX_SECONDS, SLOW_REQUEST_MAX_ENTRIES
 
 
 
@@ -37,6 +62,12 @@ VALID_API_KEYS = {
     "wBT6XJiN1l5Vhc2Tx_d8r41sAFMsEgw-efCO6Y_fvKg": "kmu_image_team",
 }
 
+# --- Admin Key Configuration ---
+# 管理端點 (/api/admin) 使用獨立的金鑰，透過環境變數 ADMIN_API_KEYS 設定（以逗號分隔）。
+ADMIN_API_KEY_NAME = "X-Admin-Key"
+admin_key_header_auth = APIKeyHeader(name=ADMIN_API_KEY_NAME, auto_error=False)
+ADMIN_API_KEYS = {k.strip(): "admin" for k in os.environ.get("ADMIN_API_KEYS", "").split(",") if k.strip()}
+
 # --- Logging Configuration ---
 log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
 # Ensure log level is a valid level string for basicConfig
@@ -49,6 +80,10 @@ logging.basicConfig(level=log_level, format="%(asctime)s - %(name)s - %(levelnam
 logger = logging.getLogger(__name__)
 
 async def get_api_key_user(api_key: str = Security(api_key_header_auth)):
+    with span("auth", **{"auth.method": "api_key"}):
+        return _validate_api_key(api_key)
+
+def _validate_api_key(api_key: Optional[str]) -> str:
     if not api_key:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -72,6 +107,14 @@ async def get_api_key_user(api_key: str = Security(api_key_header_auth)):
             detail="Could not validate credentials: Invalid API Key."
         )
 
+async def get_admin_user(admin_key: str = Security(admin_key_header_auth)):
+    if not ADMIN_API_KEYS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin API is disabled: ADMIN_API_KEYS not configured.")
+    if not admin_key or admin_key not in ADMIN_API_KEYS:
+        logger.warning("Invalid or missing admin key for admin endpoint.")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Could not validate admin credentials.")
+    return ADMIN_API_KEYS[admin_key]
+
 app = FastAPI(
     title="KMU Air Pollution RAG API",
     description="""
@@ -94,6 +137,7 @@ If no `session_id` is provided in a request, a new session will be initiated for
     version="1.0.0"
 )
 api_router = APIRouter(prefix="/api")
+admin_router = APIRouter(prefix="/api/admin", tags=["Admin (X-Admin-Key Auth)"])
 
 def detect_format_mode(question: str) -> str:
     format_triggers = [
@@ -125,11 +169,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*", "X-Username", "X-API-Key"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "X-Sync-Watermark", "ETag", "X-Trace-Id"],
 )
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
+# 只壓縮超過門檻的回應 (sources、聊天記錄等大型 JSON)，小回應壓縮反而浪費 CPU
+GZIP_MINIMUM_SIZE = int(os.environ.get("GZIP_MINIMUM_SIZE", "1024"))
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
 
 MAX_HISTORY_PER_SESSION = 10
-device = "cuda" if torch.cuda.is_available() else "cpu"
 embedding = None
 vectordb = None
 request_counters = {}
@@ -139,6 +186,38 @@ SAVE_QA = True
 MAX_LLM_RETRIES = 1
 USER_DATA_BASE_DIR = Path("user_specific_chat_data")
 
+# --- 多 worker 部署模式 (Multi-worker Mode) ---
+# 以 `uvicorn 6_10test:app --workers N` 啟動時請設定 MULTI_WORKER_MODE=true：
+# 速率限制改用共用的 SQLite 計數，背景工作只由取得 leader 鎖的 worker 執行，
+# 各 worker 也會跟隨 vectordb_snapshots/ACTIVE 切換快照。聊天檔案的讀寫在任何模式下都以檔案鎖序列化。
+MULTI_WORKER_MODE = os.environ.get("MULTI_WORKER_MODE", "false").lower() == "true"
+SHARED_STATE_DB_PATH = Path(os.environ.get("SHARED_STATE_DB_PATH", "shared_state.sqlite3"))
+LOCKS_DIR = Path(os.environ.get("LOCKS_DIR", "locks"))
+CHAT_LOCK_TIMEOUT_SECONDS = float(os.environ.get("CHAT_LOCK_TIMEOUT_SECONDS", "30"))
+RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", "30"))
+_inflight_retrievals = 0
+_inflight_retrieval_lock = threading.Lock()
+_metrics_lock = threading.Lock()
+metrics_counters: Dict[str, float] = {}
+
+def _metric_key(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+    if not labels: return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+def _inc_metric(name: str, value: float = 1.0, labels: Optional[Dict[str, str]] = None):
+    key = _metric_key(name, labels)
+    with _metrics_lock: metrics_counters[key] = metrics_counters.get(key, 0.0) + value
+
+@contextmanager
+def _retrieval_in_flight():
+    # 記錄正在進行中的查詢檢索數量，背景工作 (如回饋匯入) 會在有查詢時讓路
+    global _inflight_retrievals
+    with _inflight_retrieval_lock: _inflight_retrievals += 1
+    try:
+        yield
+    finally:
+        with _inflight_retrieval_lock: _inflight_retrievals -= 1
+
 def sanitize_username(username: str) -> str:
     if not username: return "default_user"
     sanitized = re.sub(r'[^a-zA-Z0-9_-]', '', username).lower()
@@ -150,7 +229,47 @@ def get_user_chat_messages_dir(username: str) -> Path: return get_user_chat_data
 def get_user_feedback_save_path(username: str) -> Path: return FEEDBACK_SAVE_PATH_BASE / sanitize_username(username)
 def get_user_qa_log_path(username: str) -> Path: return QA_LOG_PATH_BASE / sanitize_username(username)
 
+def _user_chat_lock(username: str) -> FileLock:
+    # 同一用戶的 chats_metadata.json 與訊息檔在所有 worker / 執行緒之間序列化讀-改-寫
+    # 鎖檔放在用戶資料夾之外，刪除用戶資料夾時不會影響鎖
+    LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+    return FileLock(str(LOCKS_DIR / f"chat_{sanitize_username(username)}.lock"), timeout=CHAT_LOCK_TIMEOUT_SECONDS)
+
+_leader_locks: Dict[str, FileLock] = {}
+
+def _hold_leader_lock(name: str) -> bool:
+    # 多 worker 模式下，背景工作只在持有 leader 鎖的 worker 中執行；該 worker 結束後由其他 worker 接手
+    if not MULTI_WORKER_MODE: return True
+    lock = _leader_locks.get(name)
+    if lock is None:
+        LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+        lock = _leader_locks[name] = FileLock(str(LOCKS_DIR / f"leader_{name}.lock"), thread_local=False)
+    if lock.is_locked: return True
+    try:
+        lock.acquire(timeout=0)
+        logger.info(f"👑 Worker {os.getpid()} 成為背景工作 '{name}' 的 leader")
+        return True
+    except FileLockTimeout:
+        return False
+
+def _is_leader(name: str) -> bool:
+    # 只回報本 worker 目前是否持有 leader 鎖，不嘗試取得 (取得只由背景工作進行)
+    if not MULTI_WORKER_MODE: return True
+    lock = _leader_locks.get(name)
+    return lock is not None and lock.is_locked
+
+def _write_json_atomic(target: Path, data):
+    # 先寫入暫存檔再取代，其他 worker 不會讀到寫到一半的 JSON
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, target)
+
 async def get_current_username(x_username: Optional[str] = Header(None)) -> str:
+    with span("auth", **{"auth.method": "x_username"}):
+        return _validate_username_header(x_username)
+
+def _validate_username_header(x_username: Optional[str]) -> str:
     if x_username is None:
         logger.warning("請求中未找到 X-Username Header")
         raise HTTPException(status_code=400, detail="請求標頭中缺少 X-Username")
@@ -166,42 +285,213 @@ async def get_current_username(x_username: Optional[str] = Header(None)) -> str:
 
 embedding_model_name = os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3")
 try:
-    embedding = HuggingFaceEmbeddings(
-        model_name=embedding_model_name,
-        model_kwargs={"device": device},
-        encode_kwargs={"normalize_embeddings": True}
-    )
+    # EMBEDDING_BACKEND=torch | onnx | onnx-int8，見 embedding_backends.py；torch 只在 torch 後端時才匯入並偵測 CUDA
+    embedding = build_embeddings(embedding_model_name)
     _ = embedding.embed_query("測試嵌入模型")
 except Exception as e:
     logger.error(f"❌ 嵌入模型載入失敗: {str(e)}", exc_info=True)
     embedding = None
 
+# --- 向量資料庫快照 (Vector Store Snapshots) ---
+# 每個快照是 VECTORDB_SNAPSHOTS_DIR 底下的一個 Chroma 資料夾，資料夾名稱即快照 ID。
+# 管理端點可在背景載入並預熱新快照後原子性地切換；進行中的請求會繼續使用舊快照，
+# 舊快照在所有使用中的請求結束後才釋放。
+VECTORDB_SNAPSHOTS_DIR = Path(os.environ.get("VECTORDB_SNAPSHOTS_DIR", "vectordb_snapshots"))
+VECTORDB_ACTIVE_SNAPSHOT_FILE = VECTORDB_SNAPSHOTS_DIR / "ACTIVE"
+# 快照 ID -> 線上寫入 (回饋匯入) 的版本號；寫入的 worker 遞增，其餘 worker 看到版本變大時重新開啟同一個快照
+VECTORDB_CORPUS_VERSIONS_FILE = VECTORDB_SNAPSHOTS_DIR / "CORPUS_VERSIONS.json"
+VECTORDB_RETIRE_TIMEOUT_SECONDS = float(os.environ.get("VECTORDB_RETIRE_TIMEOUT_SECONDS", "900"))
+VECTORDB_FOLLOW_POLL_SECONDS = float(os.environ.get("VECTORDB_FOLLOW_POLL_SECONDS", "5"))
+VECTORDB_SHARD_PROCESSES = os.environ.get("VECTORDB_SHARD_PROCESSES", "")  # 分片快照的查詢子程序數；空白 = min(分片數, CPU 數)，0 = 本程序內以執行緒查詢
+vectordb_snapshot_id: Optional[str] = None
+vectordb_corpus_version = 0  # 目前載入的快照內容對應的版本號 (見 VECTORDB_CORPUS_VERSIONS_FILE)
+_vectordb_swap_lock = threading.Lock()
+_vectordb_snapshot_inflight: Dict[str, int] = {}
+_vectordb_reload_state = {"in_progress": False, "target": None, "last_result": None}
+
+def _legacy_vectordb_path() -> Path: return Path(os.environ.get("VECTORDB_PATH", "6_12"))
+
+def _resolve_snapshot_dir(snapshot_id: str) -> Optional[Path]:
+    if not snapshot_id or "/" in snapshot_id or "\\" in snapshot_id or snapshot_id.startswith("."): return None
+    candidate = VECTORDB_SNAPSHOTS_DIR / snapshot_id
+    if candidate.is_dir(): return candidate
+    legacy_path = _legacy_vectordb_path()
+    if legacy_path.name == snapshot_id and legacy_path.is_dir(): return legacy_path
+    return None
+
+def _list_vectordb_snapshots() -> List[str]:
+    snapshots = sorted(p.name for p in VECTORDB_SNAPSHOTS_DIR.iterdir() if p.is_dir()) if VECTORDB_SNAPSHOTS_DIR.is_dir() else []
+    if _legacy_vectordb_path().is_dir() and _legacy_vectordb_path().name not in snapshots:
+        snapshots.append(_legacy_vectordb_path().name)
+    return snapshots
+
+def _initial_snapshot_id() -> str:
+    # 優先順序：VECTORDB_SNAPSHOT 環境變數 > 上次切換後記錄的 ACTIVE 檔 > VECTORDB_PATH
+    if os.environ.get("VECTORDB_SNAPSHOT"): return os.environ["VECTORDB_SNAPSHOT"]
+    if VECTORDB_ACTIVE_SNAPSHOT_FILE.exists():
+        recorded = VECTORDB_ACTIVE_SNAPSHOT_FILE.read_text(encoding="utf-8").strip()
+        if recorded: return recorded
+    return _legacy_vectordb_path().name
+
+def _load_vectordb_snapshot(snapshot_dir: Path) -> Chroma:
+    # 以 ingest_corpus.py --shards 建置的快照 (含 shards.json) 改用分片檢索，見 sharded_search.py
+    layout = load_shard_layout(snapshot_dir)
+    if layout:
+        processes = int(VECTORDB_SHARD_PROCESSES) if VECTORDB_SHARD_PROCESSES else min(len(layout["collections"]), os.cpu_count() or 1)
+        db = ShardedVectorStore(snapshot_dir, embedding, layout, processes=processes)
+        db.warm_up()
+        logger.info(f"🧩 快照 '{snapshot_dir.name}' 為 {db.num_shards} 個分片 ({f'{processes} 個子程序' if processes else '執行緒'}平行查詢)")
+    else:
+        db = Chroma(persist_directory=str(snapshot_dir), embedding_function=embedding)
+    _ = db.similarity_search("系統預熱", k=1)
+    return db
+
+def get_active_vectordb():
+    with _vectordb_swap_lock:
+        return vectordb_snapshot_id, vectordb
+
+def _read_corpus_versions() -> Dict[str, int]:
+    try:
+        with open(VECTORDB_CORPUS_VERSIONS_FILE, encoding="utf-8") as f: return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _bump_corpus_version(snapshot_id: str) -> int:
+    # 只由持有寫入權的 worker (回饋匯入 leader) 呼叫；先更新本 worker 的版本，跟進執行緒才不會把自己的寫入當成外部變更
+    global vectordb_corpus_version
+    versions = _read_corpus_versions()
+    versions[snapshot_id] = version = versions.get(snapshot_id, 0) + 1
+    with _vectordb_swap_lock:
+        if vectordb_snapshot_id == snapshot_id: vectordb_corpus_version = version
+    try:
+        VECTORDB_SNAPSHOTS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = VECTORDB_CORPUS_VERSIONS_FILE.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f: json.dump(versions, f)
+        os.replace(tmp_file, VECTORDB_CORPUS_VERSIONS_FILE)
+    except Exception as e: logger.warning(f"⚠️ 無法記錄向量資料庫快照 '{snapshot_id}' 的版本號: {e}")
+    return version
+
+def _drop_cached_chroma_system(persist_dir: Path):
+    # 同一程序內以相同路徑開啟的 Chroma client 共用同一個 System (含記憶體中的 HNSW 索引)，
+    # 不會看到其他程序寫入的向量；移除快取後重新開啟才會從磁碟載入最新內容
+    from chromadb.api.shared_system_client import SharedSystemClient
+    SharedSystemClient._identifier_to_system.pop(str(persist_dir), None)
+    SharedSystemClient._identifier_to_refcount.pop(str(persist_dir), None)
+
+@contextmanager
+def _pinned_vectordb():
+    # 取得目前的快照並在使用期間計數，切換後舊快照要等計數歸零才會被釋放
+    with _vectordb_swap_lock:
+        snapshot_id, db = vectordb_snapshot_id, vectordb
+        if snapshot_id is not None:
+            _vectordb_snapshot_inflight[snapshot_id] = _vectordb_snapshot_inflight.get(snapshot_id, 0) + 1
+    try:
+        yield snapshot_id, db
+    finally:
+        if snapshot_id is not None:
+            with _vectordb_swap_lock: _vectordb_snapshot_inflight[snapshot_id] -= 1
+
+def _retire_vectordb_snapshot(snapshot_id: str, db: Chroma, release_clients: bool = True):
+    # release_clients=False：重新開啟同一個快照時，舊 client 與新 client 共用 Chroma 的 System 識別，關閉舊的會連帶停掉新的，只交給 GC 回收
+    if not release_clients and not isinstance(db, ShardedVectorStore): return
+    deadline = time.time() + VECTORDB_RETIRE_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        with _vectordb_swap_lock:
+            if _vectordb_snapshot_inflight.get(snapshot_id, 0) <= 0 or vectordb is db: break
+        time.sleep(0.5)
+    with _vectordb_swap_lock:
+        if vectordb is db: return  # 又被切換回來，不釋放
+    close = (lambda: db.close(release_clients=release_clients)) if isinstance(db, ShardedVectorStore) else getattr(getattr(db, "_client", None), "close", None)
+    try:
+        if callable(close): close()
+        logger.info(f"♻️ 舊的向量資料庫快照 '{snapshot_id}' 已釋放")
+    except Exception as e: logger.warning(f"⚠️ 釋放向量資料庫快照 '{snapshot_id}' 時發生錯誤: {e}")
+
+def _swap_vectordb_snapshot(snapshot_id: str, snapshot_dir: Path, refresh: bool = False):
+    # refresh=True：重新開啟目前的快照以載入其他 worker 寫入的內容
+    global vectordb, vectordb_snapshot_id, vectordb_corpus_version
+    start_load = time.time()
+    corpus_version = _read_corpus_versions().get(snapshot_id, 0)
+    try:
+        if refresh: _drop_cached_chroma_system(snapshot_dir)
+        new_db = _load_vectordb_snapshot(snapshot_dir)
+    except Exception as e:
+        logger.error(f"❌ 向量資料庫快照 '{snapshot_id}' 載入失敗，維持使用 '{vectordb_snapshot_id}': {e}", exc_info=True)
+        _vectordb_reload_state.update(in_progress=False, target=None, last_result={"snapshot_id": snapshot_id, "status": "failed", "error": str(e), "finished_at": datetime.now().isoformat()})
+        _inc_metric("vectordb_reloads_total", labels={"status": "failed"})
+        return
+    with _vectordb_swap_lock:
+        old_snapshot_id, old_db = vectordb_snapshot_id, vectordb
+        vectordb, vectordb_snapshot_id, vectordb_corpus_version = new_db, snapshot_id, corpus_version
+    try:
+        VECTORDB_SNAPSHOTS_DIR.mkdir(parents=True, exist_ok=True)
+        VECTORDB_ACTIVE_SNAPSHOT_FILE.write_text(snapshot_id, encoding="utf-8")
+    except Exception as e: logger.warning(f"⚠️ 無法記錄目前使用的快照 ID: {e}")
+    load_time = time.time() - start_load
+    logger.info(f"🔁 向量資料庫已切換: '{old_snapshot_id}' -> '{snapshot_id}' (載入與預熱 {load_time:.2f}s)")
+    _vectordb_reload_state.update(in_progress=False, target=None, last_result={"snapshot_id": snapshot_id, "previous_snapshot_id": old_snapshot_id, "status": "ok", "load_seconds": round(load_time, 2), "finished_at": datetime.now().isoformat()})
+    _inc_metric("vectordb_reloads_total", labels={"status": "ok"})
+    if old_db is not None and old_db is not new_db:
+        threading.Thread(target=_retire_vectordb_snapshot, args=(old_snapshot_id, old_db, not refresh), name=f"retire-{old_snapshot_id}", daemon=True).start()
+
+def _follow_active_snapshot():
+    # 多 worker 模式：管理端點只會打到其中一個 worker，其餘 worker 依 ACTIVE 檔跟進切換；
+    # 回饋匯入只在 leader 寫入，其餘 worker 依 CORPUS_VERSIONS.json 的版本號重新開啟目前的快照
+    while True:
+        time.sleep(VECTORDB_FOLLOW_POLL_SECONDS)
+        try:
+            target = VECTORDB_ACTIVE_SNAPSHOT_FILE.read_text(encoding="utf-8").strip() if VECTORDB_ACTIVE_SNAPSHOT_FILE.exists() else ""
+            versions = _read_corpus_versions()
+            with _vectordb_swap_lock:
+                if _vectordb_reload_state["in_progress"]: continue
+                switch = bool(target) and target != vectordb_snapshot_id
+                refresh = not switch and vectordb_snapshot_id is not None and versions.get(vectordb_snapshot_id, 0) > vectordb_corpus_version
+                if not switch and not refresh: continue
+                target = target if switch else vectordb_snapshot_id
+                _vectordb_reload_state.update(in_progress=True, target=target)
+            snapshot_dir = _resolve_snapshot_dir(target)
+            if snapshot_dir is None:
+                logger.error(f"❌ ACTIVE 指定的快照 '{target}' 不存在，略過跟進切換")
+                _vectordb_reload_state.update(in_progress=False, target=None)
+                continue
+            if refresh: logger.info(f"🔁 Worker {os.getpid()} 重新開啟向量資料庫快照 '{target}' 以載入其他 worker 匯入的內容 (版本 {versions[target]})")
+            else: logger.info(f"🔁 Worker {os.getpid()} 跟進切換至向量資料庫快照 '{target}'")
+            _swap_vectordb_snapshot(target, snapshot_dir, refresh=refresh)
+        except Exception as e:
+            logger.error(f"❌ 跟進快照切換失敗: {e}", exc_info=True)
+            _vectordb_reload_state.update(in_progress=False, target=None)
+
 @app.on_event("startup")
 def startup_event():
-    global vectordb, embedding_model_name
+    global vectordb, vectordb_snapshot_id, vectordb_corpus_version, embedding_model_name
     logger.info(f"日誌級別設定為: {log_level}")
-    logger.info(f"使用設備: {device}")
     if embedding is None:
         logger.error("❌ 嵌入模型未載入，無法初始化向量資料庫。")
     else:
-        logger.info(f"正在載入嵌入模型: {embedding_model_name}")
+        logger.info(f"正在載入嵌入模型: {embedding_model_name} (後端: {EMBEDDING_BACKEND})")
         logger.info("✅ 嵌入模型載入並測試成功")
         try:
-            persist_dir = os.environ.get("VECTORDB_PATH", "6_12")
-            logger.info(f"正在從 '{persist_dir}' 載入向量資料庫...")
-            if not os.path.exists(persist_dir):
-                logger.error(f"❌ 向量資料庫目錄 '{persist_dir}' 不存在。")
+            snapshot_id = _initial_snapshot_id()
+            persist_dir = _resolve_snapshot_dir(snapshot_id)
+            logger.info(f"正在載入向量資料庫快照 '{snapshot_id}' ({persist_dir})...")
+            if persist_dir is None:
+                logger.error(f"❌ 向量資料庫快照 '{snapshot_id}' 不存在 (VECTORDB_SNAPSHOTS_DIR={VECTORDB_SNAPSHOTS_DIR}, VECTORDB_PATH={_legacy_vectordb_path()})。")
             else:
-                vectordb = Chroma(persist_directory=persist_dir, embedding_function=embedding)
-                _ = vectordb.similarity_search("系統預熱", k=1)
-                logger.info(f"✅ 向量資料庫從 '{persist_dir}' 載入並預熱完成")
+                vectordb_corpus_version = _read_corpus_versions().get(snapshot_id, 0)
+                vectordb = _load_vectordb_snapshot(persist_dir)
+                vectordb_snapshot_id = snapshot_id
+                logger.info(f"✅ 向量資料庫快照 '{snapshot_id}' 從 '{persist_dir}' 載入並預熱完成")
         except Exception as e:
             logger.error(f"❌ 向量資料庫載入失敗: {str(e)}", exc_info=True)
             vectordb = None
+            vectordb_snapshot_id = None
     USER_DATA_BASE_DIR.mkdir(parents=True, exist_ok=True)
     FEEDBACK_SAVE_PATH_BASE.mkdir(parents=True, exist_ok=True)
     QA_LOG_PATH_BASE.mkdir(parents=True, exist_ok=True)
     logger.info(f"用戶特定數據的基礎目錄已準備就緒: {USER_DATA_BASE_DIR}, {FEEDBACK_SAVE_PATH_BASE}, {QA_LOG_PATH_BASE}")
+    if MULTI_WORKER_MODE:
+        logger.info(f"🧩 多 worker 模式已啟用 (pid {os.getpid()}, 共用狀態: {SHARED_STATE_DB_PATH}, 鎖目錄: {LOCKS_DIR})")
+        threading.Thread(target=_follow_active_snapshot, name="snapshot-follower", daemon=True).start()
 
 
 # --- Prompt Templates ---
@@ -778,13 +1068,302 @@ Format Mode: {format_mode}
 👇 **請嚴格遵守以上所有規則，開始撰寫你的分析報告:**
 """
 )
+
+# --- 精簡版模板 (Compact Template Variants) ---
+# 與上方模板相同的規則與區段標記 (停止序列仍然適用)，但指示濃縮、範例縮短為一個章節，預填 token 約為原本的一半以下。
+# 以 PROMPT_TEMPLATE_VARIANT 選擇："full" (預設)、"compact"，或 JSON 逐模板指定，例如 '{"research": "compact"}'。
+STRUCTURED_LIST_PROMPT_COMPACT = PromptTemplate(
+    input_variables=["question", "context", "history"],
+    template="""
+你是嚴謹的資訊整理專家，只根據 `<CONTEXT>` 以繁體中文回答，不得虛構或使用外部知識，不要開場白、結尾語或提及資料來源。
+`<CONTEXT>` 沒有答案時，直接回答「根據所提供的資料，無法回答『[使用者的問題]』這個問題。」
+
+**--- 輸出格式 (FORMAT) ---**
+1-2 句引言；每個章節為 `**一、標題**` (標題不加表情符號)，下一行寫 1-3 句純文字內容 (可少量使用 Emoji)，再下一行為 100 個半形句點的分隔線。資訊不足的章節直接省略。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 輸出範例 (OUTPUT EXAMPLE) ---**
+小港空污USR計畫已展現出一定的成效 ✅，主要體現在提升社區居民對空污議題的認知。
+
+**一、社區參與與教育推廣**
+計畫團隊深入小港區的學校 🏫 與社區，舉辦各類環境與健康教育活動。
+....................................................................................................
+
+👇 **直接開始回答:**
+"""
+)
+
+HIERARCHICAL_BULLETS_PROMPT_COMPACT = PromptTemplate(
+    input_variables=["question", "context", "history", "format_mode"],
+    template="""
+你是嚴謹的政策分析師，只根據 `<CONTEXT>` 以繁體中文回答，不得虛構或使用外部知識；資訊不足的部分省略或說明「根據所提供的資料，此部分資訊不足」。不要開場白、結尾語或提及資料來源。
+
+**--- 輸出格式 (FORMAT) ---**
+Markdown 報告：`#` 主標題、`##` 章節標題 (一、二、三…)，章節內以 `*` 條列；粗體只用於條列內的關鍵詞。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 輸出範例 (OUTPUT EXAMPLE) ---**
+# 空氣污染教育成效評估方法
+評估時應結合量化與質化指標。
+
+## 一、量化指標
+*   **前後測問卷分析:** 比較參與者在活動前後的知識與態度變化。
+
+👇 **直接開始撰寫報告:**
+"""
+)
+
+PARAGRAPH_EMOJI_LEAD_PROMPT_COMPACT = PromptTemplate(
+    input_variables=["question", "context", "history", "format_mode"],
+    template="""
+你是友善的助理，只根據 `<CONTEXT>` 以繁體中文回答。回答由數個段落組成，每個段落以一個與內容相關的表情符號和一個空格開頭。
+不要使用數字列表、項目符號、Markdown 標題或分隔線，也不要將整句加粗。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 輸出範例 (OUTPUT EXAMPLE) ---**
+💡 USR計畫與醫療機構合作，是推動社區健康促進的重要一環。
+
+🏥 計畫與地方醫療單位合作設立健康檢查站，並定期進行監測。
+
+👇 **直接開始回答:**
+"""
+)
+
+CUSTOM_FORMAT_BASE_PROMPT_COMPACT = PromptTemplate(
+    input_variables=["question", "context", "history", "format_mode"],
+    template="""
+你是嚴格遵循指令的助理。你的輸出必須一字不差地採用使用者在 `<QUESTION>` 中指定的格式 (標籤、標點、換行與大小寫)，直接以該格式開始，不要添加任何其他文字、編號或分隔符。
+要求多個項目時，每個項目都完整遵循該格式。內容取自 `<CONTEXT>` 與 `<HISTORY>`。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 範例 (EXAMPLE) ---**
+# 使用者要求「2組QA，格式：Question: [問題] / Answer: [答案]」時，輸出只能是：
+Question: [第一個問題]
+Answer: [第一個答案]
+Question: [第二個問題]
+Answer: [第二個答案]
+
+👇 **直接輸出使用者要求的格式化內容:**
+"""
+)
+
+RESEARCH_PROMPT_TEMPLATE_COMPACT = PromptTemplate(
+    input_variables=["question", "context", "history", "format_mode"],
+    template="""
+你是台灣空污議題的政策分析師，以客觀、學術的繁體中文回答，不使用口語或表情符號。所有內容必須來自 `<CONTEXT>`；資訊不足時回答「根據所提供的資料，無法回答此問題」。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 輸出格式指南 (OUTPUT FORMATTING) ---**
+Format Mode: {format_mode}
+- `custom`：嚴格遵循使用者在 `<QUESTION>` 中定義的格式，不自行添加標題或列表。
+- `default`：Markdown 報告 (`#` 主標題、`## 一、` 章節、必要時 `###` 次章節與 `*` 列表，最後一章為結論)；粗體只用於關鍵詞。
+
+👇 **請開始撰寫你的分析報告:**
+"""
+)
 DEFAULT_PROMPT_OPTIONS = [
     STRUCTURED_LIST_PROMPT,
     HIERARCHICAL_BULLETS_PROMPT,
     PARAGRAPH_EMOJI_LEAD_PROMPT
 ]
 
+# --- 精簡結構化輸出 (Compact Structured Output) ---
+# 模型只輸出內容 (JSON)，分隔線、標題編號、條列符號與段落表情符號由 answer_rendering 依選中的風格排版，
+# 省下逐 token 生成裝飾文字的時間。以 COMPACT_OUTPUT_RATIO 設定使用比例 (0 = 關閉，1 = 一律使用，介於中間可做 A/B 比較)。
+COMPACT_STRUCTURED_PROMPT = PromptTemplate(
+    input_variables=["question", "context", "history", "format_mode"],
+    template="""
+你是一位專業且樂於助人的助理，請以繁體中文回答使用者的問題，並且**只輸出一個 JSON 物件**，不要輸出任何其他文字。
+
+**--- 輸出規則 (MUST FOLLOW) ---**
+1.  `title`: 回答的簡短標題。
+2.  `intro`: 一到兩句直接回答問題的引言。
+3.  `sections`: 2 到 5 個重點，每個重點包含 `title` (簡短標題)、`emoji` (一個與主題相關的表情符號) 與 `points` (1 到 3 個完整句子的陣列)。
+4.  `conclusion`: 一句總結 (可省略)。
+5.  內容必須基於下方 `<CONTEXT>` 提供的資料；資料不足以回答時，`sections` 為空陣列並在 `intro` 說明。
+6.  文字中**不要**使用 Markdown、編號、條列符號或分隔線，排版由系統處理。
+
+**--- 輸入資料 (INPUT DATA) ---**
+<CONTEXT>
+{context}
+</CONTEXT>
+
+<HISTORY>
+{history}
+</HISTORY>
+
+<QUESTION>
+{question}
+</QUESTION>
+
+**--- 輸出範例 (OUTPUT EXAMPLE) ---**
+{{"title": "小港空污USR計畫成效", "intro": "小港空污USR計畫已展現出一定的成效，主要體現在提升社區居民對空污議題的認知。", "sections": [{{"title": "社區參與與教育推廣", "emoji": "🏫", "points": ["計畫團隊深入小港區的學校與社區，舉辦各類環境與健康教育活動。"]}}], "conclusion": "整體而言，計畫有效提升了居民的健康意識。"}}
+"""
+)
+COMPACT_OUTPUT_RATIO = min(max(float(os.environ.get("COMPACT_OUTPUT_RATIO", "0")), 0.0), 1.0)
+
 common_llm_config = { "temperature": 0.1, "top_p": 0.8 }
+
+# --- 每個模板的生成長度預算與停止序列 (Generation Budgets & Stop Sequences) ---
+# num_predict 限制輸出 token 數；停止序列取自模板本身的區段標記，模型開始回顯提示詞時 Ollama 會立即停止，
+# 不再為 post_process_answer 會丟棄的內容付出 GPU 時間。預算可用 TEMPLATE_NUM_PREDICT (JSON) 覆寫。
+TEMPLATE_NUM_PREDICT = {
+    "structured_list": 1200,
+    "hierarchical_bullets": 1500,
+    "paragraph_emoji_lead": 900,
+    "custom_format": 1200,
+    "research": 2500,
+    "compact_structured": 700,
+    **json.loads(os.environ.get("TEMPLATE_NUM_PREDICT", "{}")),
+}
+MAX_OUTPUT_TOKENS_LIMIT = int(os.environ.get("MAX_OUTPUT_TOKENS_LIMIT", "4096"))
+# 與 post_process_answer 移除的回顯標記一致 (舊版模板的標記)
+ECHO_STOP_MARKERS = ["📘 Conversation History:", "📄 Retrieved Context:", "❓ User Question:",
+                     "You are a helpful assistant", "You are a policy analyst"]
+TEMPLATE_KEYS = [
+    (STRUCTURED_LIST_PROMPT, "structured_list"), (HIERARCHICAL_BULLETS_PROMPT, "hierarchical_bullets"),
+    (PARAGRAPH_EMOJI_LEAD_PROMPT, "paragraph_emoji_lead"), (CUSTOM_FORMAT_BASE_PROMPT, "custom_format"),
+    (RESEARCH_PROMPT_TEMPLATE, "research"), (COMPACT_STRUCTURED_PROMPT, "compact_structured"),
+]
+
+def _template_key(template: PromptTemplate) -> str:
+    return next((key for t, key in TEMPLATE_KEYS if t is template), "unknown")
+
+def _template_stop_sequences(template: PromptTemplate) -> List[str]:
+    """從模板文字取出區段標記：<CONTEXT> 類標籤、「**--- 區段名稱」標題與「👇 **」結尾指示"""
+    stops = []
+    for tag in re.findall(r"</?[A-Z_]{3,}>", template.template):
+        if tag not in stops: stops.append(tag)
+    for line in template.template.splitlines():
+        line = line.strip()
+        if line.startswith("**--- "): marker = " ".join(line.split()[:2])
+        elif line.startswith("👇"): marker = "👇 **"
+        else: continue
+        if marker not in stops: stops.append(marker)
+    return stops + [m for m in ECHO_STOP_MARKERS if m not in stops]
+
+TEMPLATE_STOP_SEQUENCES = {key: _template_stop_sequences(template) for template, key in TEMPLATE_KEYS}
+COMPACT_TEMPLATE_VARIANTS = {
+    "structured_list": STRUCTURED_LIST_PROMPT_COMPACT, "hierarchical_bullets": HIERARCHICAL_BULLETS_PROMPT_COMPACT,
+    "paragraph_emoji_lead": PARAGRAPH_EMOJI_LEAD_PROMPT_COMPACT, "custom_format": CUSTOM_FORMAT_BASE_PROMPT_COMPACT,
+    "research": RESEARCH_PROMPT_TEMPLATE_COMPACT,
+}
+COMPACT_TEMPLATE_STOP_SEQUENCES = {key: _template_stop_sequences(template) for key, template in COMPACT_TEMPLATE_VARIANTS.items()}
+
+def _load_prompt_variants(spec: str) -> Dict[str, str]:
+    """"full" / "compact" 套用到所有模板，或以 JSON 逐模板指定；未指定的模板使用 full"""
+    spec = (spec or "").strip() or "full"
+    choices = json.loads(spec) if spec.startswith("{") else {key: spec for key in COMPACT_TEMPLATE_VARIANTS}
+    invalid = {key: v for key, v in choices.items() if key not in COMPACT_TEMPLATE_VARIANTS or v not in ("full", "compact")}
+    if invalid: raise ValueError(f"PROMPT_TEMPLATE_VARIANT 設定無效: {invalid}")
+    return {key: choices.get(key, "full") for key in COMPACT_TEMPLATE_VARIANTS}
+
+PROMPT_TEMPLATE_VARIANTS = _load_prompt_variants(os.environ.get("PROMPT_TEMPLATE_VARIANT", "full"))
+
+def _prompt_template_variant(template_key: str, template: PromptTemplate):
+    """回傳 (variant, 模板, 停止序列)"""
+    if PROMPT_TEMPLATE_VARIANTS.get(template_key) == "compact":
+        return "compact", COMPACT_TEMPLATE_VARIANTS[template_key], COMPACT_TEMPLATE_STOP_SEQUENCES[template_key]
+    return "full", template, TEMPLATE_STOP_SEQUENCES.get(template_key, ECHO_STOP_MARKERS)
+_generation_stats_lock = threading.Lock()
+_generation_stats: Dict[str, Dict] = {}  # template key -> {"count", "truncated", "parse_failures", "eval_counts": deque, "seconds": deque}
+
+def _generation_stats_entry(template_key: str) -> Dict:
+    return _generation_stats.setdefault(template_key, {"count": 0, "truncated": 0, "parse_failures": 0,
+                                                       "eval_counts": deque(maxlen=500), "seconds": deque(maxlen=500)})
+
+def _record_generation(template_key: str, done_reason: Optional[str], eval_count: Optional[int], seconds: Optional[float] = None):
+    _inc_metric("llm_generations_total", labels={"template": template_key, "done_reason": str(done_reason)})
+    if eval_count: _inc_metric("llm_output_tokens_total", eval_count, labels={"template": template_key})
+    with _generation_stats_lock:
+        stats = _generation_stats_entry(template_key)
+        stats["count"] += 1
+        if done_reason == "length": stats["truncated"] += 1
+        if eval_count: stats["eval_counts"].append(eval_count)
+        if seconds is not None: stats["seconds"].append(seconds)
+
+def _record_compact_parse_failure(stats_key: str):
+    _inc_metric("structured_output_parse_failures_total", labels={"template": stats_key})
+    with _generation_stats_lock: _generation_stats_entry(stats_key)["parse_failures"] += 1
+
+_prompt_token_stats: Dict[str, Dict] = {}  # "<template key>:<variant>" -> {"count", "sections": {區段: deque}, "prompt_eval_counts", "prefill_seconds"}
+
+def _record_prompt_tokens(template_key: str, variant: str, breakdown: Dict[str, int], generation_info: Dict):
+    """breakdown 為各區段的估計 token 數；prompt_eval_count / prompt_eval_duration 為 Ollama 實際預填的 token 數與時間"""
+    labels = {"template": template_key, "variant": variant}
+    for section, tokens in breakdown.items():
+        _inc_metric("llm_prompt_tokens_estimated_total", tokens, labels={**labels, "section": section})
+    prompt_eval_count, prefill_seconds = generation_info.get("prompt_eval_count"), (generation_info.get("prompt_eval_duration") or 0) / 1e9
+    if prompt_eval_count: _inc_metric("llm_prompt_eval_tokens_total", prompt_eval_count, labels=labels)
+    if prefill_seconds: _inc_metric("llm_prefill_seconds_total", prefill_seconds, labels=labels)
+    with _generation_stats_lock:
+        stats = _prompt_token_stats.setdefault(f"{template_key}:{variant}", {
+            "count": 0, "sections": {section: deque(maxlen=500) for section in PROMPT_SECTIONS},
+            "prompt_eval_counts": deque(maxlen=500), "prefill_seconds": deque(maxlen=500)})
+        stats["count"] += 1
+        for section, tokens in breakdown.items(): stats["sections"][section].append(tokens)
+        if prompt_eval_count: stats["prompt_eval_counts"].append(prompt_eval_count)
+        if prefill_seconds: stats["prefill_seconds"].append(prefill_seconds)
 SUPPORTED_MODELS = [
     "qwen3:14b", "gemma3:12b", "gemma3:12b-it-q4_K_M", "qwen2.5:14b-instruct-q5_K_M",
     # 為了測試，可以加入一個較小的模型
@@ -792,45 +1371,274 @@ SUPPORTED_MODELS = [
 ]
 DEFAULT_MODEL = "gemma3:12b" # Or your preferred default
 
-@lru_cache(maxsize=5)
+class ModelLoadError(Exception):
+    pass
+
 def get_model(model_name: str) -> Optional[OllamaLLM]:
+    # 載入失敗時拋出例外而不是回傳 None，lru_cache 不會快取失敗，下次呼叫會重新嘗試
+    try:
+        return _load_model(model_name)
+    except ModelLoadError:
+        return None
+
+@lru_cache(maxsize=5)
+def _load_model(model_name: str) -> OllamaLLM:
     if model_name not in SUPPORTED_MODELS:
         logger.warning(f"⚠️ 請求的模型 '{model_name}' 不在支援列表，將使用預設模型 '{DEFAULT_MODEL}'。")
         model_name = DEFAULT_MODEL
+    # 多後端時依序嘗試，任一後端預熱成功即可
+    for backend in ollama_pool.ranked(model_name):
+        try:
+            logger.info(f"⏳ 正在載入或獲取緩存的模型: {model_name} ({backend.name})...")
+            # 設定一個合理的超時時間，例如10分鐘
+            model = OllamaLLM(model=model_name, base_url=backend.url, **common_llm_config, request_timeout=600.0)
+            # 預熱測試，如果這裡就失敗，表示模型載入有問題
+            _ = model.invoke("請用繁體中文做個簡短的自我介紹")
+            logger.info(f"✅ 模型 {model_name} 載入並測試成功")
+            return model
+        except Exception as e:
+            ollama_pool.record_failure(backend, e, model_name)
+            logger.error(f"❌ 載入或測試模型 {model_name} 失敗 ({backend.name}): {str(e)}", exc_info=True)
+    logger.error(f"💡 提示：模型載入失敗可能是因為 VRAM/RAM 不足，或模型檔案損毀。請嘗試：1. 重新啟動 Ollama 服務。 2. 執行 'ollama pull {model_name}' 重新下載模型。 3. 嘗試更小的模型（如 llama3:8b）。")
+    raise ModelLoadError(model_name)
+
+# --- 模型降級策略 (Model Fallback Cascade) ---
+# 依每個模型最近的延遲與錯誤率估計「排隊等待 + 生成」時間；超過該模型的延遲 SLO 或錯誤率過高時，
+# 改用 MODEL_FALLBACK_CHAIN 中較小的模型。呼叫端可用 allow_model_fallback=false 停用。
+# 統計只涵蓋本 worker 內的請求。
+MODEL_FALLBACK_CHAIN: Dict[str, List[str]] = json.loads(os.environ.get("MODEL_FALLBACK_CHAIN", json.dumps({
+    "qwen3:14b": ["llama3:8b", "qwen:4b"],
+    "gemma3:12b": ["llama3:8b", "qwen:4b"],
+    "gemma3:12b-it-q4_K_M": ["llama3:8b", "qwen:4b"],
+    "qwen2.5:14b-instruct-q5_K_M": ["llama3:8b", "qwen:4b"],
+    "llama3:8b": ["qwen:4b"],
+})))
+MODEL_LATENCY_SLO_SECONDS: Dict[str, float] = json.loads(os.environ.get("MODEL_LATENCY_SLO_SECONDS", "{}"))
+MODEL_DEFAULT_LATENCY_SLO_SECONDS = float(os.environ.get("MODEL_DEFAULT_LATENCY_SLO_SECONDS", "90"))
+MODEL_ERROR_RATE_THRESHOLD = float(os.environ.get("MODEL_ERROR_RATE_THRESHOLD", "0.5"))
+MODEL_HEALTH_WINDOW = int(os.environ.get("MODEL_HEALTH_WINDOW", "20"))
+MODEL_HEALTH_MIN_SAMPLES = int(os.environ.get("MODEL_HEALTH_MIN_SAMPLES", "4"))
+# 樣本超過此秒數即不再採計；被降級的模型沒有新流量時，統計會自然過期並恢復使用
+MODEL_HEALTH_MAX_AGE_SECONDS = float(os.environ.get("MODEL_HEALTH_MAX_AGE_SECONDS", "120"))
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "1"))  # 與 Ollama 伺服器的設定一致
+_model_health_lock = threading.Lock()
+_model_health: Dict[str, Dict] = {}
+
+def _health_for(model_name: str) -> Dict:
+    # 呼叫端需持有 _model_health_lock
+    return _model_health.setdefault(model_name, {
+        "inflight": 0, "latencies": deque(maxlen=MODEL_HEALTH_WINDOW), "outcomes": deque(maxlen=MODEL_HEALTH_WINDOW)})
+
+def _model_load_estimate(model_name: str) -> Dict:
+    cutoff = time.time() - MODEL_HEALTH_MAX_AGE_SECONDS
+    with _model_health_lock:
+        health = _health_for(model_name)
+        latencies = sorted(v for ts, v in health["latencies"] if ts >= cutoff)
+        outcomes = [v for ts, v in health["outcomes"] if ts >= cutoff]
+        inflight = health["inflight"]
+    p50 = latencies[len(latencies) // 2] if len(latencies) >= MODEL_HEALTH_MIN_SAMPLES else None
+    # 新請求需等待前面已在處理的請求 (每個後端的 Ollama 每個模型同時處理 OLLAMA_NUM_PARALLEL 個)
+    queue_wait = (inflight // (max(OLLAMA_NUM_PARALLEL, 1) * ollama_pool.capacity(model_name))) * p50 if p50 else 0.0
+    error_rate = (outcomes.count(False) / len(outcomes)) if len(outcomes) >= MODEL_HEALTH_MIN_SAMPLES else 0.0
+    return {"inflight": inflight, "p50_latency_seconds": p50, "estimated_queue_wait_seconds": round(queue_wait, 2),
+            "error_rate": round(error_rate, 3), "samples": len(outcomes),
+            "slo_seconds": MODEL_LATENCY_SLO_SECONDS.get(model_name, MODEL_DEFAULT_LATENCY_SLO_SECONDS)}
+
+def _model_degradation_reason(model_name: str) -> Optional[str]:
+    estimate = _model_load_estimate(model_name)
+    if estimate["error_rate"] >= MODEL_ERROR_RATE_THRESHOLD:
+        return "error_rate"
+    # p50 延遲本身也反映了 Ollama 端的排隊 (其他 worker 的請求)
+    if estimate["p50_latency_seconds"] and estimate["estimated_queue_wait_seconds"] + estimate["p50_latency_seconds"] > estimate["slo_seconds"]:
+        return "queue_wait" if estimate["estimated_queue_wait_seconds"] else "latency_slo"
+    return None
+
+def _choose_model(requested_model: str, allow_fallback: bool = True, exclude: Optional[set] = None):
+    """回傳 (模型名稱, OllamaLLM, 降級原因)；不允許降級或無可用替代模型時回傳原模型"""
+    exclude = exclude or set()
+    reason = None if requested_model in exclude else _model_degradation_reason(requested_model)
+    llm = None
+    # 已知降級且允許替換時不載入原模型，避免預熱一個不會被使用的模型
+    if reason is None or not allow_fallback:
+        llm = get_model(requested_model) if requested_model not in exclude else None
+        if llm is not None or not allow_fallback: return requested_model, llm, None
+        if reason is None: reason = "unavailable"
+    for candidate in MODEL_FALLBACK_CHAIN.get(requested_model, []):
+        if candidate in exclude or candidate not in SUPPORTED_MODELS or _model_degradation_reason(candidate): continue
+        candidate_llm = get_model(candidate)
+        if candidate_llm is not None:
+            return candidate, candidate_llm, reason
+    # 沒有可用的替代模型：仍以原模型處理
+    if llm is None and requested_model not in exclude and reason != "unavailable": llm = get_model(requested_model)
+    return requested_model, llm, None
+
+@contextmanager
+def _track_model_call(model_name: str):
+    with _model_health_lock: _health_for(model_name)["inflight"] += 1
+    start, outcome = time.time(), "error"
+    try:
+        yield
+        outcome = "ok"
+    except (RequestCancelledError, asyncio.CancelledError):
+        # 用戶端取消不代表模型異常，不計入錯誤率與延遲
+        outcome = "cancelled"
+        raise
+    finally:
+        with _model_health_lock:
+            health = _health_for(model_name)
+            health["inflight"] -= 1
+            now = time.time()
+            if outcome != "cancelled": health["outcomes"].append((now, outcome == "ok"))
+            if outcome == "ok": health["latencies"].append((now, now - start))
+        _inc_metric("llm_calls_total", labels={"model": model_name, "outcome": outcome})
+
+# --- 模型親和排程 (Model-Affinity Scheduling) ---
+# 生成前先向排程器取得名額：常駐模型優先、切換前先排空目前模型的這一批，其他模型最多等待 MODEL_SCHEDULER_MAX_WAIT_SECONDS。
+# MODEL_SCHEDULER_MAX_RESIDENT 應與 Ollama 的 OLLAMA_MAX_LOADED_MODELS (VRAM 放得下的模型數) 一致。
+MODEL_SCHEDULER_ENABLED = os.environ.get("MODEL_SCHEDULER_ENABLED", "true").lower() == "true"
+MODEL_SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get("MODEL_SCHEDULER_MAX_WAIT_SECONDS", "20"))
+MODEL_SCHEDULER_MAX_RESIDENT = int(os.environ.get("MODEL_SCHEDULER_MAX_RESIDENT", os.environ.get("OLLAMA_MAX_LOADED_MODELS", "1")))
+MODEL_SCHEDULER_PS_REFRESH_SECONDS = float(os.environ.get("MODEL_SCHEDULER_PS_REFRESH_SECONDS", "5"))
+# 每個模型同時放行的請求數只在明確設定 OLLAMA_NUM_PARALLEL 時限制；未設定時不限制，交給 Ollama 依自己的設定排隊
+MODEL_SCHEDULER_SLOTS_PER_MODEL = OLLAMA_NUM_PARALLEL if os.environ.get("OLLAMA_NUM_PARALLEL") else None
+OLLAMA_HOST = normalize_ollama_url(os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434"))
+
+def _new_model_scheduler(ollama_url: str) -> ModelAffinityScheduler:
+    return ModelAffinityScheduler(
+        ollama_url, slots_per_model=MODEL_SCHEDULER_SLOTS_PER_MODEL, max_resident=MODEL_SCHEDULER_MAX_RESIDENT,
+        max_wait_seconds=MODEL_SCHEDULER_MAX_WAIT_SECONDS, ps_refresh_seconds=MODEL_SCHEDULER_PS_REFRESH_SECONDS,
+        enabled=MODEL_SCHEDULER_ENABLED, metric=lambda name, value=1.0, labels=None: _inc_metric(name, value, labels),
+    )
+
+# --- 多 Ollama 後端 (Ollama Backend Pool) ---
+# OLLAMA_BACKENDS 未設定時只有 OLLAMA_HOST 一個後端。每個後端有各自的模型親和排程器；
+# 生成時選擇進行中請求最少的健康後端，連線錯誤 / 5xx 時立即改送下一個後端 (最多 OLLAMA_BACKEND_MAX_ATTEMPTS 個)。
+OLLAMA_BACKENDS = os.environ.get("OLLAMA_BACKENDS", "")
+OLLAMA_BACKEND_MAX_FAILURES = int(os.environ.get("OLLAMA_BACKEND_MAX_FAILURES", "3"))
+OLLAMA_BACKEND_EJECT_SECONDS = float(os.environ.get("OLLAMA_BACKEND_EJECT_SECONDS", "30"))
+OLLAMA_HEALTH_CHECK_SECONDS = float(os.environ.get("OLLAMA_HEALTH_CHECK_SECONDS", "10"))
+ollama_pool = OllamaBackendPool.from_config(
+    OLLAMA_BACKENDS, OLLAMA_HOST, scheduler_factory=_new_model_scheduler,
+    max_failures=OLLAMA_BACKEND_MAX_FAILURES, eject_seconds=OLLAMA_BACKEND_EJECT_SECONDS,
+    health_check_seconds=OLLAMA_HEALTH_CHECK_SECONDS, metric=lambda name, value=1.0, labels=None: _inc_metric(name, value, labels),
+)
+OLLAMA_BACKEND_MAX_ATTEMPTS = int(os.environ.get("OLLAMA_BACKEND_MAX_ATTEMPTS", str(len(ollama_pool.backends))))
+if OLLAMA_BACKENDS:
+    logger.info(f"🖧 Ollama 後端池: {', '.join(b.url for b in ollama_pool.backends)}")
+
+@lru_cache(maxsize=64)
+def _backend_llm(base_url: str, model_name: str) -> OllamaLLM:
+    return OllamaLLM(model=model_name, base_url=base_url, **common_llm_config, request_timeout=600.0)
+
+# --- 問題複雜度路由 (Complexity-based Model Routing) ---
+# 用戶端未指定模型或指定 "auto" 時，在檢索完成後依問題長度、類型、格式、prompt_mode、歷史輪數與檢索分數選擇模型等級；
+# 停用時與過去相同使用 DEFAULT_MODEL。選出的模型仍會經過上面的降級策略。
+AUTO_MODEL = "auto"
+MODEL_ROUTER_ENABLED = os.environ.get("MODEL_ROUTER_ENABLED", "false").lower() == "true"
+MODEL_ROUTER_TIERS: Dict[str, str] = json.loads(os.environ.get("MODEL_ROUTER_TIERS", json.dumps({"small": "llama3:8b", "large": DEFAULT_MODEL})))
+model_router = ComplexityRouter(MODEL_ROUTER_TIERS, load_rules(os.environ.get("MODEL_ROUTER_RULES", "")),
+                                default_tier=os.environ.get("MODEL_ROUTER_DEFAULT_TIER", "large"), enabled=MODEL_ROUTER_ENABLED)
+
+def _resolve_requested_model(model_name: Optional[str]) -> Optional[str]:
+    """回傳用戶端指定的模型；None 代表交給路由器決定"""
+    if model_name in SUPPORTED_MODELS: return model_name
+    if MODEL_ROUTER_ENABLED and model_name in (None, "", AUTO_MODEL): return None
+    return DEFAULT_MODEL
+
+def _select_model(requested_model: str, allow_model_fallback: bool, username: str):
+    with span("model.select", **{"llm.model_requested": requested_model}) as model_span:
+        # 模型第一次使用時 get_model 會在這裡同步載入 / 預熱
+        selected_model, llm, fallback_reason = _choose_model(requested_model, allow_model_fallback)
+        model_span.set_attributes(**{"llm.model": selected_model, "llm.fallback_reason": fallback_reason})
+    if fallback_reason:
+        logger.warning(f"⚠️ 模型 '{requested_model}' 目前 {fallback_reason}，用戶 {username} 的請求改用 '{selected_model}'")
+        _inc_metric("llm_model_fallbacks_total", labels={"requested": requested_model, "used": selected_model, "reason": fallback_reason})
+    if llm is None:
+        logger.error(f"❌ RAG process error: LLM '{selected_model}' not loaded.")
+        raise HTTPException(status_code=500, detail=f"無法載入語言模型 '{selected_model}'. 請檢查伺服器日誌以了解詳情。")
+    return selected_model, llm, fallback_reason
+
+def _shared_state_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(SHARED_STATE_DB_PATH), timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS rate_events (client TEXT NOT NULL, ts REAL NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_events_client_ts ON rate_events (client, ts)")
+    return conn
+
+def _rate_limit_exceeded(client_key: str, limit: int, window_seconds: float = 60) -> bool:
+    current_time = time.time()
+    if not MULTI_WORKER_MODE:
+        request_timestamps = request_counters.get(client_key, [])
+        valid_timestamps = [t for t in request_timestamps if current_time - t < window_seconds]
+        if len(valid_timestamps) >= limit:
+            request_counters[client_key] = valid_timestamps
+            return True
+        valid_timestamps.append(current_time)
+        request_counters[client_key] = valid_timestamps
+        return False
+    # 多 worker 模式：所有 worker 共用同一個 SQLite 計數表
+    conn = _shared_state_connection()
     try:
-        logger.info(f"⏳ 正在載入或獲取緩存的模型: {model_name}...")
-        # 設定一個合理的超時時間，例如10分鐘
-        model = OllamaLLM(model=model_name, **common_llm_config, request_timeout=600.0)
-        # 預熱測試，如果這裡就失敗，表示模型載入有問題
-        _ = model.invoke("請用繁體中文做個簡短的自我介紹")
-        logger.info(f"✅ 模型 {model_name} 載入並測試成功")
-        return model
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM rate_events WHERE ts < ?", (current_time - window_seconds,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM rate_events WHERE client = ?", (client_key,)).fetchone()
+        if count >= limit:
+            conn.execute("COMMIT")
+            return True
+        conn.execute("INSERT INTO rate_events (client, ts) VALUES (?, ?)", (client_key, current_time))
+        conn.execute("COMMIT")
+        return False
     except Exception as e:
-        logger.error(f"❌ 載入或測試模型 {model_name} 失敗: {str(e)}", exc_info=True)
-        logger.error(f"💡 提示：模型載入失敗可能是因為 VRAM/RAM 不足，或模型檔案損毀。請嘗試：1. 重新啟動 Ollama 服務。 2. 執行 'ollama pull {model_name}' 重新下載模型。 3. 嘗試更小的模型（如 llama3:8b）。")
-        return None
+        logger.error(f"❌ 共用速率限制計數失敗，本次請求不限制: {e}", exc_info=True)
+        try: conn.execute("ROLLBACK")
+        except Exception: pass
+        return False
+    finally:
+        conn.close()
+
+async def _rate_limit_exceeded_async(client_key: str, limit: int) -> bool:
+    # 多 worker 模式的共用計數需取得 SQLite 寫入鎖 (最多等待 10 秒)，放到執行緒執行，不讓事件迴圈上的其他請求 (含串流中的回應) 一起停住
+    if MULTI_WORKER_MODE: return await asyncio.to_thread(_rate_limit_exceeded, client_key, limit)
+    return _rate_limit_exceeded(client_key, limit)
 
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    if "/chat" in str(request.url) or "/api/v1/public/rag/ask" in str(request.url):
+    # /chat/prefetch 只做檢索且由前端 debounce 觸發，另用一個較寬鬆的額度 (PREFETCH_RATE_LIMIT_PER_MINUTE)，不佔用 /chat 的額度
+    if request.url.path == "/chat/prefetch":
+        client_ip = request.client.host if request.client else "unknown"
+        if await _rate_limit_exceeded_async(f"prefetch:{client_ip}", PREFETCH_RATE_LIMIT_PER_MINUTE):
+            from fastapi.responses import JSONResponse
+            return JSONResponse(status_code=429, content={"error": "預取請求過於頻繁"})
+    elif "/chat" in str(request.url) or "/api/v1/public/rag/ask" in str(request.url):
         client_ip = request.client.host if request.client else "unknown"
-        current_time = time.time()
-        request_timestamps = request_counters.get(client_ip, [])
-        valid_timestamps = [t for t in request_timestamps if current_time - t < 60]
-        rate_limit_count = 30
-        if len(valid_timestamps) >= rate_limit_count:
+        if await _rate_limit_exceeded_async(client_ip, RATE_LIMIT_PER_MINUTE):
             logger.warning(f"🚦 速率限制觸發: IP {client_ip} for URL {request.url}")
             from fastapi.responses import JSONResponse
             return JSONResponse(status_code=429, content={"error": "請求過於頻繁"})
-        valid_timestamps.append(current_time)
-        request_counters[client_ip] = valid_timestamps
     return await call_next(request)
 
+TRACE_ID_HEADER = "X-Trace-Id"
+
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    # 沿用上游的 W3C traceparent，否則開新 trace；trace ID 以 X-Trace-Id 回傳，可對照日誌與 QA 記錄中的 trace_id
+    trace_id, parent_id = parse_traceparent(request.headers.get("traceparent"))
+    with start_trace(f"{request.method} {request.url.path}", trace_id=trace_id, parent_id=parent_id,
+                     **{"http.method": request.method, "http.target": request.url.path}) as root:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None: root.name = f"{request.method} {route.path}"
+        root.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500: root.set_error(f"HTTP {response.status_code}")
+        response.headers[TRACE_ID_HEADER] = root.trace_id
+        return response
+
 class ChatRequest(BaseModel):
     session_id: str
     question: str
-    model: Optional[str] = DEFAULT_MODEL
+    model: Optional[str] = None  # 未指定或 "auto"：啟用路由時依問題複雜度選擇，否則使用 DEFAULT_MODEL
     prompt_mode: str = "default"
+    allow_model_fallback: bool = True
 
 class FeedbackRequest(BaseModel):
     session_id: str
@@ -841,9 +1649,38 @@ class FeedbackRequest(BaseModel):
     user_expected_answer: str
 
 class ChatListItem(BaseModel): id: str; title: str; updated_at: str
+class ArchivedChatItem(ChatListItem): archived_at: str; messages: int
 class NewChatRequest(BaseModel): id: str; title: str
 class RenameChatRequest(BaseModel): title: str
-class Message(BaseModel): role: str; content: str
+class Message(BaseModel): role: str; content: str; index: Optional[int] = None
+
+MAX_PAGE_LIMIT = 200
+
+def _encode_chat_cursor(updated_at: str, chat_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([updated_at, chat_id], ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+def _decode_chat_cursor(cursor: str):
+    try:
+        updated_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return str(updated_at), str(chat_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="無效的 cursor")
+
+def _files_etag(request: Request, *paths: Path) -> str:
+    # 以檔案 stat (inode / mtime / 大小) 與查詢參數組成 ETag，不需讀取或序列化檔案內容即可判斷是否變更
+    parts = [request.url.path, str(request.url.query)]
+    for path in paths:
+        try:
+            st = path.stat()
+            parts.append(f"{st.st_ino}-{st.st_mtime_ns}-{st.st_size}")
+        except FileNotFoundError:
+            parts.append("missing")
+    return 'W/"' + hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest() + '"'
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match: return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
 
 def _load_user_chats_metadata(username: str) -> Dict[str, Dict[str, str]]:
     metadata_file = get_user_chats_metadata_file(username)
@@ -857,7 +1694,7 @@ def _save_user_chats_metadata(username: str, metadata: Dict[str, Dict[str, str]]
     metadata_file = get_user_chats_metadata_file(username)
     try:
         sorted_metadata = dict(sorted(metadata.items(), key=lambda item: item[1].get('updated_at', '1970-01-01T00:00:00Z'), reverse=True))
-        with open(metadata_file, "w", encoding="utf-8") as f: json.dump(sorted_metadata, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(metadata_file, sorted_metadata)
         logger.debug(f"用戶 {username} 的聊天元數據已保存到 {metadata_file}")
     except Exception as e: logger.error(f"❌ 保存用戶 {username} 的聊天元數據失敗: {e}", exc_info=True)
 
@@ -872,10 +1709,33 @@ def _get_user_chat_messages(username: str, chat_id: str) -> List[Dict[str, str]]
 def _save_user_chat_messages(username: str, chat_id: str, messages: List[Dict[str, str]]):
     message_file = get_user_chat_messages_dir(username) / f"{chat_id}.json"
     try:
-        with open(message_file, "w", encoding="utf-8") as f: json.dump(messages, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(message_file, messages)
         logger.debug(f"用戶 {username} 聊天 {chat_id} 的訊息已保存到 {message_file}")
     except Exception as e: logger.error(f"❌ 保存用戶 {username} 聊天 {chat_id} 的訊息失敗: {e}", exc_info=True)
 
+def _chat_archive(username: str) -> ChatArchive: return ChatArchive(get_user_chat_data_dir(username))
+
+def _restore_archived_chat(username: str, chat_id: str) -> bool:
+    # 呼叫端需持有 _user_chat_lock；先寫回熱資料再從封存移除，中斷時不會遺失聊天
+    archive = _chat_archive(username)
+    archived = archive.load(chat_id)
+    if archived is None: return False
+    meta, messages = archived
+    meta["restored_at"] = datetime.now().isoformat()  # 不更動 updated_at，聊天列表的排序維持不變
+    user_chats_metadata = _load_user_chats_metadata(username)
+    user_chats_metadata[chat_id] = meta
+    _save_user_chat_messages(username, chat_id, messages)
+    _save_user_chats_metadata(username, user_chats_metadata)
+    archive.discard(chat_id)
+    _inc_metric("chat_sessions_restored_total")
+    logger.info(f"📤 已從封存還原用戶 {username} 的聊天 {chat_id} ({len(messages)} 則訊息)")
+    return True
+
+def _ensure_chat_restored(username: str, chat_id: str):
+    if chat_id not in _chat_archive(username): return
+    with _user_chat_lock(username):
+        if chat_id not in _load_user_chats_metadata(username): _restore_archived_chat(username, chat_id)
+
 # MODIFIED: post_process_answer with refined Markdown handling for default mode
 # MODIFIED: post_process_answer with EXTREMELY conservative Markdown handling for default mode
 def post_process_answer(answer: str, format_mode: str = "default") -> str:
@@ -1011,111 +1871,807 @@ def post_process_answer(answer: str, format_mode: str = "default") -> str:
 
 
 @api_router.get("/chats", response_model=List[ChatListItem])
-async def get_chat_list_for_user(username: str = Depends(get_current_username)):
+async def get_chat_list_for_user(
+    request: Request, response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT, description="每頁筆數；未指定時回傳全部"),
+    cursor: Optional[str] = Query(None, description="上一頁回應標頭 X-Next-Cursor 的值"),
+    updated_since: Optional[str] = Query(None, description="只回傳 updated_at 晚於此值的聊天；請帶上一次回應標頭 X-Sync-Watermark 的值"),
+    username: str = Depends(get_current_username),
+):
+    etag = _files_etag(request, get_user_chats_metadata_file(username))
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     user_chats_metadata = _load_user_chats_metadata(username)
     chat_list = [ChatListItem(id=chat_id, title=meta.get("title", "無標題"), updated_at=meta.get("updated_at", "")) for chat_id, meta in user_chats_metadata.items()]
-    chat_list.sort(key=lambda x: x.updated_at, reverse=True)
+    # updated_at 是伺服器本地時間的字串，只能與伺服器發出的值比較；用戶端應帶回這個 watermark，而不是自己的時鐘
+    response.headers["X-Sync-Watermark"] = max((c.updated_at for c in chat_list), default="")
+    if updated_since:
+        chat_list = [c for c in chat_list if c.updated_at > updated_since]
+    # 依 (updated_at, id) 由新到舊排序，cursor 指向上一頁最後一筆
+    chat_list.sort(key=lambda x: (x.updated_at, x.id), reverse=True)
+    response.headers["X-Total-Count"] = str(len(chat_list))
+    if cursor:
+        cursor_key = _decode_chat_cursor(cursor)
+        chat_list = [c for c in chat_list if (c.updated_at, c.id) < cursor_key]
+    if limit is not None and len(chat_list) > limit:
+        chat_list = chat_list[:limit]
+        response.headers["X-Next-Cursor"] = _encode_chat_cursor(chat_list[-1].updated_at, chat_list[-1].id)
     return chat_list
 
+@api_router.get("/chats/archived", response_model=List[ArchivedChatItem])
+async def get_archived_chat_list_for_user(username: str = Depends(get_current_username)):
+    # 封存的聊天不在 /chats 列表中；讀取 /chats/{chat_id}/messages 時會自動還原
+    archived = [ArchivedChatItem(id=chat_id, title=meta.get("title", "無標題"), updated_at=meta.get("updated_at", ""),
+                                 archived_at=meta.get("archived_at", ""), messages=meta.get("messages", 0))
+                for chat_id, meta in (await asyncio.to_thread(_chat_archive(username).index)).items()]
+    return sorted(archived, key=lambda x: (x.updated_at, x.id), reverse=True)
+
+# 以下聊天端點會取得每用戶的檔案鎖 (最多等待 CHAT_LOCK_TIMEOUT_SECONDS)，宣告為同步端點由 FastAPI 放到執行緒池執行，不阻塞事件迴圈
 @api_router.post("/chats", response_model=ChatListItem)
-async def create_new_chat_for_user(req: NewChatRequest, username: str = Depends(get_current_username)):
-    user_chats_metadata = _load_user_chats_metadata(username)
-    if req.id in user_chats_metadata: raise HTTPException(status_code=409, detail=f"聊天 ID {req.id} 已存在")
-    now_iso = datetime.now().isoformat()
-    user_chats_metadata[req.id] = {"title": req.title, "created_at": now_iso, "updated_at": now_iso}
-    _save_user_chats_metadata(username, user_chats_metadata)
-    _save_user_chat_messages(username, req.id, [])
+def create_new_chat_for_user(req: NewChatRequest, username: str = Depends(get_current_username)):
+    with _user_chat_lock(username):
+        user_chats_metadata = _load_user_chats_metadata(username)
+        if req.id in user_chats_metadata or req.id in _chat_archive(username): raise HTTPException(status_code=409, detail=f"聊天 ID {req.id} 已存在")
+        now_iso = datetime.now().isoformat()
+        user_chats_metadata[req.id] = {"title": req.title, "created_at": now_iso, "updated_at": now_iso}
+        _save_user_chats_metadata(username, user_chats_metadata)
+        _save_user_chat_messages(username, req.id, [])
     logger.info(f"✅ 用戶 {username} 的新聊天已創建: ID={req.id}, Title='{req.title}'")
     return ChatListItem(id=req.id, title=req.title, updated_at=now_iso)
 
 @api_router.get("/chats/{chat_id}/messages", response_model=List[Message])
-async def get_chat_messages_for_user(chat_id: str, username: str = Depends(get_current_username)):
+def get_chat_messages_for_user(
+    chat_id: str, request: Request, response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT, description="最多回傳的訊息數（取最新的部分）；未指定時回傳全部"),
+    before: Optional[int] = Query(None, ge=0, description="只回傳 index 小於此值的訊息（用於載入更早的訊息）"),
+    after: Optional[int] = Query(None, ge=-1, description="只回傳 index 大於此值的訊息（用於增量同步）"),
+    username: str = Depends(get_current_username),
+):
+    _ensure_chat_restored(username, chat_id)
+    etag = _files_etag(request, get_user_chats_metadata_file(username), get_user_chat_messages_dir(username) / f"{chat_id}.json")
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     user_chats_metadata = _load_user_chats_metadata(username)
     if chat_id not in user_chats_metadata:
         logger.warning(f"用戶 {username} 請求不存在或不屬於他的聊天 {chat_id} 的訊息。")
         raise HTTPException(status_code=404, detail=f"聊天 ID {chat_id} 未找到")
+    response.headers["ETag"] = etag
     messages = _get_user_chat_messages(username, chat_id)
-    return [Message(role=msg["role"], content=msg["content"]) for msg in messages]
+    response.headers["X-Total-Count"] = str(len(messages))
+    # 訊息只會附加不會修改，因此以在檔案中的位置作為穩定的 index
+    start, end = 0, len(messages)
+    if after is not None: start = max(start, after + 1)
+    if before is not None: end = min(end, before)
+    if limit is not None and end - start > limit: start = end - limit
+    if start > 0 and start < end and after is None:
+        response.headers["X-Next-Cursor"] = str(start)
+    return [Message(role=msg["role"], content=msg["content"], index=i) for i, msg in enumerate(messages[start:end], start=start)]
 
 @api_router.put("/chats/{chat_id}", response_model=ChatListItem)
-async def rename_chat_for_user(chat_id: str, req: RenameChatRequest, username: str = Depends(get_current_username)):
-    user_chats_metadata = _load_user_chats_metadata(username)
-    if chat_id not in user_chats_metadata: raise HTTPException(status_code=404, detail=f"聊天 ID {chat_id} 未找到")
-    new_title = req.title.strip()
-    if not new_title: raise HTTPException(status_code=400, detail="標題不能為空")
-    now_iso = datetime.now().isoformat()
-    user_chats_metadata[chat_id]["title"] = new_title
-    user_chats_metadata[chat_id]["updated_at"] = now_iso
-    _save_user_chats_metadata(username, user_chats_metadata)
+def rename_chat_for_user(chat_id: str, req: RenameChatRequest, username: str = Depends(get_current_username)):
+    with _user_chat_lock(username):
+        user_chats_metadata = _load_user_chats_metadata(username)
+        if chat_id not in user_chats_metadata and _restore_archived_chat(username, chat_id):
+            user_chats_metadata = _load_user_chats_metadata(username)
+        if chat_id not in user_chats_metadata: raise HTTPException(status_code=404, detail=f"聊天 ID {chat_id} 未找到")
+        new_title = req.title.strip()
+        if not new_title: raise HTTPException(status_code=400, detail="標題不能為空")
+        now_iso = datetime.now().isoformat()
+        user_chats_metadata[chat_id]["title"] = new_title
+        user_chats_metadata[chat_id]["updated_at"] = now_iso
+        _save_user_chats_metadata(username, user_chats_metadata)
     logger.info(f"✅ 用戶 {username} 的聊天已重命名: ID={chat_id}, New Title='{new_title}'")
     return ChatListItem(id=chat_id, title=new_title, updated_at=now_iso)
 
 @api_router.delete("/chats/{chat_id}", status_code=204)
-async def delete_chat_for_user(chat_id: str, username: str = Depends(get_current_username)):
-    user_chats_metadata = _load_user_chats_metadata(username)
-    if chat_id not in user_chats_metadata: raise HTTPException(status_code=404, detail=f"聊天 ID {chat_id} 未找到")
-    del user_chats_metadata[chat_id]
-    _save_user_chats_metadata(username, user_chats_metadata)
-    message_file = get_user_chat_messages_dir(username) / f"{chat_id}.json"
-    if message_file.exists():
-        try:
-            message_file.unlink()
-            logger.info(f"用戶 {username} 的聊天訊息文件 {message_file} 已刪除。")
-        except Exception as e: logger.error(f"❌ 刪除用戶 {username} 的聊天訊息文件 {message_file} 失敗: {e}", exc_info=True)
-    logger.info(f"🗑️ 用戶 {username} 的聊天已刪除: ID={chat_id}")
-    if not user_chats_metadata:
-        user_chat_data_d = get_user_chat_data_dir(username)
-        user_chat_messages_d = get_user_chat_messages_dir(username)
+def delete_chat_for_user(chat_id: str, username: str = Depends(get_current_username)):
+    with _user_chat_lock(username):
+        user_chats_metadata = _load_user_chats_metadata(username)
+        if chat_id not in user_chats_metadata:
+            if not _chat_archive(username).discard(chat_id, purge=True): raise HTTPException(status_code=404, detail=f"聊天 ID {chat_id} 未找到")
+            logger.info(f"🗑️ 用戶 {username} 的封存聊天已刪除: ID={chat_id}")
+            return None
+        del user_chats_metadata[chat_id]
+        _save_user_chats_metadata(username, user_chats_metadata)
+        message_file = get_user_chat_messages_dir(username) / f"{chat_id}.json"
+        if message_file.exists():
+            try:
+                message_file.unlink()
+                logger.info(f"用戶 {username} 的聊天訊息文件 {message_file} 已刪除。")
+            except Exception as e: logger.error(f"❌ 刪除用戶 {username} 的聊天訊息文件 {message_file} 失敗: {e}", exc_info=True)
+        logger.info(f"🗑️ 用戶 {username} 的聊天已刪除: ID={chat_id}")
+        if not user_chats_metadata and not _chat_archive(username).index():
+            user_chat_data_d = get_user_chat_data_dir(username)
+            user_chat_messages_d = get_user_chat_messages_dir(username)
+            try:
+                if user_chat_messages_d.exists() and not any(user_chat_messages_d.iterdir()): # Check if messages dir is empty
+                    if user_chat_data_d.exists(): # Check if base user data dir exists before trying to delete
+                        shutil.rmtree(user_chat_data_d)
+                        logger.info(f"用戶 {username} 的數據目錄 {user_chat_data_d} 因無聊天記錄而被刪除。")
+            except Exception as e: logger.error(f"❌ 刪除空的用戶 {username} 數據目錄 {user_chat_data_d} 失敗: {e}", exc_info=True)
+    return None
+
+# --- 聊天記錄分層保存 (Chat Retention) ---
+# 超過 CHAT_RETENTION_DAYS 天未更新 (或還原後未再使用) 的聊天移出 chats_metadata.json 與 chat_messages/，
+# 壓縮保存在 <用戶資料夾>/archive/ (見 chat_archive.py)。熱資料只保留近期聊天，列表與元數據讀寫不再隨歷史成長；
+# 封存的聊天在讀取訊息、改名或以相同 session_id 繼續對話時自動還原。
+CHAT_RETENTION_DAYS = float(os.environ.get("CHAT_RETENTION_DAYS", "0"))  # 0 = 停用自動封存
+CHAT_RETENTION_INTERVAL_SECONDS = float(os.environ.get("CHAT_RETENTION_INTERVAL_SECONDS", "3600"))
+
+_chat_retention_stop_event = threading.Event()
+_chat_retention_state = {"last_run_at": None, "last_run": None, "archived_total": 0, "errors": 0, "last_error": None}
+
+def _chat_last_active(meta: Dict[str, str], message_file: Path) -> Optional[datetime]:
+    timestamps = []
+    for key in ("updated_at", "restored_at"):
         try:
-            if user_chat_messages_d.exists() and not any(user_chat_messages_d.iterdir()): # Check if messages dir is empty
-                if user_chat_data_d.exists(): # Check if base user data dir exists before trying to delete
-                    shutil.rmtree(user_chat_data_d)
-                    logger.info(f"用戶 {username} 的數據目錄 {user_chat_data_d} 因無聊天記錄而被刪除。")
-        except Exception as e: logger.error(f"❌ 刪除空的用戶 {username} 數據目錄 {user_chat_data_d} 失敗: {e}", exc_info=True)
+            ts = datetime.fromisoformat(meta.get(key) or "")
+            timestamps.append(ts.astimezone().replace(tzinfo=None) if ts.tzinfo else ts)
+        except ValueError: pass
+    if not timestamps and message_file.exists(): timestamps.append(datetime.fromtimestamp(message_file.stat().st_mtime))
+    return max(timestamps) if timestamps else None
+
+def _archive_idle_chats(username: str, cutoff: datetime) -> int:
+    messages_dir = get_user_chat_messages_dir(username)
+    with _user_chat_lock(username):
+        user_chats_metadata = _load_user_chats_metadata(username)
+        idle = {chat_id: meta for chat_id, meta in user_chats_metadata.items()
+                if (last_active := _chat_last_active(meta, messages_dir / f"{chat_id}.json")) is not None and last_active < cutoff}
+        if not idle: return 0
+        _chat_archive(username).archive({chat_id: (meta, _get_user_chat_messages(username, chat_id)) for chat_id, meta in idle.items()})
+        _save_user_chats_metadata(username, {chat_id: meta for chat_id, meta in user_chats_metadata.items() if chat_id not in idle})
+        for chat_id in idle: (messages_dir / f"{chat_id}.json").unlink(missing_ok=True)
+    _inc_metric("chat_sessions_archived_total", len(idle))
+    logger.info(f"📦 已封存用戶 {username} 的 {len(idle)} 個閒置聊天")
+    return len(idle)
+
+def _run_chat_retention(max_idle_days: float) -> Dict:
+    cutoff = datetime.now() - timedelta(days=max_idle_days)
+    result = {"cutoff": cutoff.isoformat(), "users": 0, "archived": 0, "skipped_users": []}
+    if USER_DATA_BASE_DIR.is_dir():
+        for user_dir in sorted(p for p in USER_DATA_BASE_DIR.iterdir() if p.is_dir()):
+            try:
+                archived = _archive_idle_chats(user_dir.name, cutoff)
+            except FileLockTimeout:
+                result["skipped_users"].append(user_dir.name)  # 用戶正在使用中，下一輪再處理
+                continue
+            if archived:
+                result["users"] += 1
+                result["archived"] += archived
+    _chat_retention_state["last_run_at"] = datetime.now().isoformat()
+    _chat_retention_state["last_run"] = result
+    _chat_retention_state["archived_total"] += result["archived"]
+    return result
+
+def _chat_retention_worker():
+    logger.info(f"🧵 聊天封存背景工作已啟動 (閒置超過 {CHAT_RETENTION_DAYS} 天封存, 每 {CHAT_RETENTION_INTERVAL_SECONDS}s 檢查一次)")
+    while not _chat_retention_stop_event.is_set():
+        if _hold_leader_lock("chat_retention"):
+            try:
+                _run_chat_retention(CHAT_RETENTION_DAYS)
+            except Exception as e:
+                logger.error(f"❌ 聊天封存失敗: {e}", exc_info=True)
+                _chat_retention_state["errors"] += 1
+                _chat_retention_state["last_error"] = str(e)
+        _chat_retention_stop_event.wait(CHAT_RETENTION_INTERVAL_SECONDS)
+    logger.info("🧵 聊天封存背景工作已停止")
+
+@app.on_event("startup")
+def start_chat_retention_worker():
+    if CHAT_RETENTION_DAYS <= 0:
+        logger.info("聊天自動封存已停用 (CHAT_RETENTION_DAYS=0)")
+        return
+    threading.Thread(target=_chat_retention_worker, name="chat-retention", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_chat_retention_worker():
+    _chat_retention_stop_event.set()
+
+@admin_router.post("/chats/retention/run", summary="Archive idle chat sessions now")
+async def run_chat_retention(
+    max_idle_days: Optional[float] = Query(None, ge=0, description="閒置超過此天數的聊天會被封存；未指定時使用 CHAT_RETENTION_DAYS"),
+    admin: str = Depends(get_admin_user),
+):
+    if max_idle_days is None:
+        if CHAT_RETENTION_DAYS <= 0: raise HTTPException(status_code=400, detail="CHAT_RETENTION_DAYS 未設定，請指定 max_idle_days")
+        max_idle_days = CHAT_RETENTION_DAYS
+    return await asyncio.to_thread(_run_chat_retention, max_idle_days)
+
+@admin_router.get("/chats/storage", summary="Hot / archived chat storage per user")
+async def get_chat_storage(admin: str = Depends(get_admin_user)):
+    def collect():
+        users, totals = {}, {"hot_chats": 0, "hot_bytes": 0, "archived_chats": 0, "archived_bytes": 0}
+        if USER_DATA_BASE_DIR.is_dir():
+            for user_dir in sorted(p for p in USER_DATA_BASE_DIR.iterdir() if p.is_dir()):
+                hot_files = [user_dir / "chats_metadata.json"] + list((user_dir / "chat_messages").glob("*.json"))
+                cold = ChatArchive(user_dir).sizes()
+                usage = {"hot_chats": len(_load_user_chats_metadata(user_dir.name)),
+                         "hot_bytes": sum(f.stat().st_size for f in hot_files if f.exists()),
+                         "archived_chats": cold["chats"], "archived_bytes": cold["bytes"]}
+                users[user_dir.name] = usage
+                for key in totals: totals[key] += usage[key]
+        return {"retention_days": CHAT_RETENTION_DAYS, "totals": totals, "users": users,
+                "last_run_at": _chat_retention_state["last_run_at"], "last_run": _chat_retention_state["last_run"],
+                "archived_total": _chat_retention_state["archived_total"],
+                "errors": _chat_retention_state["errors"], "last_error": _chat_retention_state["last_error"]}
+    return await asyncio.to_thread(collect)
+
+# --- 檢索預取 (Retrieval Prefetch) ---
+# 前端在使用者輸入時 (debounce) 呼叫 /chat/prefetch，預先完成查詢嵌入與 MMR 檢索；
+# 送出的問題與預取時相同 (正規化空白後) 且快照未切換時，/chat 直接沿用結果，檢索不再位於關鍵路徑上。
+RETRIEVER_K = 10   # 10
+RETRIEVER_FETCH_K = 30  # 40
+RETRIEVER_LAMBDA_MULT = 0.4   #0.6
+# 依 metadata 分區檢索 (見 partitioned_retrieval.py)：RETRIEVAL_PARTITIONS 為空時維持單一 MMR；
+# "default" 使用內建的 qa / feedback / longform 分區 (需以 ingest_corpus.py 建置，片段才有 doc_type)，沒有 doc_type 的片段由 other 分區承接；
+# 或以 JSON 字串 / 檔案自訂 (自訂時需自行涵蓋所有片段)
+RETRIEVAL_PARTITIONS = load_partitions(os.environ.get("RETRIEVAL_PARTITIONS", ""))
+RETRIEVAL_MAX_DOCS = int(os.environ.get("RETRIEVAL_MAX_DOCS", str(RETRIEVER_K)))
+_partition_search_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_PARTITION_WORKERS", "8")), thread_name_prefix="retrieval-partition") if RETRIEVAL_PARTITIONS else None
+# 預取結果存在各 worker 的記憶體中，多 worker 時 /chat 通常落在另一個 worker 而無法命中，因此預設只在單一 worker 時啟用
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "false" if MULTI_WORKER_MODE else "true").lower() == "true"
+PREFETCH_RATE_LIMIT_PER_MINUTE = int(os.environ.get("PREFETCH_RATE_LIMIT_PER_MINUTE", "120"))
+PREFETCH_CACHE_TTL_SECONDS = float(os.environ.get("PREFETCH_CACHE_TTL_SECONDS", "60"))
+PREFETCH_CACHE_MAX_ENTRIES = int(os.environ.get("PREFETCH_CACHE_MAX_ENTRIES", "1000"))
+PREFETCH_MIN_QUESTION_CHARS = int(os.environ.get("PREFETCH_MIN_QUESTION_CHARS", "4"))
+_prefetch_cache: "OrderedDict[tuple, Dict]" = OrderedDict()  # (username, session_id) -> 最近一次預取結果
+_prefetch_cache_lock = threading.Lock()
+# /chat 的檢索耗時 (命中 / 只沿用查詢向量 / 未命中) 與命中時省下的預取檢索時間，供 /api/admin/prefetch 比較
+_prefetch_stats: Dict[str, deque] = {"hit": deque(maxlen=500), "embedding_reused": deque(maxlen=500), "miss": deque(maxlen=500), "saved": deque(maxlen=500)}
+
+def _normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question).strip()
+
+def _mmr_search(db, question: str, query_embedding: Optional[List[float]] = None, where: Optional[Dict] = None,
+                k: int = RETRIEVER_K, fetch_k: int = RETRIEVER_FETCH_K):
+    """與原本 as_retriever(search_type="mmr") 相同的檢索，回傳 (片段, 查詢向量, 各片段與查詢的 cosine 相似度)。
+    自行取候選再做 MMR (與 Chroma.max_marginal_relevance_search_by_vector 相同)，相似度直接由候選向量算出，不需額外查詢"""
+    if query_embedding is None:
+        with span("retrieval.embed_query"):
+            query_embedding = db.embeddings.embed_query(question)
+    with span("retrieval.mmr", **{"retrieval.fetch_k": fetch_k, "retrieval.lambda_mult": RETRIEVER_LAMBDA_MULT, "retrieval.where": json.dumps(where, ensure_ascii=False) if where else None}):
+        if isinstance(db, ShardedVectorStore):
+            # 各分片平行取 top fetch_k，合併成全域 top fetch_k 後再做 MMR
+            with span("retrieval.shards", **{"retrieval.shards": db.num_shards}):
+                results = db.query_candidates(query_embedding, fetch_k, where)
+        else:
+            results = db._collection.query(query_embeddings=[query_embedding], n_results=fetch_k, where=where,
+                                           include=["metadatas", "documents", "embeddings"])
+        candidate_embeddings = results["embeddings"][0] if results["embeddings"] else []
+        if len(candidate_embeddings) == 0: return [], query_embedding, []
+        selected = set(maximal_marginal_relevance(np.array(query_embedding, dtype=np.float32), candidate_embeddings,
+                                                  k=k, lambda_mult=RETRIEVER_LAMBDA_MULT))
+        similarities = cosine_similarity([query_embedding], candidate_embeddings)[0]
+        docs, scores = [], []
+        # 與 Chroma 的實作相同，依候選 (相似度) 順序回傳
+        for i, (doc_id, content, metadata) in enumerate(zip(results["ids"][0], results["documents"][0], results["metadatas"][0])):
+            if i not in selected: continue
+            docs.append(Document(page_content=content, metadata=metadata or {}, id=doc_id))
+            scores.append(float(similarities[i]))
+    return docs, query_embedding, scores
+
+def _search_documents(db, question: str, query_embedding: Optional[List[float]] = None, metadata_filter: Optional[Dict] = None):
+    """檢索入口 (/chat、公開 API、預取共用)：未設定分區時為單一 MMR，否則各分區平行 MMR 後依名額合併。
+    回傳值與 _mmr_search 相同；分區檢索的片段 metadata 另帶 retrieval_partition"""
+    if not RETRIEVAL_PARTITIONS:
+        return _mmr_search(db, question, query_embedding, where=metadata_filter)
+    if query_embedding is None:
+        with span("retrieval.embed_query"):
+            query_embedding = db.embeddings.embed_query(question)
+
+    def search_partition(partition: Dict):
+        with span("retrieval.partition", **{"retrieval.partition": partition["name"], "retrieval.k": partition["k"]}):
+            docs, _, scores = _mmr_search(db, question, query_embedding, where=combine_where(partition["where"], metadata_filter),
+                                          k=partition["k"], fetch_k=partition["fetch_k"])
+        return list(zip(docs, scores))
+
+    # 每個分區在各自的執行緒查詢 (Chroma 查詢期間釋放 GIL)；複製 contextvars 讓分區 span 掛在目前的 trace 下
+    futures = {partition["name"]: _partition_search_executor.submit(contextvars.copy_context().run, search_partition, partition)
+               for partition in RETRIEVAL_PARTITIONS}
+    results = {name: future.result() for name, future in futures.items()}
+    merged = merge_partition_results(results, RETRIEVAL_PARTITIONS, RETRIEVAL_MAX_DOCS)
+    for doc, _, partition_name in merged: doc.metadata["retrieval_partition"] = partition_name
+    for name, candidates in results.items():
+        used = sum(1 for _, _, partition_name in merged if partition_name == name)
+        _inc_metric("retrieval_partition_candidates_total", len(candidates), labels={"partition": name})
+        _inc_metric("retrieval_partition_docs_total", used, labels={"partition": name})
+    return [doc for doc, _, _ in merged], query_embedding, [score for _, score, _ in merged]
+
+def _store_prefetched_retrieval(username: str, session_id: str, question: str, snapshot_id: str,
+                                query_embedding: List[float], docs: List, scores: List[float], retrieval_seconds: float):
+    with _prefetch_cache_lock:
+        _prefetch_cache[(username, session_id)] = {
+            "question_key": _normalize_question(question), "snapshot_id": snapshot_id,
+            "query_embedding": query_embedding, "docs": docs, "scores": scores,
+            "retrieval_seconds": retrieval_seconds, "expires_at": time.time() + PREFETCH_CACHE_TTL_SECONDS,
+        }
+        _prefetch_cache.move_to_end((username, session_id))
+        while len(_prefetch_cache) > PREFETCH_CACHE_MAX_ENTRIES:
+            _prefetch_cache.popitem(last=False)
+
+def _peek_prefetched_retrieval(username: str, session_id: str, question: str) -> Optional[Dict]:
+    with _prefetch_cache_lock:
+        entry = _prefetch_cache.get((username, session_id))
+        if entry and entry["question_key"] == _normalize_question(question) and entry["expires_at"] > time.time():
+            return entry
+    return None
+
+def _take_prefetched_retrieval(username: str, session_id: str, question: str) -> Optional[Dict]:
+    """取出並移除相符的預取結果 (每次預取只供一次 /chat 使用)"""
+    with _prefetch_cache_lock:
+        entry = _prefetch_cache.pop((username, session_id), None)
+    if entry and entry["question_key"] == _normalize_question(question) and entry["expires_at"] > time.time():
+        return entry
     return None
 
 class PublicRAGDocumentSource(BaseModel):
-    content: str
-    metadata: Dict
+    id: Optional[str] = None
+    content: Optional[str] = None
+    metadata: Optional[Dict] = None
+
+SOURCE_SNIPPET_CHARS = int(os.environ.get("SOURCE_SNIPPET_CHARS", "240"))
+SOURCE_CACHE_MAX_ENTRIES = int(os.environ.get("SOURCE_CACHE_MAX_ENTRIES", "5000"))
+# 回饋片段 (source=user_feedback) 的 metadata 帶有提問者的身分，不可經由公開 API 回傳
+PUBLIC_SOURCE_HIDDEN_METADATA = ("user_identifier", "session_id")
+# 最近回傳給各用戶的來源片段 (LRU，以 (用戶, source id) 為鍵)；快照被替換或片段被刪除後，仍能解析剛發出去的 source id
+_source_cache: "OrderedDict[tuple, Dict]" = OrderedDict()
+_source_cache_lock = threading.Lock()
+
+def _remember_sources(username: str, sources: List[Dict]):
+    with _source_cache_lock:
+        for source in sources:
+            if not source.get("id"): continue
+            _source_cache[(username, source["id"])] = source
+            _source_cache.move_to_end((username, source["id"]))
+        while len(_source_cache) > SOURCE_CACHE_MAX_ENTRIES:
+            _source_cache.popitem(last=False)
+
+def _public_source(source: Dict) -> Dict:
+    metadata = {k: v for k, v in (source.get("metadata") or {}).items() if k not in PUBLIC_SOURCE_HIDDEN_METADATA}
+    return {**source, "metadata": metadata}
+
+def _best_matching_snippet(content: str, question: str, max_chars: int = SOURCE_SNIPPET_CHARS) -> str:
+    """擷取與問題字元 bigram 重疊最多的視窗，前後以「…」標示截斷"""
+    if len(content) <= max_chars: return content
+    question_bigrams = {question[i:i + 2] for i in range(len(question) - 1) if not question[i:i + 2].isspace()}
+    hits = [1 if content[i:i + 2] in question_bigrams else 0 for i in range(len(content) - 1)]
+    window = max_chars - 1
+    score = sum(hits[:window])
+    best_start, best_score = 0, score
+    for start in range(1, len(hits) - window + 1):
+        score += hits[start + window - 1] - hits[start - 1]
+        if score > best_score: best_start, best_score = start, score
+    if best_score:
+        # 將視窗置中於命中範圍，避免相符片段貼在視窗邊緣
+        hit_positions = [i for i in range(best_start, best_start + window) if hits[i]]
+        center = (hit_positions[0] + hit_positions[-1] + 2) // 2
+        best_start = min(max(center - max_chars // 2, 0), len(content) - max_chars)
+    snippet = content[best_start:best_start + max_chars]
+    return ("…" if best_start > 0 else "") + snippet + ("…" if best_start + max_chars < len(content) else "")
+
+def _shape_sources(sources: List[Dict], mode: str, question: str) -> List[Dict]:
+    if mode == "ids":
+        return [{"id": source.get("id")} for source in sources]
+    sources = [_public_source(source) for source in sources]
+    if mode == "snippet":
+        return [{**source, "content": _best_matching_snippet(source["content"], question)} for source in sources]
+    return sources
+
+# --- 請求期限與取消 (Request Deadlines & Cancellation) ---
+# 每個請求有一個截止時間 (X-Request-Timeout 標頭或 REQUEST_DEADLINE_SECONDS)，貫穿檢索與生成；
+# 用戶端斷線或超過期限時取消進行中的 Ollama 串流 (關閉連線後 Ollama 會停止生成)，且不寫入聊天記錄。
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "600"))
+REQUEST_DEADLINE_MAX_SECONDS = float(os.environ.get("REQUEST_DEADLINE_MAX_SECONDS", "900"))
+DISCONNECT_POLL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", "0.5"))
+CLIENT_CLOSED_REQUEST_STATUS = 499  # nginx 慣例：用戶端已關閉連線
+
+class RequestCancelledError(Exception):
+    def __init__(self, reason: str, stage: str, output_tokens: int = 0):
+        super().__init__(f"request cancelled ({reason}) during {stage}")
+        self.reason, self.stage, self.output_tokens = reason, stage, output_tokens
+
+class _TokenCounter(BaseCallbackHandler):
+    """計算已串流的 token 數，取消時用於估計浪費掉的生成量"""
+    run_inline = True
+
+    def __init__(self):
+        self.tokens = 0
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.tokens += 1
+
+def _request_deadline(request: Optional[Request]) -> float:
+    timeout = REQUEST_DEADLINE_SECONDS
+    header_value = request.headers.get(REQUEST_TIMEOUT_HEADER) if request is not None else None
+    if header_value:
+        try:
+            timeout = float(header_value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"{REQUEST_TIMEOUT_HEADER} 必須是秒數")
+        if timeout <= 0:
+            raise HTTPException(status_code=400, detail=f"{REQUEST_TIMEOUT_HEADER} 必須大於 0")
+    return time.time() + min(timeout, REQUEST_DEADLINE_MAX_SECONDS)
+
+def _disconnect_watcher(request: Optional[Request]) -> Optional[asyncio.Task]:
+    """在背景等待 http.disconnect；經過 @app.middleware("http") 包裝後 request.is_disconnected() 偵測不到斷線"""
+    if request is None: return None
+    watcher = getattr(request.state, "disconnect_watcher", None)
+    if watcher is None:
+        async def _wait():
+            while (await request.receive())["type"] != "http.disconnect": pass
+        # 回應送出後 receive() 也會回傳 http.disconnect，task 會自行結束
+        watcher = request.state.disconnect_watcher = asyncio.create_task(_wait())
+    return watcher
+
+async def _check_request_alive(request: Optional[Request], deadline: float, stage: str, output_tokens: int = 0):
+    if time.time() >= deadline:
+        raise RequestCancelledError("deadline", stage, output_tokens)
+    watcher = _disconnect_watcher(request)
+    if watcher is not None and watcher.done():
+        raise RequestCancelledError("client_disconnected", stage, output_tokens)
+
+async def _scheduled_generate(llm: OllamaLLM, prompt: str, options: Dict, counter: _TokenCounter, output_format: Optional[Dict] = None):
+    """選擇後端並在該後端的排程器取得名額後生成；後端故障時改送下一個後端。output_format 為 Ollama 結構化輸出的 JSON schema"""
+    model_name, tried = llm.model, []
+    while True:
+        backend = ollama_pool.pick(model_name, exclude=tried)
+        if backend is None:
+            raise NoBackendAvailableError(f"沒有可用的 Ollama 後端提供模型 '{model_name}'")
+        tried.append(backend)
+        try:
+            with ollama_pool.track(backend, model_name):
+                with span("llm.queue", **{"llm.model": model_name, "llm.backend": backend.name}) as queue_span:
+                    swap = await backend.scheduler.acquire(model_name)
+                    queue_span.set_attribute("llm.swap", swap)
+                try:
+                    extra = {"format": output_format} if output_format else {}
+                    result = await _backend_llm(backend.url, model_name).agenerate([prompt], callbacks=[counter], options=options, **extra)
+                finally:
+                    backend.scheduler.release(model_name)
+        except Exception as e:
+            if not ollama_pool.is_retryable(e) or len(tried) >= OLLAMA_BACKEND_MAX_ATTEMPTS: raise
+            next_backend = ollama_pool.pick(model_name, exclude=tried)
+            if next_backend is None: raise
+            logger.warning(f"⚠️ Ollama 後端 {backend.name} 生成 '{model_name}' 失敗 ({type(e).__name__}: {e})，改送 {next_backend.name}")
+            backend.stats["failovers_from"] += 1
+            _inc_metric("ollama_backend_failovers_total", labels={"from": backend.name, "to": next_backend.name})
+            current_span().add_event("backend_failover", **{"from": backend.name, "to": next_backend.name, "error": type(e).__name__})
+            continue
+        current_span().set_attribute("llm.backend", backend.name)
+        generation_info = result.generations[0][0].generation_info or {}
+        backend.scheduler.record_load(model_name, (generation_info.get("load_duration") or 0) / 1e9)
+        return result
+
+async def _generate_cancellable(llm: OllamaLLM, prompt: str, options: Dict, request: Optional[Request], deadline: float,
+                                output_format: Optional[Dict] = None):
+    """以非同步串流生成；客戶端斷線或超過期限時取消串流"""
+    counter = _TokenCounter()
+    task = asyncio.create_task(_scheduled_generate(llm, prompt, options, counter, output_format))
+    watcher = _disconnect_watcher(request)
+    try:
+        while True:
+            await asyncio.wait({task, watcher} - {None}, timeout=max(min(DISCONNECT_POLL_SECONDS, deadline - time.time()), 0),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if task.done():
+                return task.result().generations[0][0]
+            await _check_request_alive(request, deadline, "generation", counter.tokens)
+    except BaseException:
+        # 取消 task 會關閉與 Ollama 的 HTTP 串流
+        task.cancel()
+        raise
+
+def _append_qa_record(username: str, qa_record: Dict):
+    try:
+        user_qa_log_dir = get_user_qa_log_path(username)
+        today_str = datetime.now().strftime("%Y-%m-%d")
+        qa_filename = user_qa_log_dir / f"qa_log_{today_str}.jsonl"
+        with open(qa_filename, "a", encoding="utf-8") as f: f.write(json.dumps(qa_record, ensure_ascii=False) + "\n")
+    except Exception as e: logger.error(f"❌ Failed to save QA record for {username}: {e}", exc_info=True)
+
+def _append_chat_turn(username: str, session_id: str, question: str, answer: str):
+    # 在鎖內重新讀取後再附加，多個 worker 同時處理同一 session 時不會互相覆蓋
+    with _user_chat_lock(username):
+        current_chat_session_messages = _get_user_chat_messages(username, session_id)
+        current_chat_session_messages.append({"role": "user", "content": question})
+        current_chat_session_messages.append({"role": "assistant", "content": answer})
+        _save_user_chat_messages(username, session_id, current_chat_session_messages)
+
+        user_chats_metadata_to_update = _load_user_chats_metadata(username)
+        if session_id in user_chats_metadata_to_update:
+            user_chats_metadata_to_update[session_id]["updated_at"] = datetime.now().isoformat()
+            _save_user_chats_metadata(username, user_chats_metadata_to_update)
+    logger.info(f"用戶 {username} 的聊天 {session_id} 記錄已更新並保存。")
+
+def _raise_cancelled(e: RequestCancelledError, username: str, session_id: str, question: str,
+                     model: Optional[str], start_all_processing: float):
+    elapsed = time.time() - start_all_processing
+    logger.warning(f"🛑 用戶 {username} 的請求在 {e.stage} 階段取消 ({e.reason})，已耗時 {elapsed:.2f}s，已生成 {e.output_tokens} tokens")
+    _inc_metric("rag_requests_cancelled_total", labels={"reason": e.reason, "stage": e.stage})
+    current_span().add_event("cancelled", reason=e.reason, stage=e.stage, output_tokens=e.output_tokens)
+    if e.output_tokens: _inc_metric("llm_cancelled_output_tokens_total", e.output_tokens, labels={"model": str(model)})
+    if SAVE_QA:
+        _append_qa_record(username, {
+            "username_source_type": "api_call" if username.startswith("api_consumer_") else "frontend_user",
+            "user_identifier": username, "session_id": session_id, "timestamp": datetime.now().isoformat(),
+            "model": model, "question": question, "answer": None,
+            "cancelled": True, "cancel_reason": e.reason, "cancel_stage": e.stage,
+            "cancelled_output_tokens": e.output_tokens, "total_processing_time_seconds": round(elapsed, 2),
+            "trace_id": current_trace_id(),
+        })
+    if e.reason == "deadline":
+        raise HTTPException(status_code=504, detail=f"請求超過期限 ({e.stage} 階段已取消)")
+    raise HTTPException(status_code=CLIENT_CLOSED_REQUEST_STATUS, detail="用戶端已中斷連線")
+
+# --- 常見問題預先計算 (Precomputed Answers) ---
+# 離峰時段 (PRECOMPUTE_WINDOW，本地時間) 由背景工作從 QA 記錄找出各 (模型, prompt_mode) 最常見的問題 (見 answer_store.py)，
+# 以目前的向量資料庫快照與提示模板重新生成並存入 ANSWER_STORE_DB_PATH；process_rag_request 在檢索前先查詢。
+# 回答以語料鍵 (快照 ID + 回饋匯入的版本號，見 _answer_corpus_key) 與模板版本 (模板文字的雜湊) 區分，
+# 快照熱切換、回饋匯入原地修改快照或修改模板後自動失效。
+# 生成依序進行：本 worker 有其他生成進行中時等待，累計 LLM 時間超過 PRECOMPUTE_GPU_BUDGET_SECONDS 即停止。
+ANSWER_STORE_ENABLED = os.environ.get("ANSWER_STORE_ENABLED", "false").lower() == "true"
+ANSWER_STORE_DB_PATH = Path(os.environ.get("ANSWER_STORE_DB_PATH", "precomputed_answers.sqlite3"))
+PRECOMPUTE_WINDOW = os.environ.get("PRECOMPUTE_WINDOW", "02:00-05:00")
+PRECOMPUTE_TOP_N = int(os.environ.get("PRECOMPUTE_TOP_N", "50"))  # 每個 (模型, prompt_mode)
+PRECOMPUTE_MIN_COUNT = int(os.environ.get("PRECOMPUTE_MIN_COUNT", "3"))
+PRECOMPUTE_LOOKBACK_DAYS = int(os.environ.get("PRECOMPUTE_LOOKBACK_DAYS", "30"))
+PRECOMPUTE_GPU_BUDGET_SECONDS = float(os.environ.get("PRECOMPUTE_GPU_BUDGET_SECONDS", "1800"))
+PRECOMPUTE_USERNAME = "answer_precompute"  # 生成時使用的用戶 (只寫入 QA 記錄)，不列入常見問題統計
+
+answer_store = AnswerStore(ANSWER_STORE_DB_PATH) if ANSWER_STORE_ENABLED else None
+_answer_precompute_task: Optional[asyncio.Task] = None
+_answer_precompute_state = {"running": False, "last_run_date": None, "last_run": None, "generated_total": 0}
+
+def _answer_template_version(prompt_mode: str, format_mode: str) -> str:
+    """此 (prompt_mode, format_mode) 可能使用的所有模板 (含目前選用的 variant 與精簡輸出設定) 的雜湊"""
+    if prompt_mode == "research": templates = [RESEARCH_PROMPT_TEMPLATE]
+    elif format_mode == "custom": templates = [CUSTOM_FORMAT_BASE_PROMPT]
+    else: templates = DEFAULT_PROMPT_OPTIONS
+    parts = [format_mode]
+    for template in templates:
+        template_key = _template_key(template)
+        variant, variant_template, _ = _prompt_template_variant(template_key, template)
+        parts.append(f"{template_key}:{variant}:{variant_template.template}")
+        if template_key in compact_styles() and COMPACT_OUTPUT_RATIO > 0: parts.append(f"compact:{COMPACT_OUTPUT_RATIO}:{COMPACT_STRUCTURED_PROMPT.template}")
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def _answer_corpus_key() -> str:
+    # 回饋匯入會原地寫入目前的快照 (快照 ID 不變)，因此存入 answer_store 的 snapshot_id 欄位時附上版本號
+    with _vectordb_swap_lock: snapshot_id, version = vectordb_snapshot_id, vectordb_corpus_version
+    return f"{snapshot_id}@v{version}" if version else str(snapshot_id)
+
+async def _serve_stored_answer(stored: Dict, store_key: tuple, snapshot_id: Optional[str], username: str, session_id: str, stateless: bool, start_all_processing: float) -> Dict:
+    question, model, prompt_mode, _, _ = store_key
+    _inc_metric("answer_store_hits_total", labels={"model": model})
+    current_span().set_attributes(**{"rag.answer_store_hit": True, "rag.model": model})
+    logger.info(f"🗃️ 用戶 {username} 的問題命中預先計算的回答 (模型: {model}, 快照: {snapshot_id})")
+    await asyncio.to_thread(answer_store.record_hit, *store_key)
+    _remember_sources(username, stored["sources"])
+    with span("persistence"):
+        if not stateless: await asyncio.to_thread(_append_chat_turn, username, session_id, question, stored["answer"])
+        if SAVE_QA:
+            _append_qa_record(username, {
+                "username_source_type": "api_call" if username.startswith("api_consumer_") else "frontend_user",
+                "user_identifier": username, "session_id": session_id, "stateless": stateless, "timestamp": datetime.now().isoformat(),
+                "model": model, "model_requested": model, "prompt_mode_requested": prompt_mode,
+                "format_mode_detected": stored["format_mode"], "question": question, "answer": stored["answer"],
+                "template_used": stored["template_style"], "done_reason": stored["done_reason"],
+                "answer_store_hit": True, "answer_generated_at": datetime.fromtimestamp(stored["generated_at"]).isoformat(),
+                "retrieved_docs_count": len(stored["sources"]), "vectordb_snapshot": snapshot_id,
+                "total_processing_time_seconds": round(time.time() - start_all_processing, 2),
+                "trace_id": current_trace_id(),
+            })
+    _inc_metric("rag_requests_total", labels={"vectordb_snapshot": str(snapshot_id)})
+    return {
+        "answer": stored["answer"], "model_used": model,
+        "model_requested": model, "model_fallback_reason": None, "model_routing_rule": None,
+        "prompt_mode_used": prompt_mode, "format_mode_used": stored["format_mode"],
+        "template_style_used": stored["template_style"], "sources": stored["sources"],
+        "session_id": session_id, "vectordb_snapshot": snapshot_id, "done_reason": stored["done_reason"],
+        "llm_processing_time_seconds": 0.0, "retrieval_time_seconds": 0.0,
+    }
+
+def _in_precompute_window(now: Optional[datetime] = None) -> bool:
+    start, end = [datetime.strptime(part.strip(), "%H:%M").time() for part in PRECOMPUTE_WINDOW.split("-")]
+    current = (now or datetime.now()).time()
+    return start <= current < end if start <= end else (current >= start or current < end)  # 可跨午夜，例如 23:00-04:00
+
+async def _run_answer_precompute(trigger: str) -> Dict:
+    _answer_precompute_state["running"] = True
+    start = time.time()
+    snapshot_id = str(get_active_vectordb()[0])
+    corpus_key = _answer_corpus_key()
+    result = {"trigger": trigger, "started_at": datetime.now().isoformat(), "vectordb_snapshot": snapshot_id, "corpus_key": corpus_key,
+              "candidates": 0, "generated": 0, "fresh": 0, "skipped": 0, "errors": 0, "pruned": 0,
+              "llm_seconds": 0.0, "stopped_reason": None}
+    try:
+        since = (datetime.now() - timedelta(days=PRECOMPUTE_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+        candidates = await asyncio.to_thread(mine_frequent_questions, QA_LOG_PATH_BASE, since, [PRECOMPUTE_USERNAME],
+                                             PRECOMPUTE_TOP_N, PRECOMPUTE_MIN_COUNT)
+        result["candidates"] = len(candidates)
+        get_user_qa_log_path(PRECOMPUTE_USERNAME).mkdir(parents=True, exist_ok=True)
+        logger.info(f"🌙 開始預先計算常見問題的回答 ({trigger})：{len(candidates)} 個候選問題，GPU 預算 {PRECOMPUTE_GPU_BUDGET_SECONDS:.0f}s")
+        for candidate in candidates:
+            if result["llm_seconds"] >= PRECOMPUTE_GPU_BUDGET_SECONDS:
+                result["stopped_reason"] = "gpu_budget"
+                break
+            if trigger == "schedule" and not _in_precompute_window():
+                result["stopped_reason"] = "window_closed"
+                break
+            if _answer_corpus_key() != corpus_key:
+                result["stopped_reason"] = "snapshot_changed"
+                break
+            model, prompt_mode, question = candidate["model"], candidate["prompt_mode"], candidate["question"]
+            if model not in SUPPORTED_MODELS or prompt_mode not in ("default", "research"):
+                result["skipped"] += 1
+                continue
+            template_version = _answer_template_version(prompt_mode, detect_format_mode(question))
+            if await asyncio.to_thread(answer_store.get, question, model, prompt_mode, corpus_key, template_version):
+                result["fresh"] += 1
+                continue
+            # 讓路給線上請求：本 worker 有生成進行中時等待
+            while sum(backend.outstanding for backend in ollama_pool.backends) > 0:
+                await asyncio.sleep(1)
+            try:
+                with start_trace("answer_precompute", **{"precompute.model": model, "precompute.prompt_mode": prompt_mode}):
+                    generated = await process_rag_request(
+                        username=PRECOMPUTE_USERNAME, session_id=f"precompute_{candidate['question_key'][:40]}", question=question,
+                        selected_model=model, prompt_mode=prompt_mode, allow_model_fallback=False,
+                        deadline=time.time() + REQUEST_DEADLINE_MAX_SECONDS, stateless=True, use_answer_store=False,
+                    )
+            except HTTPException as e:
+                logger.warning(f"⚠️ 預先計算失敗 ({model}/{prompt_mode}) '{question[:50]}': {e.detail}")
+                result["errors"] += 1
+                continue
+            result["llm_seconds"] += generated["llm_processing_time_seconds"] or 0.0
+            # 被截斷、改用其他模型或期間切換快照 / 匯入回饋的回答不保存
+            if generated["done_reason"] == "length" or generated["model_used"] != model or _answer_corpus_key() != corpus_key:
+                result["skipped"] += 1
+                continue
+            await asyncio.to_thread(answer_store.put, question, model, prompt_mode, corpus_key, template_version, generated["answer"],
+                                    generated["sources"], generated["format_mode_used"], generated["template_style_used"],
+                                    generated["done_reason"], candidate["count"], generated["llm_processing_time_seconds"])
+            result["generated"] += 1
+            _inc_metric("answer_store_precomputed_total", labels={"model": model})
+        keep = {(c["question_key"], c["model"], c["prompt_mode"]) for c in candidates}
+        result["pruned"] = await asyncio.to_thread(answer_store.prune, corpus_key, keep)
+    except Exception as e:
+        logger.error(f"❌ 預先計算常見問題的回答失敗: {e}", exc_info=True)
+        result["stopped_reason"] = f"error: {e}"
+    finally:
+        result["llm_seconds"] = round(result["llm_seconds"], 2)
+        result["duration_seconds"] = round(time.time() - start, 2)
+        _answer_precompute_state.update(running=False, last_run=result)
+        _answer_precompute_state["generated_total"] += result["generated"]
+    logger.info(f"🌙 預先計算完成：新增 {result['generated']}、仍有效 {result['fresh']}、略過 {result['skipped']}、失敗 {result['errors']}、"
+                f"清除 {result['pruned']}，LLM {result['llm_seconds']:.1f}s" + (f" (停止原因: {result['stopped_reason']})" if result["stopped_reason"] else ""))
+    return result
+
+async def _answer_precompute_scheduler():
+    while True:
+        await asyncio.sleep(60)
+        today = datetime.now().strftime("%Y-%m-%d")
+        if _answer_precompute_state["running"] or _answer_precompute_state["last_run_date"] == today or not _in_precompute_window(): continue
+        if not _hold_leader_lock("answer_precompute"): continue
+        _answer_precompute_state["last_run_date"] = today
+        await _run_answer_precompute("schedule")
+
+@app.on_event("startup")
+async def start_answer_precompute_scheduler():
+    global _answer_precompute_task
+    if not ANSWER_STORE_ENABLED:
+        logger.info("常見問題預先計算已停用 (ANSWER_STORE_ENABLED=false)")
+        return
+    _in_precompute_window()  # 格式錯誤時在啟動時就報錯
+    _answer_precompute_task = asyncio.create_task(_answer_precompute_scheduler())
+
+@app.on_event("shutdown")
+async def stop_answer_precompute_scheduler():
+    if _answer_precompute_task is not None: _answer_precompute_task.cancel()
+
+def _require_answer_store():
+    if answer_store is None: raise HTTPException(status_code=400, detail="預先計算回答未啟用 (ANSWER_STORE_ENABLED=false)")
+
+@admin_router.get("/answer-store", summary="Precomputed answer store status")
+async def get_answer_store_status(admin: str = Depends(get_admin_user)):
+    _require_answer_store()
+    return {"enabled": ANSWER_STORE_ENABLED, "window": PRECOMPUTE_WINDOW, "gpu_budget_seconds": PRECOMPUTE_GPU_BUDGET_SECONDS,
+            "top_n": PRECOMPUTE_TOP_N, "min_count": PRECOMPUTE_MIN_COUNT, "lookback_days": PRECOMPUTE_LOOKBACK_DAYS,
+            "vectordb_snapshot": str(get_active_vectordb()[0]), "corpus_key": _answer_corpus_key(), **_answer_precompute_state, **await asyncio.to_thread(answer_store.stats)}
+
+@admin_router.post("/answer-store/precompute", summary="Run the precomputation job now (in the background)")
+async def trigger_answer_precompute(admin: str = Depends(get_admin_user)):
+    _require_answer_store()
+    if _answer_precompute_state["running"]: raise HTTPException(status_code=409, detail="預先計算正在執行中")
+    _answer_precompute_state["running"] = True  # 立即標記，避免重複觸發
+    asyncio.create_task(_run_answer_precompute("manual"))
+    logger.info(f"🌙 管理者 {admin} 手動觸發預先計算")
+    return {"started": True}
+
+@admin_router.delete("/answer-store", summary="Remove all precomputed answers")
+async def clear_answer_store(admin: str = Depends(get_admin_user)):
+    _require_answer_store()
+    removed = await asyncio.to_thread(answer_store.clear)
+    logger.info(f"🗑️ 管理者 {admin} 清除了 {removed} 筆預先計算的回答")
+    return {"removed": removed}
+
+def _load_session_history(username: str, session_id: str, question: str, session_span) -> tuple:
+    """在檔案鎖內讀取 (必要時建立或還原) session，回傳 (history_pairs, history_text)；會阻塞，需在執行緒中呼叫"""
+    with _user_chat_lock(username):
+        user_chats_metadata = _load_user_chats_metadata(username)
+        if session_id not in user_chats_metadata and _restore_archived_chat(username, session_id):
+            user_chats_metadata = _load_user_chats_metadata(username)
+            session_span.set_attribute("session.restored", True)
+        if session_id not in user_chats_metadata:
+            now_iso = datetime.now().isoformat()
+            default_title = question[:30].strip() + "..." if len(question) > 30 else question.strip() or f"對話 {session_id[:8]}"
+            user_chats_metadata[session_id] = {"title": default_title, "created_at": now_iso, "updated_at": now_iso}
+            _save_user_chats_metadata(username, user_chats_metadata)
+            _save_user_chat_messages(username, session_id, [])
+            session_span.set_attribute("session.created", True)
+            logger.info(f"ℹ️ 自動為用戶 {username} session '{session_id}' 創建聊天元數據. 標題: '{default_title}'")
+
+        messages_for_prompt_history = _get_user_chat_messages(username, session_id)
+        history_pairs = []
+        temp_user_q = None
+        for msg_dict in messages_for_prompt_history:
+            if msg_dict["role"] == "user": temp_user_q = msg_dict["content"]
+            elif msg_dict["role"] == "assistant" and temp_user_q:
+                history_pairs.append((temp_user_q, msg_dict["content"]))
+                temp_user_q = None
+        history_text = "\n".join([f"使用者: {q}\n助理: {a}" for q, a in history_pairs[-MAX_HISTORY_PER_SESSION:]]) or "無歷史對話紀錄。"
+        session_span.set_attributes(**{"session.messages": len(messages_for_prompt_history), "session.history_pairs": len(history_pairs)})
+    return history_pairs, history_text
 
 async def process_rag_request(
     username: str, session_id: str, question: str,
-    selected_model: str, prompt_mode: str,
+    selected_model: Optional[str], prompt_mode: str,
+    max_output_tokens: Optional[int] = None, allow_model_fallback: bool = True,
+    request: Optional[Request] = None, deadline: Optional[float] = None, stateless: bool = False,
+    metadata_filter: Optional[Dict] = None, use_answer_store: bool = True,
 ) -> Dict:
     start_all_processing = time.time()
+    deadline = deadline or _request_deadline(request)
     if not question:
         logger.warning(f"⚠️ 用戶 {username} 收到空問題。")
         raise HTTPException(status_code=400, detail="問題不能為空.")
-    llm = get_model(selected_model)
-    if llm is None:
-        logger.error(f"❌ RAG process error: LLM '{selected_model}' not loaded.")
-        raise HTTPException(status_code=500, detail=f"無法載入語言模型 '{selected_model}'. 請檢查伺服器日誌以了解詳情。")
-    if vectordb is None:
+    # selected_model 為 None 時，檢索完成後由複雜度路由器選擇
+    requested_model, llm, fallback_reason, routing_rule = selected_model, None, None, None
+    if requested_model is not None:
+        selected_model, llm, fallback_reason = _select_model(requested_model, allow_model_fallback, username)
+    if get_active_vectordb()[1] is None:
         logger.error(f"❌ RAG process error: Vector database not available.")
         raise HTTPException(status_code=500, detail="向量資料庫不可用.")
 
-    user_chats_metadata = _load_user_chats_metadata(username)
-    if session_id not in user_chats_metadata:
-        now_iso = datetime.now().isoformat()
-        default_title = question[:30].strip() + "..." if len(question) > 30 else question.strip() or f"對話 {session_id[:8]}"
-        user_chats_metadata[session_id] = {"title": default_title, "created_at": now_iso, "updated_at": now_iso}
-        _save_user_chats_metadata(username, user_chats_metadata)
-        _save_user_chat_messages(username, session_id, [])
-        logger.info(f"ℹ️ 自動為用戶 {username} session '{session_id}' 創建聊天元數據. 標題: '{default_title}'")
+    current_span().set_attributes(**{"rag.user": username, "rag.session_id": session_id, "rag.model": selected_model,
+                                     "rag.model_requested": requested_model, "rag.model_fallback_reason": fallback_reason,
+                                     "rag.prompt_mode": prompt_mode, "rag.stateless": stateless})
 
-    format_mode = detect_format_mode(question)
-    logger.info(f"🚀 RAG - User: {username}, Session: {session_id}, Model: {selected_model}, PromptMode(TemplateGroup): {prompt_mode}, FormatMode(LLMInstruction): {format_mode}")
+    if stateless:
+        # 無狀態請求：不讀取對話記錄，也不建立 session 元數據與訊息檔
+        history_pairs, history_text = [], "無歷史對話紀錄。"
+    else:
+        with span("session.load") as session_span:
+            # 檔案鎖最多等待 CHAT_LOCK_TIMEOUT_SECONDS，在執行緒中取得以免阻塞事件迴圈
+            history_pairs, history_text = await asyncio.to_thread(_load_session_history, username, session_id, question, session_span)
+
+    with span("format_detection") as format_span:
+        format_mode = detect_format_mode(question)
+        format_span.set_attribute("rag.format_mode", format_mode)
+    logger.info(f"🚀 RAG - User: {username}, Session: {session_id}, Model: {selected_model or AUTO_MODEL}, PromptMode(TemplateGroup): {prompt_mode}, FormatMode(LLMInstruction): {format_mode}, Trace: {current_trace_id()}")
     logger.info(f"❓ Question for {username}: {question[:200]}...") # Log truncated question
 
-    messages_for_prompt_history = _get_user_chat_messages(username, session_id)
-    history_pairs = []
-    temp_user_q = None
-    for msg_dict in messages_for_prompt_history:
-        if msg_dict["role"] == "user": temp_user_q = msg_dict["content"]
-        elif msg_dict["role"] == "assistant" and temp_user_q:
-            history_pairs.append((temp_user_q, msg_dict["content"]))
-            temp_user_q = None
-    history_text = "\n".join([f"使用者: {q}\n助理: {a}" for q, a in history_pairs[-MAX_HISTORY_PER_SESSION:]]) or "無歷史對話紀錄。"
+    # 常見問題的預先計算回答：只用於沒有對話記錄、沒有 metadata 條件與輸出上限、且指定了模型的請求
+    if use_answer_store and ANSWER_STORE_ENABLED and requested_model is not None and not history_pairs and not metadata_filter and not max_output_tokens:
+        store_snapshot_id = get_active_vectordb()[0]
+        store_key = (question, requested_model, prompt_mode, _answer_corpus_key(), _answer_template_version(prompt_mode, format_mode))
+        with span("answer_store.lookup") as lookup_span:
+            stored = await asyncio.to_thread(answer_store.get, *store_key)
+            lookup_span.set_attribute("answer_store.hit", stored is not None)
+        if stored is not None:
+            return await _serve_stored_answer(stored, store_key, store_snapshot_id, username, session_id, stateless, start_all_processing)
+        _inc_metric("answer_store_misses_total")
 
     start_retrieve = time.time()
 
@@ -1131,60 +2687,142 @@ async def process_rag_request(
     #retriever = vectordb.as_retriever(search_type="similarity_score_threshold", search_kwargs={"k": retriever_k, "score_threshold": 0.5})
 
     # # MMR 策略 (當前生效) # 試試看調整 5, 30, 0.4
-    retriever_k = 10   # 10
-    retriever_fetch_k = 30  # 40
-    retriever_lambda_mult = 0.4   #0.6
-    retriever = vectordb.as_retriever(
-        search_type="mmr",
-        search_kwargs={
-            "k": retriever_k, 
-            "fetch_k": retriever_fetch_k, 
-            "lambda_mult": retriever_lambda_mult
-        }
-    )
-
+    # 參數見模組層級的 RETRIEVER_K / RETRIEVER_FETCH_K / RETRIEVER_LAMBDA_MULT (/chat/prefetch 共用)
     retrieved_docs_list: List[Dict] = []
     context_str = "沒有找到相關的背景資料。"
 
+    prefetch_saved: Dict[str, float] = {}  # 命中預取時，預取當下花費 (即 /chat 省下) 的檢索秒數
+
+    def _retrieve():
+        # 整個檢索過程固定使用同一個快照，即使期間發生熱切換也不受影響
+        with _pinned_vectordb() as (pinned_snapshot_id, db), _retrieval_in_flight():
+            prefetched = _take_prefetched_retrieval(username, session_id, question)
+            # 預取時沒有 metadata 條件，有條件的請求只沿用查詢向量
+            if prefetched and prefetched["snapshot_id"] == pinned_snapshot_id and not metadata_filter:
+                _inc_metric("prefetch_hits_total")
+                _inc_metric("prefetch_saved_seconds_total", prefetched["retrieval_seconds"])
+                prefetch_saved["seconds"] = prefetched["retrieval_seconds"]
+                return pinned_snapshot_id, prefetched["docs"], prefetched["scores"], "hit"
+            # 快照已切換時仍可沿用預取的查詢向量，只重做 MMR
+            docs, _, scores = _search_documents(db, question, prefetched["query_embedding"] if prefetched else None, metadata_filter)
+            _inc_metric("prefetch_misses_total")
+            if prefetched: _inc_metric("prefetch_embedding_reuses_total")
+            return pinned_snapshot_id, docs, scores, "embedding_reused" if prefetched else "miss"
+
     docs_langchain = []
+    retrieval_scores: List[float] = []
+    prefetch_hit = False
     try:
-        docs_langchain = retriever.invoke(question)
-        if docs_langchain:
-            context_str = "\n\n".join([doc.page_content for doc in docs_langchain])
-            retrieved_docs_list = [{"content": doc.page_content, "metadata": doc.metadata} for doc in docs_langchain]
-        logger.info(f"⏱️ Retrieval: {time.time() - start_retrieve:.2f}s, Found {len(docs_langchain)} docs using MMR for {username}.")
+        await _check_request_alive(request, deadline, "retrieval")
+        with span("retrieval", **{"retrieval.k": RETRIEVER_K, "retrieval.fetch_k": RETRIEVER_FETCH_K}) as retrieval_span:
+            # 在執行緒中檢索，事件迴圈可繼續服務其他請求；超過期限時不再等待結果
+            snapshot_id, docs_langchain, retrieval_scores, prefetch_status = await asyncio.wait_for(asyncio.to_thread(_retrieve), timeout=max(deadline - time.time(), 0.001))
+            prefetch_hit = prefetch_status == "hit"
+            if docs_langchain:
+                context_str = "\n\n".join([doc.page_content for doc in docs_langchain])
+                retrieved_docs_list = [_public_source({"id": getattr(doc, "id", None), "content": doc.page_content, "metadata": doc.metadata}) for doc in docs_langchain]
+                _remember_sources(username, retrieved_docs_list)
+            retrieval_span.set_attributes(**{"retrieval.retrieved_count": len(docs_langchain), "retrieval.prefetch_hit": prefetch_hit,
+                                             "retrieval.context_chars": len(context_str), "vectordb.snapshot": str(snapshot_id)})
+        retrieval_seconds = time.time() - start_retrieve
+        if PREFETCH_ENABLED:
+            with _prefetch_cache_lock:
+                _prefetch_stats[prefetch_status].append(retrieval_seconds)
+                if prefetch_hit: _prefetch_stats["saved"].append(prefetch_saved["seconds"])
+        logger.info(f"⏱️ Retrieval: {retrieval_seconds:.2f}s, Found {len(docs_langchain)} docs using MMR for {username}{' (prefetched)' if prefetch_hit else ''}.")
+    except RequestCancelledError as e:
+        _raise_cancelled(e, username, session_id, question, selected_model, start_all_processing)
+    except asyncio.TimeoutError:
+        _raise_cancelled(RequestCancelledError("deadline", "retrieval"), username, session_id, question, selected_model, start_all_processing)
     except Exception as e:
         logger.error(f"❌ Retrieval error for {username}, q='{question[:100]}...': {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"向量資料庫檢索錯誤: {str(e)}")
 
-    selected_template: Optional[PromptTemplate] = None
-    template_name_for_log = "N/A"
-
-    if prompt_mode == "research":
-        selected_template = RESEARCH_PROMPT_TEMPLATE
-        template_name_for_log = f"Research (Format: {format_mode})"
-    elif format_mode == "custom":
-        selected_template = CUSTOM_FORMAT_BASE_PROMPT
-        template_name_for_log = "Custom Format Request"
-    else:
-        selected_template = random.choice(DEFAULT_PROMPT_OPTIONS)
-        if selected_template == STRUCTURED_LIST_PROMPT: template_name_for_log = "Default Style (Random: Structured List)"
-        elif selected_template == HIERARCHICAL_BULLETS_PROMPT: template_name_for_log = "Default Style (Random: Hierarchical Bullets)"
-        elif selected_template == PARAGRAPH_EMOJI_LEAD_PROMPT: template_name_for_log = "Default Style (Random: Paragraph Emoji Lead)"
-        else: template_name_for_log = "Default Style (Random: Unknown)"
+    routing_signals = question_signals(question, format_mode, prompt_mode, min(len(history_pairs), MAX_HISTORY_PER_SESSION), retrieval_scores)
+    if requested_model is None:
+        with span("model.route") as route_span:
+            routing_tier, requested_model, routing_rule = model_router.route(routing_signals)
+            route_span.set_attributes(**{"router.tier": routing_tier, "router.rule": routing_rule, "llm.model_requested": requested_model})
+        _inc_metric("model_router_decisions_total", labels={"tier": routing_tier, "rule": str(routing_rule)})
+        logger.info(f"🧭 模型路由 ({username}): {routing_tier} -> '{requested_model}' (規則: {routing_rule}, 訊號: {routing_signals})")
+        selected_model, llm, fallback_reason = _select_model(requested_model, allow_model_fallback, username)
+
+    with span("prompt.build") as prompt_span:
+        selected_template: Optional[PromptTemplate] = None
+        template_name_for_log = "N/A"
+
+        if prompt_mode == "research":
+            selected_template = RESEARCH_PROMPT_TEMPLATE
+            template_name_for_log = f"Research (Format: {format_mode})"
+        elif format_mode == "custom":
+            selected_template = CUSTOM_FORMAT_BASE_PROMPT
+            template_name_for_log = "Custom Format Request"
+        else:
+            selected_template = random.choice(DEFAULT_PROMPT_OPTIONS)
+            if selected_template == STRUCTURED_LIST_PROMPT: template_name_for_log = "Default Style (Random: Structured List)"
+            elif selected_template == HIERARCHICAL_BULLETS_PROMPT: template_name_for_log = "Default Style (Random: Hierarchical Bullets)"
+            elif selected_template == PARAGRAPH_EMOJI_LEAD_PROMPT: template_name_for_log = "Default Style (Random: Paragraph Emoji Lead)"
+            else: template_name_for_log = "Default Style (Random: Unknown)"
     
-    if selected_template is None:
-        logger.error(f"❌ Critical error: No template selected for prompt_mode '{prompt_mode}' and format_mode '{format_mode}'")
-        raise HTTPException(status_code=500, detail="內部錯誤：無法選擇提示模板。")
+        if selected_template is None:
+            logger.error(f"❌ Critical error: No template selected for prompt_mode '{prompt_mode}' and format_mode '{format_mode}'")
+            raise HTTPException(status_code=500, detail="內部錯誤：無法選擇提示模板。")
         
-    logger.info(f"Using template for {username}: {template_name_for_log} (PromptMode: {prompt_mode}, Detected FormatMode: {format_mode})")
+        logger.info(f"Using template for {username}: {template_name_for_log} (PromptMode: {prompt_mode}, Detected FormatMode: {format_mode})")
 
-    try:
-        prompt_input = {"context": context_str, "question": question, "history": history_text, "format_mode": format_mode}
-        prompt = selected_template.format(**prompt_input)
-    except Exception as e:
-        logger.error(f"❌ Prompt formatting error for {username}: {e} with input keys {list(prompt_input.keys())}", exc_info=True)
-        raise HTTPException(status_code=500, detail="內部錯誤：提示詞格式化失敗.")
+        template_key = _template_key(selected_template)
+        prompt_variant, selected_template, stop_sequences = _prompt_template_variant(template_key, selected_template)
+        try:
+            prompt_input = {"context": context_str, "question": question, "history": history_text, "format_mode": format_mode}
+            prompt = selected_template.format(**prompt_input)
+        except Exception as e:
+            logger.error(f"❌ Prompt formatting error for {username}: {e} with input keys {list(prompt_input.keys())}", exc_info=True)
+            raise HTTPException(status_code=500, detail="內部錯誤：提示詞格式化失敗.")
+
+        num_predict = min(max_output_tokens, MAX_OUTPUT_TOKENS_LIMIT) if max_output_tokens else TEMPLATE_NUM_PREDICT.get(template_key, -1)
+        # 傳入 options 會取代 OllamaLLM 的預設選項，因此需帶上 common_llm_config
+        generation_options = {**common_llm_config, "num_predict": num_predict, "stop": stop_sequences}
+        # (模板, variant, 各區段估計 token 數)，生成後與 Ollama 回報的預填 token 數一起記錄
+        prompt_accounting = (template_key, prompt_variant, prompt_token_breakdown(selected_template.template, prompt_input))
+        # 精簡模式：模型輸出 JSON，由伺服器依 template_key 的風格排版；解析失敗時改用上面的自由文字提示詞
+        output_mode, output_format = "free", None
+        free_text_generation = (prompt, generation_options, num_predict, prompt_accounting)
+        if template_key in compact_styles() and COMPACT_OUTPUT_RATIO > 0 and random.random() < COMPACT_OUTPUT_RATIO:
+            output_mode, output_format = "compact", COMPACT_ANSWER_SCHEMA
+            prompt = COMPACT_STRUCTURED_PROMPT.format(**prompt_input)
+            num_predict = min(max_output_tokens, MAX_OUTPUT_TOKENS_LIMIT) if max_output_tokens else TEMPLATE_NUM_PREDICT["compact_structured"]
+            generation_options = {**common_llm_config, "num_predict": num_predict, "stop": TEMPLATE_STOP_SEQUENCES["compact_structured"]}
+            prompt_accounting = ("compact_structured", "full", prompt_token_breakdown(COMPACT_STRUCTURED_PROMPT.template, prompt_input))
+            template_name_for_log += " [compact]"
+        if prompt_variant == "compact": template_name_for_log += " [compact prompt]"
+        prompt_span.set_attributes(**{"prompt.template": template_name_for_log, "prompt.template_key": template_key,
+                                      "prompt.variant": prompt_variant, "prompt.output_mode": output_mode,
+                                      "prompt.chars": len(prompt), "prompt.context_chars": len(context_str),
+                                      "prompt.history_chars": len(history_text), "llm.num_predict": num_predict,
+                                      **{f"prompt.tokens.{section}": tokens for section, tokens in prompt_accounting[2].items()}})
+    current_span().set_attribute("rag.template", template_key)
+    done_reason = None
+    output_tokens = 0
+    prompt_usage: Dict = {}
+
+    async def _generate_once(prompt_text: str, options: Dict, stats_key: str, output_schema: Optional[Dict]):
+        start_generation = time.time()
+        with span("llm.generate", **{"llm.attempt": llm_actual_attempts, "llm.model": selected_model, "llm.num_predict": options["num_predict"],
+                                     "llm.output_mode": output_mode}) as llm_span:
+            with _track_model_call(selected_model):
+                generation = await _generate_cancellable(llm, prompt_text, options, request, deadline, output_schema)
+            generation_info = generation.generation_info or {}
+            llm_span.set_attributes(**{"llm.done_reason": generation_info.get("done_reason"), "llm.output_tokens": generation_info.get("eval_count"),
+                                       "llm.prompt_tokens": generation_info.get("prompt_eval_count"), "llm.answer_chars": len(generation.text)})
+        # 呼叫端自訂上限時另外統計，避免影響模板預算的截斷率
+        _record_generation(f"{stats_key}:override" if max_output_tokens else stats_key, generation_info.get("done_reason"),
+                           generation_info.get("eval_count"), time.time() - start_generation)
+        _record_prompt_tokens(*prompt_accounting, generation_info)
+        prompt_usage.update(template=prompt_accounting[0], variant=prompt_accounting[1], estimated=prompt_accounting[2],
+                            prompt_eval_count=generation_info.get("prompt_eval_count"),
+                            prefill_seconds=round((generation_info.get("prompt_eval_duration") or 0) / 1e9, 3))
+        logger.info(f"⏱️ LLM raw response (Attempt {llm_actual_attempts}, {output_mode}) for {username}: {time.time() - start_generation:.2f}s. Length: {len(generation.text)}, tokens: {generation_info.get('eval_count')}/{options['num_predict']}, done_reason: {generation_info.get('done_reason')}")
+        return generation.text, generation_info
 
     final_answer = None
     llm_actual_attempts = 0
@@ -1193,13 +2831,29 @@ async def process_rag_request(
     for attempt in range(MAX_LLM_RETRIES + 1):
         llm_actual_attempts = attempt + 1
         try:
-            start_llm_one_attempt = time.time()
-            raw_answer = llm.invoke(prompt)
-            logger.info(f"⏱️ LLM raw response (Attempt {llm_actual_attempts}) for {username}: {time.time() - start_llm_one_attempt:.2f}s. Length: {len(raw_answer)}")
+            compact_answer = None
+            if output_mode == "compact":
+                raw_answer, generation_info = await _generate_once(prompt, generation_options, f"{template_key}:compact", output_format)
+                output_tokens = generation_info.get("eval_count") or 0
+                compact_answer = parse_compact_answer(raw_answer)
+                if compact_answer is None:
+                    logger.warning(f"⚠️ 精簡結構化輸出解析失敗 ({username}, {template_key}, done_reason: {generation_info.get('done_reason')})，改用自由文字模板重新生成")
+                    _record_compact_parse_failure(f"{template_key}:compact")
+                    current_span().add_event("compact_output_fallback", template=template_key, done_reason=str(generation_info.get("done_reason")))
+                    output_mode, output_format = "compact_fallback", None
+                    prompt, generation_options, num_predict, prompt_accounting = free_text_generation
+            if compact_answer is None:
+                stats_key = f"{template_key}:compact_fallback" if output_mode == "compact_fallback" else template_key
+                raw_answer, generation_info = await _generate_once(prompt, generation_options, stats_key, None)
+                output_tokens += generation_info.get("eval_count") or 0
+            done_reason = generation_info.get("done_reason")
             if logger.isEnabledFor(logging.DEBUG):
                  logger.debug(f"LLM raw output (Attempt {llm_actual_attempts}) for {username} before post-processing: '{raw_answer[:500]}...'")
 
-            processed_answer = post_process_answer(raw_answer, format_mode=format_mode)
+            with span("postprocess", **{"rag.format_mode": format_mode, "rag.output_mode": output_mode}) as postprocess_span:
+                if compact_answer is not None: raw_answer = render_compact_answer(compact_answer, template_key)
+                processed_answer = post_process_answer(raw_answer, format_mode=format_mode)
+                postprocess_span.set_attribute("postprocess.answer_chars", len(processed_answer))
             if logger.isEnabledFor(logging.DEBUG):
                  logger.debug(f"LLM output (Attempt {llm_actual_attempts}) for {username} AFTER post-processing: '{processed_answer[:500]}...'")
 
@@ -1207,13 +2861,15 @@ async def process_rag_request(
                 logger.warning(f"LLM returned empty/whitespace answer (Attempt {llm_actual_attempts}) for {username} after processing. Raw: '{raw_answer[:200]}...'")
                 if attempt < MAX_LLM_RETRIES: 
                     logger.info(f"Retrying LLM call for {username} (attempt {attempt + 2})")
-                    time.sleep(1)
+                    await asyncio.sleep(1)
                     continue
                 else:
                     raise ValueError("LLM returned empty or whitespace answer after all retries")
             
             final_answer = processed_answer
             break 
+        except RequestCancelledError as e:
+            _raise_cancelled(e, username, session_id, question, selected_model, start_all_processing)
         except Exception as e:
             # BUG FIX: 處理 Ollama 連線錯誤
             # 你遇到的 `wsarecv: An existing connection was forcibly closed` 錯誤會在這裡被捕捉到。
@@ -1232,9 +2888,20 @@ async def process_rag_request(
             logger.error("  4. **重新下載模型**: 在終端執行 `ollama rm <model_name>`，然後執行 `ollama pull <model_name>` 來重新下載。")
             logger.error("💡--------------------------💡")
             
-            if attempt < MAX_LLM_RETRIES:
+            switched_model = False
+            if attempt < MAX_LLM_RETRIES and allow_model_fallback:
+                # 重試時排除剛失敗的模型，改用降級鏈中的下一個模型
+                next_model, next_llm, _ = _choose_model(requested_model, True, exclude={selected_model})
+                if next_llm is not None and next_model != selected_model:
+                    logger.warning(f"⚠️ 用戶 {username} 的請求在 '{selected_model}' 失敗，重試改用 '{next_model}'")
+                    _inc_metric("llm_model_fallbacks_total", labels={"requested": requested_model, "used": next_model, "reason": "error"})
+                    selected_model, llm, fallback_reason = next_model, next_llm, "error"
+                    current_span().add_event("model_fallback", requested=requested_model, used=next_model, reason="error")
+                    switched_model = True
+            # 多後端時 _scheduled_generate 已改送其他後端重試過，同一模型不再重試
+            if attempt < MAX_LLM_RETRIES and (switched_model or len(ollama_pool.backends) == 1):
                 logger.info(f"Retrying LLM call for {username} (attempt {attempt + 2}) due to error.")
-                time.sleep(random.uniform(1,3))
+                await asyncio.sleep(random.uniform(1,3))
             else:
                 logger.error(f"❌ Failed to get LLM response for {username} after {llm_actual_attempts} attempts due to error: {e}")
                 # 向前端返回一個更友好的錯誤訊息
@@ -1244,65 +2911,69 @@ async def process_rag_request(
         logger.error(f"❌ Failed to get valid LLM response for {username} after {MAX_LLM_RETRIES + 1} attempts.")
         raise HTTPException(status_code=500, detail="LLM 回應或處理失敗.")
 
-    current_chat_session_messages = _get_user_chat_messages(username, session_id)
-    current_chat_session_messages.append({"role": "user", "content": question})
-    current_chat_session_messages.append({"role": "assistant", "content": final_answer})
-    _save_user_chat_messages(username, session_id, current_chat_session_messages)
-
-    user_chats_metadata_to_update = _load_user_chats_metadata(username)
-    if session_id in user_chats_metadata_to_update:
-        user_chats_metadata_to_update[session_id]["updated_at"] = datetime.now().isoformat()
-        _save_user_chats_metadata(username, user_chats_metadata_to_update)
-    logger.info(f"用戶 {username} 的聊天 {session_id} 記錄已更新並保存。")
+    current_span().set_attributes(**{"rag.model": selected_model, "rag.model_fallback_reason": fallback_reason,
+                                     "rag.llm_attempts": llm_actual_attempts, "rag.done_reason": done_reason})
+    with span("persistence"):
+        if not stateless: await asyncio.to_thread(_append_chat_turn, username, session_id, question, final_answer)
 
-    if SAVE_QA:
-        try:
-            user_qa_log_dir = get_user_qa_log_path(username)
-            today_str = datetime.now().strftime("%Y-%m-%d")
-            qa_filename = user_qa_log_dir / f"qa_log_{today_str}.jsonl"
-            qa_record = {
+        if SAVE_QA:
+            _append_qa_record(username, {
                 "username_source_type": "api_call" if username.startswith("api_consumer_") else "frontend_user",
-                "user_identifier": username, "session_id": session_id, "timestamp": datetime.now().isoformat(),
-                "model": selected_model, "prompt_mode_requested": prompt_mode,
+                "user_identifier": username, "session_id": session_id, "stateless": stateless, "timestamp": datetime.now().isoformat(),
+                "model": selected_model, "model_requested": requested_model, "model_fallback_reason": fallback_reason,
+                "model_routing_rule": routing_rule, "routing_signals": routing_signals,
+                "prompt_mode_requested": prompt_mode,
                 "format_mode_detected": format_mode, "question": question, "answer": final_answer,
                 "llm_attempts": llm_actual_attempts, "template_used": template_name_for_log,
-                "retrieved_docs_count": len(docs_langchain),
-                "total_processing_time_seconds": round(time.time() - start_all_processing, 2)
-            }
-            with open(qa_filename, "a", encoding="utf-8") as f: f.write(json.dumps(qa_record, ensure_ascii=False) + "\n")
-        except Exception as e: logger.error(f"❌ Failed to save QA record for {username}: {e}", exc_info=True)
+                "num_predict": num_predict, "done_reason": done_reason,
+                "output_mode": output_mode, "output_tokens": output_tokens,
+                "prompt_variant": prompt_variant, "prompt_tokens": prompt_usage,
+                "retrieved_docs_count": len(docs_langchain), "vectordb_snapshot": snapshot_id, "metadata_filter": metadata_filter,
+                "retrieval_partitions": dict(Counter(doc.metadata.get("retrieval_partition") for doc in docs_langchain if doc.metadata.get("retrieval_partition"))) or None,
+                "prefetch_hit": prefetch_hit, "prefetch_saved_seconds": round(prefetch_saved["seconds"], 3) if prefetch_saved else None,
+                "retrieval_time_seconds": round(retrieval_seconds, 3),
+                "total_processing_time_seconds": round(time.time() - start_all_processing, 2),
+                "trace_id": current_trace_id(),
+            })
     
     llm_total_time = time.time() - start_llm_total_processing
     retrieval_total_time = time.time() - start_retrieve
+    _inc_metric("rag_requests_total", labels={"vectordb_snapshot": str(snapshot_id)})
 
     return {
         "answer": final_answer, "model_used": selected_model,
+        "model_requested": requested_model, "model_fallback_reason": fallback_reason, "model_routing_rule": routing_rule,
         "prompt_mode_used": prompt_mode, "format_mode_used": format_mode,
         "template_style_used": template_name_for_log, "sources": retrieved_docs_list,
-        "session_id": session_id,
+        "session_id": session_id, "vectordb_snapshot": snapshot_id, "done_reason": done_reason,
         "llm_processing_time_seconds": round(llm_total_time, 2),
         "retrieval_time_seconds": round(retrieval_total_time, 2),
     }
 
 @app.post("/chat")
-async def chat(req: ChatRequest, username: str = Depends(get_current_username)):
+async def chat(req: ChatRequest, request: Request, username: str = Depends(get_current_username)):
     start_overall_request = time.time()
     session_id = req.session_id
     question = req.question.strip()
-    selected_model = req.model if req.model and req.model in SUPPORTED_MODELS else DEFAULT_MODEL
+    selected_model = _resolve_requested_model(req.model)
     prompt_mode_from_req = req.prompt_mode if req.prompt_mode in ["default", "research"] else "default"
     try:
         result_dict = await process_rag_request(
             username=username, session_id=session_id, question=question,
-            selected_model=selected_model, prompt_mode=prompt_mode_from_req
+            selected_model=selected_model, prompt_mode=prompt_mode_from_req,
+            allow_model_fallback=req.allow_model_fallback, request=request,
         )
         total_time = time.time() - start_overall_request
         logger.info(f"⏱️ Total /chat request for {username}: {total_time:.2f}s. LLM: {result_dict.get('llm_processing_time_seconds', 'N/A')}s. Retrieval: {result_dict.get('retrieval_time_seconds', 'N/A')}s")
         return {
             "answer": result_dict["answer"], "model_used": result_dict["model_used"],
+            "model_requested": result_dict["model_requested"],
+            "model_fallback_reason": result_dict["model_fallback_reason"],
+            "model_routing_rule": result_dict["model_routing_rule"],
             "prompt_mode_used": result_dict["prompt_mode_used"],
             "format_mode_used": result_dict["format_mode_used"],
-            "template_style_used": result_dict["template_style_used"]
+            "template_style_used": result_dict["template_style_used"],
+            "vectordb_snapshot": result_dict["vectordb_snapshot"]
         }
     except HTTPException as e_http:
         logger.error(f"HTTP Exception during /chat for {username}: {e_http.detail}")
@@ -1311,6 +2982,37 @@ async def chat(req: ChatRequest, username: str = Depends(get_current_username)):
         logger.error(f"❌ Unexpected error in /chat for {username}: {str(e_general)}", exc_info=True)
         raise HTTPException(status_code=500, detail="LLM 回應或處理失敗或內部錯誤")
 
+class ChatPrefetchRequest(BaseModel):
+    session_id: str
+    question: str
+
+@app.post("/chat/prefetch")
+def prefetch_chat_retrieval(req: ChatPrefetchRequest, username: str = Depends(get_current_username)):
+    # 同步端點：由 FastAPI 放到執行緒池執行，嵌入與 MMR 不會阻塞事件迴圈
+    if not PREFETCH_ENABLED:
+        return {"status": "disabled"}
+    question = req.question.strip()
+    if len(_normalize_question(question)) < PREFETCH_MIN_QUESTION_CHARS:
+        _inc_metric("prefetch_requests_total", labels={"status": "skipped"})
+        return {"status": "skipped"}
+    if _peek_prefetched_retrieval(username, req.session_id, question):
+        _inc_metric("prefetch_requests_total", labels={"status": "cached"})
+        return {"status": "cached"}
+    if get_active_vectordb()[1] is None:
+        raise HTTPException(status_code=503, detail="向量資料庫未就緒")
+    start = time.time()
+    try:
+        with _pinned_vectordb() as (snapshot_id, db), _retrieval_in_flight():
+            docs, query_embedding, scores = _search_documents(db, question)
+    except Exception as e:
+        logger.error(f"❌ Prefetch retrieval error for {username}, q='{question[:100]}...': {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="預取檢索失敗")
+    retrieval_seconds = time.time() - start
+    _store_prefetched_retrieval(username, req.session_id, question, snapshot_id, query_embedding, docs, scores, retrieval_seconds)
+    _inc_metric("prefetch_requests_total", labels={"status": "warmed"})
+    logger.debug(f"預取檢索完成 ({username}/{req.session_id}): {retrieval_seconds:.3f}s, {len(docs)} docs")
+    return {"status": "warmed", "retrieved_docs_count": len(docs), "retrieval_time_seconds": round(retrieval_seconds, 3)}
+
 @app.post("/feedback")
 async def submit_feedback_for_user(feedback: FeedbackRequest, username: str = Depends(get_current_username)):
     if not feedback.user_expected_answer: raise HTTPException(status_code=400, detail="預期正確回答不能為空")
@@ -1333,42 +3035,491 @@ async def submit_feedback_for_user(feedback: FeedbackRequest, username: str = De
         logger.error(f"❌ 保存用戶 {username} 的回饋失敗: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="儲存回饋失敗.")
 
+# --- 使用者回饋即時匯入向量資料庫 (Feedback Ingestion Worker) ---
+# 背景執行緒定期掃描 user_specific_feedback/<user>/feedback_*.json，批次嵌入後 upsert 進線上的向量資料庫。
+# 文件 ID 由回饋檔案的相對路徑雜湊而來，重複匯入同一份回饋只會覆寫，不會產生重複資料。
+# 匯入紀錄依向量資料庫快照分開保存，切換到新快照後會自動把回饋補匯入新快照；回饋檔案刪除後對應的文件也會從快照移除。
+# 回饋是未經審核的自由文字，會進入所有用戶共用的檢索語料，因此預設停用，需明確設定 FEEDBACK_INGEST_ENABLED=true。
+# 多 worker 時只有 leader 寫入，其餘 worker 依快照版本號重新開啟快照 (見 _follow_active_snapshot)；暫停狀態以 LOCKS_DIR 下的檔案共用。
+FEEDBACK_INGEST_ENABLED = os.environ.get("FEEDBACK_INGEST_ENABLED", "false").lower() == "true"
+FEEDBACK_INGEST_SOURCE = "user_feedback"
+FEEDBACK_INGEST_POLL_SECONDS = float(os.environ.get("FEEDBACK_INGEST_POLL_SECONDS", "30"))
+FEEDBACK_INGEST_BATCH_SIZE = int(os.environ.get("FEEDBACK_INGEST_BATCH_SIZE", "16"))
+FEEDBACK_INGEST_MAX_DOCS_PER_MINUTE = int(os.environ.get("FEEDBACK_INGEST_MAX_DOCS_PER_MINUTE", "120"))
+FEEDBACK_INGEST_INDEX_FILE = FEEDBACK_SAVE_PATH_BASE / "_ingested_index.json"
+FEEDBACK_INGEST_PAUSE_FILE = LOCKS_DIR / "feedback_ingest.paused"
+
+_feedback_ingest_lock = threading.Lock()
+_feedback_ingest_stop_event = threading.Event()
+_feedback_ingest_state = {
+    "ingested": {},  # 快照 ID -> {相對路徑: 已匯入時的檔案 mtime}
+    "ingested_total": 0, "last_scan_at": None, "last_ingest_at": None,
+    "errors": 0, "last_error": None,
+}
+
+def _feedback_rel_path(feedback_file: Path) -> str:
+    return feedback_file.relative_to(FEEDBACK_SAVE_PATH_BASE).as_posix()
+
+def _feedback_doc_id(rel_path: str) -> str:
+    return "feedback_" + hashlib.sha1(rel_path.encode("utf-8")).hexdigest()[:24]
+
+def _feedback_ingest_paused() -> bool:
+    return FEEDBACK_INGEST_PAUSE_FILE.exists()
+
+def _read_feedback_ingest_index() -> Dict[str, Dict[str, float]]:
+    if not FEEDBACK_INGEST_INDEX_FILE.exists(): return {}
+    try:
+        with open(FEEDBACK_INGEST_INDEX_FILE, "r", encoding="utf-8") as f: return json.load(f)
+    except Exception as e:
+        logger.error(f"❌ 無法讀取回饋匯入索引 {FEEDBACK_INGEST_INDEX_FILE}: {e}", exc_info=True)
+        return {}
+
+def _load_feedback_ingest_index():
+    _feedback_ingest_state["ingested"] = _read_feedback_ingest_index()
+
+def _save_feedback_ingest_index():
+    try:
+        tmp_file = FEEDBACK_INGEST_INDEX_FILE.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f: json.dump(_feedback_ingest_state["ingested"], f, ensure_ascii=False)
+        os.replace(tmp_file, FEEDBACK_INGEST_INDEX_FILE)
+    except Exception as e: logger.error(f"❌ 保存回饋匯入索引失敗: {e}", exc_info=True)
+
+def _ingested_feedback_for(snapshot_id: Optional[str]) -> Dict[str, float]:
+    return _feedback_ingest_state["ingested"].setdefault(str(snapshot_id), {})
+
+def _find_pending_feedback_files(ingested: Dict[str, float]):
+    """回傳 (新增或修改過的回饋檔案, 已匯入但檔案已刪除的相對路徑)"""
+    pending, present = [], set()
+    for feedback_file in FEEDBACK_SAVE_PATH_BASE.glob("*/feedback_*.json"):
+        rel_path = _feedback_rel_path(feedback_file)
+        try: mtime = feedback_file.stat().st_mtime
+        except OSError: continue
+        present.add(rel_path)
+        if ingested.get(rel_path) != mtime:
+            pending.append((mtime, feedback_file))
+    pending.sort(key=lambda item: item[0])
+    return [feedback_file for _, feedback_file in pending], sorted(set(ingested) - present)
+
+def _feedback_file_to_document(feedback_file: Path):
+    with open(feedback_file, "r", encoding="utf-8") as f: record = json.load(f)
+    question = (record.get("question") or "").strip()
+    answer = (record.get("answer") or "").strip()
+    if not answer: return None
+    meta = record.get("metadata", {})
+    doc_id = _feedback_doc_id(_feedback_rel_path(feedback_file))
+    # 與 QA 文件相同，問答對完整保留、不做切段
+    content = f"問題：{question}\n回答：{answer}" if question else answer
+    metadata = {
+        "source": FEEDBACK_INGEST_SOURCE, "doc_id": doc_id, "title": question[:50] or "使用者回饋",
+        "user_identifier": str(meta.get("user_identifier", "")), "session_id": str(meta.get("session_id", "")),
+        "model_used": str(meta.get("model_used", "")), "feedback_timestamp": str(meta.get("timestamp", "")),
+    }
+    return doc_id, content, metadata
+
+def _ingest_feedback_batch(batch: List[Path], snapshot_id: str, db: Chroma, removed: List[str] = ()) -> int:
+    """匯入 batch 並移除 removed (已刪除的回饋檔案相對路徑) 對應的文件；回傳匯入的文件數"""
+    ingested = _ingested_feedback_for(snapshot_id)
+    ids, texts, metadatas, done = [], [], [], []
+    stale_ids = [_feedback_doc_id(rel_path) for rel_path in removed]
+    for feedback_file in batch:
+        try:
+            doc = _feedback_file_to_document(feedback_file)
+        except Exception as e:
+            logger.error(f"❌ 無法解析回饋檔案 {feedback_file}: {e}", exc_info=True)
+            _feedback_ingest_state["errors"] += 1
+            _feedback_ingest_state["last_error"] = f"{feedback_file}: {e}"
+            doc = None
+        done.append(feedback_file)
+        if doc is None:
+            # 已匯入過、但改成沒有回答 (或無法解析) 的回饋也要移除舊文件
+            if _feedback_rel_path(feedback_file) in ingested: stale_ids.append(_feedback_doc_id(_feedback_rel_path(feedback_file)))
+            continue
+        ids.append(doc[0]); texts.append(doc[1]); metadatas.append(doc[2])
+    if stale_ids:
+        db.delete(ids=stale_ids)
+    if ids:
+        db.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+    if stale_ids or ids:
+        _bump_corpus_version(snapshot_id)
+    for rel_path in removed: ingested.pop(rel_path, None)
+    for feedback_file in done:
+        try: ingested[_feedback_rel_path(feedback_file)] = feedback_file.stat().st_mtime
+        except OSError: pass  # 匯入期間被刪除，下一輪當成移除處理
+    _save_feedback_ingest_index()
+    return len(ids)
+
+def _feedback_ingest_worker():
+    logger.info(f"🧵 回饋匯入背景工作已啟動 (每 {FEEDBACK_INGEST_POLL_SECONDS}s 掃描一次, 批次 {FEEDBACK_INGEST_BATCH_SIZE}, 上限 {FEEDBACK_INGEST_MAX_DOCS_PER_MINUTE} 筆/分鐘)")
+    min_batch_interval = 60.0 * FEEDBACK_INGEST_BATCH_SIZE / max(FEEDBACK_INGEST_MAX_DOCS_PER_MINUTE, 1)
+    while not _feedback_ingest_stop_event.is_set():
+        if _feedback_ingest_paused() or not _hold_leader_lock("feedback_ingest"):
+            _feedback_ingest_stop_event.wait(FEEDBACK_INGEST_POLL_SECONDS)
+            continue
+        snapshot_id, db = get_active_vectordb()
+        if db is not None:
+            with _feedback_ingest_lock:
+                _feedback_ingest_state["last_scan_at"] = datetime.now().isoformat()
+                pending, removed = _find_pending_feedback_files(_ingested_feedback_for(snapshot_id))
+            if removed:
+                try:
+                    with _feedback_ingest_lock, _pinned_vectordb() as (current_snapshot_id, current_db):
+                        if current_snapshot_id == snapshot_id:
+                            _ingest_feedback_batch([], current_snapshot_id, current_db, removed=removed)
+                            logger.info(f"🗑️ 已從向量資料庫快照 '{snapshot_id}' 移除 {len(removed)} 筆已刪除的使用者回饋")
+                except Exception as e:
+                    logger.error(f"❌ 移除已刪除的回饋失敗: {e}", exc_info=True)
+                    _feedback_ingest_state["errors"] += 1
+                    _feedback_ingest_state["last_error"] = str(e)
+            while pending and not _feedback_ingest_paused() and not _feedback_ingest_stop_event.is_set():
+                # 有查詢正在嵌入/檢索時讓路，避免與使用者請求搶資源
+                if _inflight_retrievals > 0:
+                    _feedback_ingest_stop_event.wait(0.5)
+                    continue
+                batch, pending = pending[:FEEDBACK_INGEST_BATCH_SIZE], pending[FEEDBACK_INGEST_BATCH_SIZE:]
+                start_batch = time.time()
+                try:
+                    with _feedback_ingest_lock, _pinned_vectordb() as (current_snapshot_id, current_db):
+                        if current_snapshot_id != snapshot_id: break  # 快照已切換，下一輪重新掃描
+                        count = _ingest_feedback_batch(batch, current_snapshot_id, current_db)
+                        _feedback_ingest_state["ingested_total"] += count
+                        _feedback_ingest_state["last_ingest_at"] = datetime.now().isoformat()
+                    _inc_metric("feedback_ingested_docs_total", count)
+                    logger.info(f"📥 已匯入 {count} 筆使用者回饋至向量資料庫快照 '{snapshot_id}' ({time.time() - start_batch:.2f}s)")
+                except Exception as e:
+                    logger.error(f"❌ 回饋匯入批次失敗: {e}", exc_info=True)
+                    _feedback_ingest_state["errors"] += 1
+                    _feedback_ingest_state["last_error"] = str(e)
+                    break
+                _feedback_ingest_stop_event.wait(max(0.0, min_batch_interval - (time.time() - start_batch)))
+        _feedback_ingest_stop_event.wait(FEEDBACK_INGEST_POLL_SECONDS)
+    logger.info("🧵 回饋匯入背景工作已停止")
+
+@app.on_event("startup")
+def start_feedback_ingest_worker():
+    if not FEEDBACK_INGEST_ENABLED:
+        logger.info("回饋匯入背景工作已停用 (FEEDBACK_INGEST_ENABLED=false)")
+        return
+    _load_feedback_ingest_index()
+    threading.Thread(target=_feedback_ingest_worker, name="feedback-ingest", daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_feedback_ingest_worker():
+    _feedback_ingest_stop_event.set()
+
+@admin_router.get("/feedback-ingestion", summary="Feedback ingestion status and lag")
+def get_feedback_ingestion_status(admin: str = Depends(get_admin_user)):
+    # 同步端點 (掃描回饋目錄)：由執行緒池執行。匯入索引每次從檔案重新讀取，非 leader 的 worker 也回報 leader 的最新進度；
+    # ingested_total、last_* 與 errors 為本 worker 的計數
+    snapshot_id, _ = get_active_vectordb()
+    ingested = _read_feedback_ingest_index().get(str(snapshot_id), {})
+    pending, removed = _find_pending_feedback_files(ingested)
+    try: oldest_pending_age = round(time.time() - pending[0].stat().st_mtime, 1) if pending else 0.0
+    except OSError: oldest_pending_age = None
+    return {
+        "enabled": FEEDBACK_INGEST_ENABLED, "pid": os.getpid(),
+        "leader": _is_leader("feedback_ingest") if FEEDBACK_INGEST_ENABLED else False,
+        "paused": FEEDBACK_INGEST_ENABLED and _feedback_ingest_paused(),
+        "pending_files": len(pending), "pending_removals": len(removed), "lag_seconds": oldest_pending_age,
+        "vectordb_snapshot": snapshot_id, "corpus_version": vectordb_corpus_version,
+        "ingested_files": len(ingested),
+        "ingested_total": _feedback_ingest_state["ingested_total"],
+        "last_scan_at": _feedback_ingest_state["last_scan_at"],
+        "last_ingest_at": _feedback_ingest_state["last_ingest_at"],
+        "errors": _feedback_ingest_state["errors"], "last_error": _feedback_ingest_state["last_error"],
+    }
+
+# 暫停旗標為 LOCKS_DIR 下的檔案：請求打到任一 worker 都會影響 leader (每批次前檢查)，重啟後仍維持暫停
+@admin_router.post("/feedback-ingestion/pause", summary="Pause the feedback ingestion worker")
+def pause_feedback_ingestion(admin: str = Depends(get_admin_user)):
+    LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+    FEEDBACK_INGEST_PAUSE_FILE.touch()
+    logger.info("⏸️ 回饋匯入背景工作已暫停")
+    return {"paused": True}
+
+@admin_router.post("/feedback-ingestion/resume", summary="Resume the feedback ingestion worker")
+def resume_feedback_ingestion(admin: str = Depends(get_admin_user)):
+    FEEDBACK_INGEST_PAUSE_FILE.unlink(missing_ok=True)
+    logger.info("▶️ 回饋匯入背景工作已恢復 (下一次掃描時繼續)")
+    return {"paused": False}
+
+class VectorDBReloadRequest(BaseModel):
+    snapshot_id: str = Field(..., min_length=1, description="Snapshot directory name under VECTORDB_SNAPSHOTS_DIR.")
+
+@admin_router.get("/vectordb/snapshots", summary="List vector store snapshots")
+async def list_vectordb_snapshots(admin: str = Depends(get_admin_user)):
+    active_snapshot_id, _ = get_active_vectordb()
+    with _vectordb_swap_lock: inflight = {k: v for k, v in _vectordb_snapshot_inflight.items() if v > 0}
+    return {
+        "active": active_snapshot_id, "available": _list_vectordb_snapshots(),
+        "inflight_requests": inflight,
+        "reload_in_progress": _vectordb_reload_state["in_progress"],
+        "reload_target": _vectordb_reload_state["target"],
+        "last_reload": _vectordb_reload_state["last_result"],
+    }
+
+@admin_router.post("/vectordb/reload", status_code=202, summary="Load, warm and atomically swap in a snapshot")
+async def reload_vectordb_snapshot(req: VectorDBReloadRequest, admin: str = Depends(get_admin_user)):
+    if embedding is None:
+        raise HTTPException(status_code=503, detail="嵌入模型未載入，無法切換向量資料庫。")
+    snapshot_dir = _resolve_snapshot_dir(req.snapshot_id)
+    if snapshot_dir is None:
+        raise HTTPException(status_code=404, detail=f"向量資料庫快照 '{req.snapshot_id}' 不存在")
+    with _vectordb_swap_lock:
+        if _vectordb_reload_state["in_progress"]:
+            raise HTTPException(status_code=409, detail=f"已有快照 '{_vectordb_reload_state['target']}' 正在載入中")
+        _vectordb_reload_state.update(in_progress=True, target=req.snapshot_id)
+    logger.info(f"⏳ 開始在背景載入向量資料庫快照 '{req.snapshot_id}' ({snapshot_dir})")
+    threading.Thread(target=_swap_vectordb_snapshot, args=(req.snapshot_id, snapshot_dir), name=f"load-{req.snapshot_id}", daemon=True).start()
+    return {"status": "loading", "snapshot_id": req.snapshot_id, "active": get_active_vectordb()[0]}
+
+@admin_router.get("/metrics", summary="Process metrics")
+async def get_metrics(admin: str = Depends(get_admin_user)):
+    with _metrics_lock: counters = dict(metrics_counters)
+    return {
+        "pid": os.getpid(),
+        "vectordb_snapshot": get_active_vectordb()[0],
+        "inflight_retrievals": _inflight_retrievals,
+        "embedding_service": ({**embedding.stats, "url": embedding.service_url, "using_service": embedding.using_service}
+                              if isinstance(embedding, RemoteEmbeddings) else None),
+        "tracing": trace_exporter.stats,
+        "counters": counters,
+    }
+
+@admin_router.get("/models/health", summary="Per-model latency, error rate and fallback chain")
+async def get_models_health(admin: str = Depends(get_admin_user)):
+    models = {}
+    for model_name in SUPPORTED_MODELS:
+        estimate = _model_load_estimate(model_name)
+        models[model_name] = {**estimate, "degraded_reason": _model_degradation_reason(model_name),
+                              "fallback_chain": MODEL_FALLBACK_CHAIN.get(model_name, [])}
+    return {"pid": os.getpid(), "models": models}
+
+@admin_router.get("/models/router", summary="Complexity router: tiers and rules")
+async def get_model_router(admin: str = Depends(get_admin_user)):
+    with _metrics_lock:
+        decisions = {k: v for k, v in metrics_counters.items() if k.startswith("model_router_decisions_total")}
+    return {"pid": os.getpid(), **model_router.describe(), "decisions": decisions}
+
+@admin_router.get("/models/scheduler", summary="Model-affinity scheduler: resident models, queues and swap rate")
+async def get_model_scheduler(admin: str = Depends(get_admin_user)):
+    return {"pid": os.getpid(), "backends": {b.name: b.scheduler.snapshot() for b in ollama_pool.backends}}
+
+@admin_router.get("/models/backends", summary="Ollama backend pool: health, outstanding requests and inventories")
+async def get_ollama_backends(admin: str = Depends(get_admin_user)):
+    return {"pid": os.getpid(), **ollama_pool.snapshot()}
+
+@admin_router.get("/generation-budgets", summary="Per-template generation budgets and truncation rates")
+async def get_generation_budgets(admin: str = Depends(get_admin_user)):
+    with _generation_stats_lock:
+        stats = {key: {"count": v["count"], "truncated": v["truncated"], "eval_counts": sorted(v["eval_counts"])} for key, v in _generation_stats.items()}
+    templates = {}
+    for _, key in TEMPLATE_KEYS:
+        observed = stats.get(key, {"count": 0, "truncated": 0, "eval_counts": []})
+        eval_counts = observed["eval_counts"]
+        templates[key] = {
+            "num_predict": TEMPLATE_NUM_PREDICT.get(key), "stop_sequences": TEMPLATE_STOP_SEQUENCES.get(key),
+            "generations": observed["count"], "truncated": observed["truncated"],
+            "truncation_rate": round(observed["truncated"] / observed["count"], 4) if observed["count"] else None,
+            # 最近 500 次生成的輸出 token 分佈，用於調整預算
+            "output_tokens_p50": eval_counts[len(eval_counts) // 2] if eval_counts else None,
+            "output_tokens_p95": eval_counts[min(len(eval_counts) - 1, int(len(eval_counts) * 0.95))] if eval_counts else None,
+            "output_tokens_max": eval_counts[-1] if eval_counts else None,
+        }
+    return {"pid": os.getpid(), "templates": templates}
+
+def _p50(values: List[float]) -> Optional[float]:
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+@admin_router.get("/prefetch", summary="Retrieval prefetch hit rate and retrieval latency saved on /chat")
+async def get_prefetch_stats(admin: str = Depends(get_admin_user)):
+    with _prefetch_cache_lock:
+        samples = {key: list(values) for key, values in _prefetch_stats.items()}
+        cached_entries = len(_prefetch_cache)
+    rounded = lambda value: round(value, 3) if value is not None else None
+    hit_p50, miss_p50 = _p50(samples["hit"]), _p50(samples["miss"])
+    requests_seen = sum(len(samples[key]) for key in ("hit", "embedding_reused", "miss"))
+    return {
+        "pid": os.getpid(), "enabled": PREFETCH_ENABLED, "multi_worker_mode": MULTI_WORKER_MODE, "cached_entries": cached_entries,
+        "recent_chat_requests": requests_seen, "hit_rate": round(len(samples["hit"]) / requests_seen, 3) if requests_seen else None,
+        "retrieval_seconds_p50": {key: rounded(_p50(samples[key])) for key in ("hit", "embedding_reused", "miss")},
+        # 命中時 /chat 省下的延遲：預取當下的檢索耗時，以及與未命中請求的檢索耗時 p50 差距
+        "saved_seconds_p50": rounded(_p50(samples["saved"])), "saved_seconds_recent_total": round(sum(samples["saved"]), 3),
+        "hit_vs_miss_p50_delta_seconds": rounded(miss_p50 - hit_p50) if hit_p50 is not None and miss_p50 is not None else None,
+    }
+
+@admin_router.get("/structured-output", summary="Output tokens and LLM latency per style: free text vs compact structured output")
+async def get_structured_output_stats(admin: str = Depends(get_admin_user)):
+    with _generation_stats_lock:
+        stats = {key: {"count": v["count"], "truncated": v["truncated"], "parse_failures": v["parse_failures"],
+                       "eval_counts": list(v["eval_counts"]), "seconds": list(v["seconds"])} for key, v in _generation_stats.items()}
+    styles = {}
+    for style in compact_styles():
+        modes = {}
+        for mode, key in (("free", style), ("compact", f"{style}:compact"), ("compact_fallback", f"{style}:compact_fallback")):
+            observed = stats.get(key, {"count": 0, "truncated": 0, "parse_failures": 0, "eval_counts": [], "seconds": []})
+            p50_seconds = _p50(observed["seconds"])
+            modes[mode] = {"generations": observed["count"], "truncated": observed["truncated"],
+                           "output_tokens_p50": _p50(observed["eval_counts"]),
+                           "llm_seconds_p50": round(p50_seconds, 2) if p50_seconds is not None else None}
+        compact = stats.get(f"{style}:compact", {"count": 0, "parse_failures": 0})
+        free_tokens, compact_tokens = modes["free"]["output_tokens_p50"], modes["compact"]["output_tokens_p50"]
+        free_seconds, compact_seconds = modes["free"]["llm_seconds_p50"], modes["compact"]["llm_seconds_p50"]
+        styles[style] = {
+            **modes, "parse_failure_rate": round(compact["parse_failures"] / compact["count"], 4) if compact["count"] else None,
+            # 中位數比較；解析失敗的請求另外付出 compact_fallback 的生成成本
+            "output_tokens_saved_pct": round(100 * (1 - compact_tokens / free_tokens), 1) if free_tokens and compact_tokens else None,
+            "llm_seconds_saved_pct": round(100 * (1 - compact_seconds / free_seconds), 1) if free_seconds and compact_seconds else None,
+        }
+    return {"pid": os.getpid(), "compact_output_ratio": COMPACT_OUTPUT_RATIO,
+            "compact_num_predict": TEMPLATE_NUM_PREDICT["compact_structured"], "styles": styles}
+
+@admin_router.get("/prompt-tokens", summary="Estimated prompt tokens per template section and measured prefill per template variant")
+async def get_prompt_token_stats(admin: str = Depends(get_admin_user)):
+    with _generation_stats_lock:
+        stats = {key: {"count": v["count"], "sections": {s: list(d) for s, d in v["sections"].items()},
+                       "prompt_eval_counts": list(v["prompt_eval_counts"]), "prefill_seconds": list(v["prefill_seconds"])}
+                 for key, v in _prompt_token_stats.items()}
+    templates = {}
+    for key, v in sorted(stats.items()):
+        sections_p50 = {section: _p50(values) for section, values in v["sections"].items()}
+        static_tokens = (sections_p50["instructions"] or 0) + (sections_p50["example"] or 0)
+        estimated_total = _p50([sum(totals) for totals in zip(*v["sections"].values())])
+        prefill_p50 = _p50(v["prefill_seconds"])
+        templates[key] = {
+            "requests": v["count"], "estimated_tokens_p50": sections_p50, "estimated_total_p50": estimated_total,
+            "static_share": round(static_tokens / estimated_total, 3) if estimated_total else None,
+            # 相同前綴會重用 KV cache，實際預填數可能小於估計總和
+            "prompt_eval_count_p50": _p50(v["prompt_eval_counts"]),
+            "prefill_seconds_p50": round(prefill_p50, 3) if prefill_p50 is not None else None,
+        }
+    return {"pid": os.getpid(), "variants": PROMPT_TEMPLATE_VARIANTS, "templates": templates}
+
+# --- Profiling (/api/admin/profiling) ---
+# 取樣剖析只在呼叫時執行；慢請求記錄只讀取 tracing 已建立的 span；記憶體快照預設每分鐘只讀一次 RSS 與 heap 計數
+sampling_profiler = SamplingProfiler()
+slow_request_recorder = SlowRequestRecorder()
+memory_sampler = MemorySampler()
+add_trace_listener(slow_request_recorder)
+
+@app.on_event("startup")
+def start_memory_sampler():
+    memory_sampler.start()
+
+@app.on_event("startup")
+def start_ollama_health_checks():
+    # 只有一個後端時剔除也無處可送，不需要背景檢查
+    if len(ollama_pool.backends) > 1: ollama_pool.start()
+
+@app.on_event("shutdown")
+def stop_ollama_health_checks():
+    ollama_pool.stop()
+
+@app.on_event("shutdown")
+def stop_memory_sampler():
+    memory_sampler.stop()
+
+class TracemallocRequest(BaseModel):
+    enabled: bool
+    nframes: int = Field(1, ge=1, le=25)
+
+@admin_router.post("/profiling/cpu", summary="Sample all thread stacks of this worker for a time window")
+async def run_cpu_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS), interval_ms: float = Query(10, ge=1, le=1000),
+    top: int = Query(30, ge=1, le=200), format: Literal["json", "collapsed"] = "json",
+    thread: Optional[str] = Query(None, description="只取樣名稱包含此字串的執行緒，例如 MainThread (事件迴圈)"),
+    include_idle: bool = False, admin: str = Depends(get_admin_user),
+):
+    logger.info(f"🔬 管理者 {admin} 開始 {seconds}s 的取樣剖析 (間隔 {interval_ms}ms)")
+    try:
+        result = await asyncio.to_thread(sampling_profiler.profile, seconds, interval_ms, top, thread, include_idle)
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="已有剖析正在進行中")
+    if format == "collapsed":
+        return Response(content=collapsed_text(result["collapsed"]), media_type="text/plain; charset=utf-8")
+    collapsed = result.pop("collapsed")
+    return {"pid": os.getpid(), **result, "distinct_stacks": len(collapsed)}
+
+@admin_router.get("/profiling/slow-requests", summary="Per-stage breakdown of recent slow requests")
+async def get_slow_requests(limit: int = Query(20, ge=1, le=SLOW_REQUEST_MAX_ENTRIES), admin: str = Depends(get_admin_user)):
+    return {"pid": os.getpid(), "threshold_seconds": slow_request_recorder.threshold_seconds,
+            "requests_seen": slow_request_recorder.seen, "log_dropped": slow_request_recorder.log_dropped, "slow_requests": slow_request_recorder.recent(limit)}
+
+@admin_router.get("/profiling/memory", summary="Current and periodic memory snapshots")
+async def get_memory_snapshots(limit: int = Query(60, ge=0, le=1000), top: int = Query(15, ge=1, le=100), admin: str = Depends(get_admin_user)):
+    # tracemalloc 開啟時 take_snapshot 可能需要數百毫秒，不在事件迴圈中執行
+    current = await asyncio.to_thread(memory_sampler.snapshot, top)
+    history = list(memory_sampler.snapshots)[-limit:] if limit else []
+    return {"pid": os.getpid(), "interval_seconds": memory_sampler.interval_seconds,
+            "tracemalloc_enabled": memory_sampler.tracemalloc_enabled, "current": current, "history": history}
+
+@admin_router.post("/profiling/tracemalloc", summary="Enable or disable allocation tracking")
+async def set_tracemalloc(req: TracemallocRequest, admin: str = Depends(get_admin_user)):
+    if req.enabled: memory_sampler.start_tracemalloc(req.nframes)
+    else: memory_sampler.stop_tracemalloc()
+    logger.info(f"🧠 管理者 {admin} 將 tracemalloc 設為 {req.enabled}")
+    return {"pid": os.getpid(), "tracemalloc_enabled": memory_sampler.tracemalloc_enabled}
+
 class PublicRAGRequest(BaseModel):
     question: str = Field(..., min_length=1, description="User's question for the RAG system.")
     session_id: Optional[str] = Field(None, description="Optional session ID.")
-    model: Optional[str] = Field(DEFAULT_MODEL, description=f"Optional LLM. Supported: {', '.join(SUPPORTED_MODELS)}. Defaults to {DEFAULT_MODEL}.")
+    stateless: Optional[bool] = Field(None, description="Answer without loading or saving conversation history; only the QA log is written. Defaults to PUBLIC_API_STATELESS_DEFAULT when session_id is omitted, otherwise false.")
+    model: Optional[str] = Field(None, description=f"Optional LLM. Supported: {', '.join(SUPPORTED_MODELS)}. Omit or pass 'auto' to let the server pick a model by question complexity (when routing is enabled); otherwise defaults to {DEFAULT_MODEL}.")
     prompt_mode: Optional[str] = Field("default", description="Optional prompt mode. Supported: 'default', 'research'. Defaults to 'default'.")
+    allow_model_fallback: bool = Field(True, description="Allow falling back to a smaller model when the requested one is over its latency SLO or erroring.")
+    max_output_tokens: Optional[int] = Field(None, ge=16, le=MAX_OUTPUT_TOKENS_LIMIT, description="Optional cap on generated tokens; overrides the per-template budget.")
+    metadata_filter: Optional[Dict] = Field(None, description='Optional filter on chunk metadata (doc_type, source, doc_id, title, section), e.g. {"doc_type": "qa"} or {"source": {"$in": ["a", "b"]}}. Supports $eq, $ne, $in, $nin, $and and $or.')
+    sources_mode: Literal["full", "snippet", "ids"] = Field("full", description="How sources are returned: 'full' (content + metadata), 'snippet' (content truncated around the best-matching span) or 'ids' (resolve later via POST /rag/sources).")
 
 class PublicRAGResponse(BaseModel):
     answer: str; model_used: str; prompt_mode_used: str; format_mode_used: str
+    model_requested: Optional[str] = None
+    model_fallback_reason: Optional[str] = Field(None, description="Why model_used differs from model_requested: error_rate, queue_wait, latency_slo, unavailable or error.")
+    model_routing_rule: Optional[str] = Field(None, description="Routing rule that chose model_requested when no model was pinned.")
     template_style_used: Optional[str] = None
     sources: List[PublicRAGDocumentSource]
     session_id: str
+    stateless: bool = False
+    vectordb_snapshot: Optional[str] = None
+    done_reason: Optional[str] = Field(None, description="'stop' when generation ended normally, 'length' when it hit the token budget.")
     llm_processing_time_seconds: Optional[float] = None
     retrieval_time_seconds: Optional[float] = None
     total_request_time_seconds: Optional[float] = None
 
+# 未帶 session_id 的公開 API 請求預設不保存對話 (每次呼叫都會產生新的一次性 session，保存只會累積檔案)；
+# 需要舊行為 (每次建立一次性 session) 時設定 PUBLIC_API_STATELESS_DEFAULT=false
+PUBLIC_API_STATELESS_DEFAULT = os.environ.get("PUBLIC_API_STATELESS_DEFAULT", "true").lower() == "true"
 public_api_v1_router = APIRouter(prefix="/api/v1/public", tags=["Public RAG API v1 (X-API-Key Auth)"])
 
 @public_api_v1_router.post("/rag/ask", response_model=PublicRAGResponse, summary="Ask the RAG system (API Key)")
-async def public_rag_ask(req: PublicRAGRequest, api_user_identifier: str = Depends(get_api_key_user)):
+async def public_rag_ask(req: PublicRAGRequest, request: Request, api_user_identifier: str = Depends(get_api_key_user)):
     start_overall_request = time.time()
     session_id_to_use = req.session_id
+    stateless = req.stateless if req.stateless is not None else (not session_id_to_use and PUBLIC_API_STATELESS_DEFAULT)
     if not session_id_to_use:
         timestamp_ms = int(time.time() * 1000)
         random_suffix = random.randint(10000, 99999)
         session_id_to_use = f"api_{api_user_identifier.replace('_','-')[:10]}_{timestamp_ms}_{random_suffix}"
-        logger.info(f"No session_id by API user '{api_user_identifier}', generated: '{session_id_to_use}'")
+        logger.info(f"No session_id by API user '{api_user_identifier}', generated: '{session_id_to_use}'{' (stateless, not persisted)' if stateless else ''}")
+    _inc_metric("public_api_requests_total", labels={"stateless": str(stateless).lower()})
+    try:
+        metadata_filter = normalize_metadata_filter(req.metadata_filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid metadata_filter: {e}")
     
-    selected_model_for_api = req.model if req.model and req.model in SUPPORTED_MODELS else DEFAULT_MODEL
+    selected_model_for_api = _resolve_requested_model(req.model)
     prompt_mode_for_api = req.prompt_mode if req.prompt_mode in ["default", "research"] else "default"
     try:
         result_dict = await process_rag_request(
             username=api_user_identifier, session_id=session_id_to_use, question=req.question,
             selected_model=selected_model_for_api, prompt_mode=prompt_mode_for_api,
+            max_output_tokens=req.max_output_tokens, allow_model_fallback=req.allow_model_fallback,
+            request=request, stateless=stateless, metadata_filter=metadata_filter,
         )
         total_time = time.time() - start_overall_request
         result_dict["total_request_time_seconds"] = round(total_time, 2)
+        result_dict["stateless"] = stateless
+        result_dict["sources"] = _shape_sources(result_dict["sources"], req.sources_mode, req.question)
         logger.info(f"⏱️ Total Public API request for API user '{api_user_identifier}': {total_time:.2f}s. LLM: {result_dict.get('llm_processing_time_seconds','N/A')}s. Retrieval: {result_dict.get('retrieval_time_seconds','N/A')}s")
         return PublicRAGResponse(**result_dict)
     except HTTPException as e_http:
@@ -1378,8 +3529,41 @@ async def public_rag_ask(req: PublicRAGRequest, api_user_identifier: str = Depen
         logger.error(f"❌ Unexpected error public_rag_ask for API user '{api_user_identifier}': {str(e_general)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error processing RAG request.")
 
+class PublicRAGSourcesRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=100, description="Source ids returned by /rag/ask.")
+
+class PublicRAGSourcesResponse(BaseModel):
+    sources: List[PublicRAGDocumentSource]
+    missing_ids: List[str] = []
+
+# 同步端點：db.get 在分片快照上會逐一查詢每個分片，由 FastAPI 放到執行緒池執行，不阻塞事件迴圈
+@public_api_v1_router.post("/rag/sources", response_model=PublicRAGSourcesResponse, summary="Resolve source ids to full chunks (API Key)")
+def public_rag_sources(req: PublicRAGSourcesRequest, api_user_identifier: str = Depends(get_api_key_user)):
+    ids = list(dict.fromkeys(req.ids))
+    resolved: Dict[str, Dict] = {}
+    with _source_cache_lock:
+        for source_id in ids:
+            if (api_user_identifier, source_id) in _source_cache: resolved[source_id] = _source_cache[(api_user_identifier, source_id)]
+    lookup_ids = [source_id for source_id in ids if source_id not in resolved]
+    if lookup_ids:
+        with _pinned_vectordb() as (_, db):
+            if db is not None:
+                try:
+                    found = db.get(ids=lookup_ids, include=["documents", "metadatas"])
+                    for source_id, content, metadata in zip(found["ids"], found["documents"], found["metadatas"]):
+                        resolved[source_id] = {"id": source_id, "content": content, "metadata": metadata or {}}
+                except Exception as e:
+                    logger.error(f"❌ 解析 source id 失敗 (API user '{api_user_identifier}'): {e}", exc_info=True)
+                    raise HTTPException(status_code=500, detail="Failed to resolve source ids.")
+        _remember_sources(api_user_identifier, [resolved[source_id] for source_id in lookup_ids if source_id in resolved])
+    return PublicRAGSourcesResponse(
+        sources=[_public_source(resolved[source_id]) for source_id in ids if source_id in resolved],
+        missing_ids=[source_id for source_id in ids if source_id not in resolved],
+    )
+
 app.include_router(api_router)
 app.include_router(public_api_v1_router)
+app.include_router(admin_router)
 
 # To run (replace `your_filename` with the actual name of your Python file):
 # uvicorn 6_10test:app --host 0.0.0.0 --port 8000 --reload   6/11 有微調prompt 如果效果不好就用這個 目前較為準確的版本
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+精簡結構化輸出與伺服器端排版 (Compact Structured Output & Server-side Rendering)
+
+預設的三種回答風格 (結構化列表、層級式條列、表情符號段落) 會讓模型逐 token 生成分隔線、標題編號與 Markdown 裝飾。
+精簡模式下模型只輸出 JSON (以 Ollama 的 format 參數限制為 COMPACT_ANSWER_SCHEMA)：
+    {"title": "...", "intro": "...", "sections": [{"title": "...", "emoji": "🏫", "points": ["...", "..."]}], "conclusion": "..."}
+再由伺服器依選中的風格確定性地排版。parse_compact_answer 無法解析時回傳 None，呼叫端改走原本的自由文字模板。
+"""
+import json
+import re
+from typing import Dict, List, Optional
+
+COMPACT_ANSWER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "intro": {"type": "string"},
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"title": {"type": "string"}, "emoji": {"type": "string"},
+                               "points": {"type": "array", "items": {"type": "string"}}},
+                "required": ["title", "points"],
+            },
+        },
+        "conclusion": {"type": "string"},
+    },
+    "required": ["intro", "sections"],
+}
+
+STRUCTURED_LIST_SEPARATOR = "." * 100
+CHINESE_NUMERALS = "一二三四五六七八九十"
+DEFAULT_SECTION_EMOJI = "🔹"
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+
+def _chinese_ordinal(index: int) -> str:
+    if index < 10: return CHINESE_NUMERALS[index]
+    tens, ones = divmod(index + 1, 10)
+    return f"{CHINESE_NUMERALS[tens - 1] if tens > 1 else ''}十{CHINESE_NUMERALS[ones - 1] if ones else ''}"
+
+
+def _clean(text) -> str:
+    return re.sub(r"\s+", " ", text).strip() if isinstance(text, str) else ""
+
+
+def _sentence(point: str) -> str:
+    return point if point[-1] in "。！？.!?" else point + "。"
+
+
+def parse_compact_answer(text: str) -> Optional[Dict]:
+    """解析並正規化模型輸出的 JSON；結構不符或沒有任何內容時回傳 None"""
+    text = _CODE_FENCE_RE.sub("", (text or "").strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start: return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("sections", []), list): return None
+    sections = []
+    for section in data.get("sections", []):
+        if not isinstance(section, dict): return None
+        points = section.get("points", section.get("body", []))
+        points = [_clean(p) for p in (points if isinstance(points, list) else [points])]
+        points = [p for p in points if p]
+        title = _clean(section.get("title"))
+        if not points and not title: continue
+        sections.append({"title": title, "emoji": _clean(section.get("emoji")), "points": points})
+    answer = {"title": _clean(data.get("title")), "intro": _clean(data.get("intro")), "sections": sections,
+              "conclusion": _clean(data.get("conclusion"))}
+    if not answer["intro"] and not sections: return None
+    return answer
+
+
+def render_structured_list(answer: Dict) -> str:
+    blocks = [answer["intro"]] if answer["intro"] else []
+    for index, section in enumerate(answer["sections"]):
+        body = "".join(_sentence(p) for p in section["points"]) + (f" {section['emoji']}" if section["emoji"] else "")
+        blocks.append(f"**{_chinese_ordinal(index)}、{section['title']}**\n{body}\n{STRUCTURED_LIST_SEPARATOR}")
+    if answer["conclusion"]: blocks.append(answer["conclusion"])
+    return "\n\n".join(blocks)
+
+
+def render_hierarchical_bullets(answer: Dict) -> str:
+    blocks = []
+    head = [f"# {answer['title']}"] if answer["title"] else []
+    if answer["intro"]: head.append(answer["intro"])
+    if head: blocks.append("\n".join(head))
+    for index, section in enumerate(answer["sections"]):
+        bullets = "\n".join(f"*   {point}" for point in section["points"])
+        blocks.append(f"## {_chinese_ordinal(index)}、{section['title']}" + (f"\n{bullets}" if bullets else ""))
+    if answer["conclusion"]: blocks.append(answer["conclusion"])
+    return "\n\n".join(blocks)
+
+
+def render_paragraph_emoji_lead(answer: Dict) -> str:
+    blocks = [f"💡 {answer['intro']}"] if answer["intro"] else []
+    for section in answer["sections"]:
+        if section["points"]: blocks.append(f"{section['emoji'] or DEFAULT_SECTION_EMOJI} {''.join(_sentence(p) for p in section['points'])}")
+    if answer["conclusion"]: blocks.append(f"✅ {answer['conclusion']}")
+    return "\n\n".join(blocks)
+
+
+RENDERERS = {
+    "structured_list": render_structured_list,
+    "hierarchical_bullets": render_hierarchical_bullets,
+    "paragraph_emoji_lead": render_paragraph_emoji_lead,
+}
+
+
+def render_compact_answer(answer: Dict, style: str) -> str:
+    # 沒有章節 (例如資料不足、無法回答) 時只輸出引言，不加任何裝飾
+    if not answer["sections"]:
+        return answer["intro"]
+    return RENDERERS[style](answer)
+
+
+def compact_styles() -> List[str]:
+    return list(RENDERERS)
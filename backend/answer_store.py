@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+預先計算的常見問題回答 (Precomputed Answer Store)
+
+夜間工作從 QA 記錄 (user_specific_qa_logs/<用戶>/qa_log_*.jsonl) 找出各 (模型, prompt_mode) 最常出現的問題，
+以當時的向量資料庫與提示模板重新生成回答並存入 SQLite；process_rag_request 在檢索前先查詢此處。
+
+每筆回答以 (問題鍵, 模型, prompt_mode, 向量資料庫快照, 模板版本) 為鍵：快照切換或模板修改後舊回答自然失效，
+下一次夜間工作會重新生成。快照欄位由呼叫端決定內容，後端會附上快照被原地寫入 (回饋匯入) 的版本號。問題鍵為 NFKC 正規化、轉小寫並移除空白與標點後的問題，
+「小港空污？」與「小港 空污?」視為同一個問題。
+"""
+import json
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+from contextlib import closing, contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+_IGNORED_CHARS_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_question_key(question: str) -> str:
+    return _IGNORED_CHARS_RE.sub("", unicodedata.normalize("NFKC", question).lower())
+
+
+def mine_frequent_questions(logs_dir: Path, since: Optional[str] = None, exclude_users: Iterable[str] = (),
+                            top_n: int = 50, min_count: int = 3) -> List[Dict]:
+    """回傳各 (模型, prompt_mode) 出現次數最多的前 top_n 個問題 (至少 min_count 次)，依次數由多到少。
+    只採計沒有對話記錄與 metadata 條件的請求 (追問的回答依賴上下文，無法重用)；since 為 YYYY-MM-DD"""
+    groups: Dict[tuple, Dict[str, Dict]] = {}
+    exclude_users = set(exclude_users)
+    if not logs_dir.is_dir(): return []
+    for user_dir in sorted(p for p in logs_dir.iterdir() if p.is_dir() and p.name not in exclude_users):
+        for log_file in sorted(user_dir.glob("qa_log_*.jsonl")):
+            if since and log_file.stem.replace("qa_log_", "") < since: continue
+            with open(log_file, encoding="utf-8") as f:
+                for line in f:
+                    try: record = json.loads(line)
+                    except ValueError: continue
+                    question = (record.get("question") or "").strip()
+                    if not question or record.get("cancelled") or record.get("metadata_filter"): continue
+                    if (record.get("routing_signals") or {}).get("history_pairs", 0) > 0: continue
+                    model = record.get("model_requested") or record.get("model")
+                    if not model: continue
+                    key = normalize_question_key(question)
+                    if not key: continue
+                    entry = groups.setdefault((model, record.get("prompt_mode_requested") or "default"), {}).setdefault(key, {"count": 0, "last_seen": ""})
+                    entry["count"] += 1
+                    timestamp = record.get("timestamp") or ""
+                    if timestamp >= entry["last_seen"]: entry.update(question=question, last_seen=timestamp)  # 以最近一次的原文生成
+    candidates = []
+    for (model, prompt_mode), questions in groups.items():
+        ranked = sorted(questions.items(), key=lambda item: (item[1]["count"], item[1]["last_seen"]), reverse=True)
+        candidates.extend({"question_key": key, "question": entry["question"], "model": model, "prompt_mode": prompt_mode, "count": entry["count"]}
+                          for key, entry in ranked[:top_n] if entry["count"] >= min_count)
+    return sorted(candidates, key=lambda c: c["count"], reverse=True)
+
+
+class AnswerStore:
+    _COLUMNS = ("question_key", "model", "prompt_mode", "snapshot_id", "template_version", "question", "answer",
+                "format_mode", "template_style", "sources", "done_reason", "frequency", "generation_seconds", "generated_at", "hits")
+
+    def __init__(self, path: Path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+                question_key TEXT NOT NULL, model TEXT NOT NULL, prompt_mode TEXT NOT NULL,
+                snapshot_id TEXT NOT NULL, template_version TEXT NOT NULL,
+                question TEXT NOT NULL, answer TEXT NOT NULL, format_mode TEXT, template_style TEXT,
+                sources TEXT NOT NULL, done_reason TEXT, frequency INTEGER, generation_seconds REAL,
+                generated_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (question_key, model, prompt_mode, snapshot_id, template_version))""")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # sqlite3 連線本身的 with 只負責 commit / rollback 不會關閉，外層再以 closing 確保每次用完即關閉
+        with closing(sqlite3.connect(str(self.path), timeout=10)) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+
+    def get(self, question: str, model: str, prompt_mode: str, snapshot_id: str, template_version: str) -> Optional[Dict]:
+        key = (normalize_question_key(question), model, prompt_mode, str(snapshot_id), template_version)
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM answers WHERE question_key = ? AND model = ? AND prompt_mode = ? "
+                               "AND snapshot_id = ? AND template_version = ?", key).fetchone()
+        if row is None: return None
+        entry = dict(zip(self._COLUMNS, row))
+        entry["sources"] = json.loads(entry["sources"])
+        return entry
+
+    def record_hit(self, question: str, model: str, prompt_mode: str, snapshot_id: str, template_version: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE answers SET hits = hits + 1 WHERE question_key = ? AND model = ? AND prompt_mode = ? AND snapshot_id = ? AND template_version = ?",
+                         (normalize_question_key(question), model, prompt_mode, str(snapshot_id), template_version))
+
+    def put(self, question: str, model: str, prompt_mode: str, snapshot_id: str, template_version: str, answer: str,
+            sources: List[Dict], format_mode: str, template_style: str, done_reason: Optional[str],
+            frequency: int, generation_seconds: float):
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO answers ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                         (normalize_question_key(question), model, prompt_mode, str(snapshot_id), template_version, question, answer,
+                          format_mode, template_style, json.dumps(sources, ensure_ascii=False), done_reason, frequency,
+                          generation_seconds, time.time(), 0))
+
+    def prune(self, snapshot_id: str, keep: Iterable[tuple]) -> int:
+        """刪除其他快照的回答，以及目前快照中不在 keep ((問題鍵, 模型, prompt_mode)) 內的回答"""
+        keep = set(keep)
+        with self._connect() as conn:
+            removed = conn.execute("DELETE FROM answers WHERE snapshot_id != ?", (str(snapshot_id),)).rowcount
+            stale = [row for row in conn.execute("SELECT question_key, model, prompt_mode FROM answers") if tuple(row) not in keep]
+            conn.executemany("DELETE FROM answers WHERE question_key = ? AND model = ? AND prompt_mode = ?", stale)
+        return removed + len(stale)
+
+    def clear(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM answers").rowcount
+
+    def stats(self) -> Dict:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT model, prompt_mode, snapshot_id, COUNT(*), SUM(hits), MAX(generated_at) FROM answers "
+                                "GROUP BY model, prompt_mode, snapshot_id").fetchall()
+            top = conn.execute("SELECT question, model, prompt_mode, frequency, hits FROM answers ORDER BY hits DESC, frequency DESC LIMIT 20").fetchall()
+        return {
+            "entries": sum(r[3] for r in rows),
+            "groups": [{"model": r[0], "prompt_mode": r[1], "vectordb_snapshot": r[2], "entries": r[3], "hits": r[4] or 0,
+                        "last_generated_at": datetime.fromtimestamp(r[5]).isoformat() if r[5] else None} for r in rows],
+            "top_entries": [{"question": r[0], "model": r[1], "prompt_mode": r[2], "frequency": r[3], "hits": r[4]} for r in top],
+        }
+
+
+if __name__ == "__main__":
+    # 離線檢視：python answer_store.py [QA 記錄資料夾] [起始日期]，列出夜間工作會預先計算的問題
+    logs_dir = Path(sys.argv[1] if len(sys.argv) > 1 else "user_specific_qa_logs")
+    for candidate in mine_frequent_questions(logs_dir, since=sys.argv[2] if len(sys.argv) > 2 else None, min_count=1):
+        print(f"{candidate['count']:>5}  {candidate['model']:<28} {candidate['prompt_mode']:<9} {candidate['question'][:60]}")
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+嵌入後端一致性檢查與效能基準 (Embedding Backend Parity & Benchmark)
+
+對每個嵌入後端 (torch / onnx / onnx-int8)：
+- 一致性：從 Chroma 取樣已儲存的 fp32 文件嵌入，以該後端重新嵌入同一段文字並計算餘弦相似度
+- 效能：單筆查詢嵌入的延遲 (p50 / p95 / mean) 與程序記憶體 (RSS)
+
+每個後端在獨立的子程序中量測，RSS 不會互相影響。
+
+範例：
+    python benchmark_embedding_backends.py --persist-dir vectordb_snapshots/20250612 --backends torch onnx-int8 --threads 4
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+
+def current_rss_mb() -> float:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        import resource  # 沒有 psutil 時退而使用峰值 RSS (Linux 單位為 KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def load_stored_samples(persist_dir: str, collection_name: str, sample: int):
+    import chromadb
+    client = chromadb.PersistentClient(path=persist_dir)
+    collection = client.get_collection(collection_name)
+    data = collection.get(limit=sample, include=["embeddings", "documents"])
+    return list(data["documents"]), [list(map(float, e)) for e in data["embeddings"]]
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def run_child(args) -> Dict:
+    from embedding_backends import build_embeddings
+
+    rss_before = current_rss_mb()
+    start = time.time()
+    embedding = build_embeddings(args.model, device="cpu", backend=args.child, num_threads=args.threads, onnx_dir=args.onnx_dir)
+    embedding.embed_query("預熱")
+    load_seconds = time.time() - start
+    rss_loaded = current_rss_mb()
+
+    documents, stored = load_stored_samples(args.persist_dir, args.collection_name, args.sample)
+    queries = [doc[:args.query_chars] for doc in documents[:args.queries]] or ["小港空污對兒童健康的影響"]
+    latencies = []
+    for _ in range(args.repeat):
+        for query in queries:
+            start = time.perf_counter()
+            embedding.embed_query(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    parity = {}
+    if documents:
+        start = time.time()
+        recomputed = embedding.embed_documents(documents)
+        similarities = [cosine(a, b) for a, b in zip(recomputed, stored)]
+        parity = {
+            "docs": len(similarities), "mean_cosine": round(statistics.mean(similarities), 5),
+            "p5_cosine": round(percentile(similarities, 0.05), 5), "min_cosine": round(min(similarities), 5),
+            "docs_per_second": round(len(documents) / max(time.time() - start, 1e-6), 2),
+        }
+    return {
+        "backend": args.child, "threads": args.threads, "load_seconds": round(load_seconds, 2),
+        "rss_mb_loaded": round(rss_loaded - rss_before, 1), "rss_mb_peak": round(current_rss_mb(), 1),
+        "query_latency_ms": {"p50": round(percentile(latencies, 0.5), 2), "p95": round(percentile(latencies, 0.95), 2),
+                             "mean": round(statistics.mean(latencies), 2), "samples": len(latencies)},
+        "parity_vs_stored": parity,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較嵌入後端的一致性、延遲與記憶體")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx-int8"])
+    parser.add_argument("--persist-dir", default=os.environ.get("VECTORDB_PATH", "6_12"), help="存有 fp32 嵌入的 Chroma 資料夾")
+    parser.add_argument("--collection-name", default="langchain")
+    parser.add_argument("--model", default=os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3"))
+    parser.add_argument("--onnx-dir", default=None, help="ONNX 模型資料夾 (預設: EMBEDDING_ONNX_DIR)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("EMBEDDING_NUM_THREADS", "0")))
+    parser.add_argument("--sample", type=int, default=200, help="一致性檢查取樣的文件數")
+    parser.add_argument("--queries", type=int, default=50, help="延遲量測使用的查詢數")
+    parser.add_argument("--query-chars", type=int, default=40, help="以文件前 N 個字元作為查詢")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="平均餘弦相似度低於此值時以非零狀態結束")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args), ensure_ascii=False))
+        return
+
+    results, failed = [], False
+    for backend in args.backends:
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", backend,
+               "--persist-dir", args.persist_dir, "--collection-name", args.collection_name, "--model", args.model,
+               "--threads", str(args.threads), "--sample", str(args.sample), "--queries", str(args.queries),
+               "--query-chars", str(args.query_chars), "--repeat", str(args.repeat)]
+        if args.onnx_dir: cmd += ["--onnx-dir", args.onnx_dir]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ {backend} 量測失敗:\n{proc.stderr[-2000:]}", file=sys.stderr)
+            failed = True
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        parity = result["parity_vs_stored"]
+        if parity and parity["mean_cosine"] < args.min_cosine: failed = True
+
+    print(f"{'backend':<10} {'load(s)':>8} {'RSS(MB)':>8} {'p50(ms)':>8} {'p95(ms)':>8} {'docs/s':>8} {'cos mean':>9} {'cos p5':>8} {'cos min':>8}")
+    for r in results:
+        lat, parity = r["query_latency_ms"], r["parity_vs_stored"] or {}
+        print(f"{r['backend']:<10} {r['load_seconds']:>8} {r['rss_mb_loaded']:>8} {lat['p50']:>8} {lat['p95']:>8} "
+              f"{parity.get('docs_per_second', '-'):>8} {parity.get('mean_cosine', '-'):>9} {parity.get('p5_cosine', '-'):>8} {parity.get('min_cosine', '-'):>8}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+分片檢索效能基準 (Sharded Search Benchmark)
+
+以合成的向量語料 (每份文件數個相近的片段，分布在多個主題群集中) 比較不同語料大小下，
+單一 collection 與 1 / 2 / 4 / 8 個分片的「候選查詢 + MMR」延遲 (與後端 _mmr_search 相同的步驟)：
+- unsharded        目前的做法：單一 collection 取 top fetch_k 後 MMR
+- N shards         ShardedVectorStore：各分片平行取 top fetch_k，合併後 MMR (--executor process | thread)
+另以暴力搜尋算出精確的 top fetch_k，回報各設定的候選召回率 (HNSW 近似誤差 + 合併是否遺漏)。
+
+語料只建立一次並保留在 --work-dir，重複執行時直接沿用 (加 --rebuild 重建)。不需要嵌入模型。
+
+範例：
+    python benchmark_sharded_search.py --sizes 20000 100000 500000 --shards 1 2 4 8 --concurrency 1 8 --output shard_bench.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from sharded_search import ShardedVectorStore, merge_shard_candidates, shard_collection_name, shard_for_doc
+
+BASELINE_COLLECTION = "unsharded"
+ADD_BATCH_SIZE = 5000
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def synthetic_corpus(size: int, dim: int, chunks_per_doc: int, seed: int):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(size // 200, 8), dim)).astype(np.float32)
+    doc_count = (size + chunks_per_doc - 1) // chunks_per_doc
+    doc_vectors = centers[rng.integers(0, len(centers), doc_count)] + 0.6 * rng.standard_normal((doc_count, dim)).astype(np.float32)
+    doc_index = np.arange(size) // chunks_per_doc
+    vectors = doc_vectors[doc_index] + 0.3 * rng.standard_normal((size, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"doc{d}::{i % chunks_per_doc}" for i, d in enumerate(doc_index)]
+    metadatas = [{"doc_id": f"doc{d}", "doc_type": "longform"} for d in doc_index]
+    return vectors, ids, metadatas
+
+
+def build_collections(client, size: int, shard_counts: List[int], args):
+    vectors, ids, metadatas = synthetic_corpus(size, args.dim, args.chunks_per_doc, args.seed)
+    existing = {c.name if hasattr(c, "name") else c for c in client.list_collections()}
+    targets = [(BASELINE_COLLECTION, None)] + [(shard_collection_name(f"s{n}", i), (n, i)) for n in shard_counts for i in range(n)]
+    for name, shard in targets:
+        if name in existing and not args.rebuild:
+            continue
+        if name in existing: client.delete_collection(name)
+        collection = client.create_collection(name, metadata={"hnsw:space": "l2"})
+        positions = [p for p in range(size) if shard is None or shard_for_doc(metadatas[p]["doc_id"], shard[0]) == shard[1]]
+        start = time.time()
+        for offset in range(0, len(positions), ADD_BATCH_SIZE):
+            batch = positions[offset:offset + ADD_BATCH_SIZE]
+            collection.add(ids=[ids[p] for p in batch], embeddings=vectors[batch], metadatas=[metadatas[p] for p in batch],
+                           documents=[ids[p] for p in batch])
+        print(f"  🏗️ {name}: {len(positions)} 個片段 ({time.time() - start:.1f}s)", file=sys.stderr)
+    return vectors, ids
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int) -> np.ndarray:
+    # 以語料中的片段加上雜訊當作查詢，模擬「問題與某些片段相近」的情況
+    rng = np.random.default_rng(seed + 1)
+    queries = vectors[rng.integers(0, len(vectors), count)] + 0.5 * rng.standard_normal((count, vectors.shape[1])).astype(np.float32) / np.sqrt(vectors.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def run_config(search, queries: np.ndarray, exact: List[set], args, concurrency: int) -> Dict:
+    from langchain_chroma.vectorstores import maximal_marginal_relevance
+
+    def one(index: int):
+        query = queries[index].tolist()
+        start = time.perf_counter()
+        results = search(query)
+        candidates = results["embeddings"][0] if results["embeddings"] else []
+        if len(candidates): maximal_marginal_relevance(np.array(query, dtype=np.float32), candidates, k=args.k, lambda_mult=0.4)
+        latency = (time.perf_counter() - start) * 1000
+        return latency, len(set(results["ids"][0]) & exact[index]) / max(len(exact[index]), 1)
+
+    for index in range(min(5, len(queries))): one(index)  # 預熱 (開啟分片、載入 HNSW 索引)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(len(queries))))
+    wall = time.perf_counter() - start
+    latencies = [o[0] for o in outcomes]
+    return {"p50_ms": round(percentile(latencies, 0.5), 2), "p95_ms": round(percentile(latencies, 0.95), 2),
+            "mean_ms": round(statistics.mean(latencies), 2), "qps": round(len(queries) / wall, 1),
+            "recall_at_fetch_k": round(statistics.mean(o[1] for o in outcomes), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較不同語料大小與分片數的檢索延遲")
+    parser.add_argument("--work-dir", default="shard_benchmark_data", help="合成語料的 Chroma 資料夾 (重複執行時沿用)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20000, 100000], help="語料片段數")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--executor", choices=["process", "thread"], default="process", help="分片查詢使用 process pool 或執行緒")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1], help="同時查詢數 (模擬多個請求同時檢索)")
+    parser.add_argument("--dim", type=int, default=1024, help="向量維度 (bge-m3 為 1024)")
+    parser.add_argument("--chunks-per-doc", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--fetch-k", type=int, default=30)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--output", default=None, help="結果另存為 JSON")
+    args = parser.parse_args()
+
+    import chromadb
+    rows = []
+    for size in args.sizes:
+        size_dir = Path(args.work_dir) / f"size_{size}"
+        size_dir.mkdir(parents=True, exist_ok=True)
+        client = chromadb.PersistentClient(path=str(size_dir))
+        print(f"📦 語料 {size} 個片段 ({size_dir})", file=sys.stderr)
+        vectors, ids = build_collections(client, size, args.shards, args)
+        queries = make_queries(vectors, args.queries, args.seed)
+        exact = [{ids[i] for i in np.argsort(-(vectors @ q))[:args.fetch_k]} for q in queries]
+        baseline = client.get_collection(BASELINE_COLLECTION)
+
+        def search_unsharded(query):
+            results = baseline.query(query_embeddings=[query], n_results=args.fetch_k, include=["metadatas", "documents", "embeddings"])
+            return merge_shard_candidates(query, [{"ids": results["ids"][0], "documents": results["documents"][0], "metadatas": results["metadatas"][0],
+                                                   "embeddings": np.asarray(results["embeddings"][0], dtype=np.float32)}], args.fetch_k)
+
+        configs = [("unsharded", 1, search_unsharded, None)]
+        for n in args.shards:
+            store = ShardedVectorStore(size_dir, None, {"collections": [shard_collection_name(f"s{n}", i) for i in range(n)]},
+                                       processes=n if args.executor == "process" else 0)
+            configs.append((f"{n} shards", n, lambda query, store=store: store.query_candidates(query, args.fetch_k), store))
+        for label, shards, search, store in configs:
+            for concurrency in args.concurrency:
+                result = run_config(search, queries, exact, args, concurrency)
+                rows.append({"corpus_size": size, "config": label, "shards": shards, "executor": None if store is None else args.executor,
+                             "concurrency": concurrency, **result})
+                print(f"  {label:<10} 並行 {concurrency:<3} p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+                      f"{result['qps']:>7.1f} qps  召回 {result['recall_at_fetch_k']:.3f}", file=sys.stderr)
+            if store is not None: store.close()
+
+    print(f"\n{'片段數':>10} {'設定':<12} {'並行':>4} {'p50 ms':>9} {'p95 ms':>9} {'qps':>8} {'召回率':>7}")
+    for row in rows:
+        print(f"{row['corpus_size']:>10} {row['config']:<12} {row['concurrency']:>4} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['qps']:>8.1f} {row['recall_at_fetch_k']:>7.3f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+        print(f"\n已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+聊天記錄冷儲存 (Chat Archive)
+
+長時間未使用的聊天從 chats_metadata.json 與 chat_messages/ 移到每個用戶自己的壓縮封存：
+    <用戶資料夾>/archive/chats.zip            每次封存附加一個 <chat_id>.<時間戳>.json 項目 ({"metadata": ..., "messages": [...]})，ZIP_DEFLATED 壓縮
+    <用戶資料夾>/archive/archived_chats.json  封存索引 (chat_id -> 標題、時間、訊息數、zip 項目名稱)，列出封存聊天時不需解壓縮
+
+封存以 zip 附加模式寫入新項目，還原只從索引移除；不在索引中的舊項目累積超過 COMPACT_MIN_STALE_ENTRIES 個
+且多於存活項目時才重寫整個 zip (寫入暫存檔後 os.replace) 清除。刪除聊天 (purge=True) 會立即重寫，不留下已刪除的內容。
+呼叫端負責在用戶的聊天檔案鎖內操作，且會做檔案 I/O，不應在事件迴圈上直接呼叫；
+寫入順序為 zip -> 索引 -> 熱資料，任一步中斷時熱資料仍然完整。
+"""
+import json
+import os
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+COMPACT_MIN_STALE_ENTRIES = 32
+
+
+class ChatArchive:
+    def __init__(self, user_dir: Path):
+        self.dir = user_dir / "archive"
+        self.zip_path = self.dir / "chats.zip"
+        self.index_path = self.dir / "archived_chats.json"
+
+    def index(self) -> Dict[str, Dict]:
+        try:
+            with open(self.index_path, encoding="utf-8") as f: return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __contains__(self, chat_id: str) -> bool:
+        return self.index_path.exists() and chat_id in self.index()
+
+    def sizes(self) -> Dict[str, int]:
+        return {"chats": len(self.index()), "bytes": self.zip_path.stat().st_size if self.zip_path.exists() else 0}
+
+    def archive(self, chats: Dict[str, Tuple[Dict, List[Dict]]]):
+        """chats: chat_id -> (元數據, 訊息列表)；同 ID 的舊封存會被取代"""
+        if not chats: return
+        index = self.index()
+        now = datetime.now()
+        stamp = now.strftime("%Y%m%d%H%M%S%f")
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(self.zip_path, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+            for chat_id, (meta, messages) in chats.items():
+                entry = f"{chat_id}.{stamp}.json"
+                zf.writestr(entry, json.dumps({"metadata": meta, "messages": messages}, ensure_ascii=False))
+                index[chat_id] = {"title": meta.get("title", "無標題"), "created_at": meta.get("created_at", ""),
+                                  "updated_at": meta.get("updated_at", ""), "archived_at": now.isoformat(),
+                                  "messages": len(messages), "entry": entry}
+        self._write_index(index)
+        self._maybe_compact(index)
+
+    def load(self, chat_id: str) -> Optional[Tuple[Dict, List[Dict]]]:
+        """讀出封存的聊天 (不移除)；還原時呼叫端先寫回熱資料，再呼叫 discard"""
+        meta = self.index().get(chat_id)
+        if meta is None: return None
+        with zipfile.ZipFile(self.zip_path) as zf:
+            entry = json.loads(zf.read(self._entry_name(chat_id, meta)).decode("utf-8"))
+        return entry["metadata"], entry["messages"]
+
+    def discard(self, chat_id: str, purge: bool = False) -> bool:
+        """從索引移除；zip 中的項目留待壓縮時清除，purge=True (刪除聊天) 時立即重寫 zip"""
+        index = self.index()
+        if index.pop(chat_id, None) is None: return False
+        self._write_index(index)
+        if purge: self._compact(index)
+        else: self._maybe_compact(index)
+        return True
+
+    @staticmethod
+    def _entry_name(chat_id: str, meta: Dict) -> str:
+        return meta.get("entry") or f"{chat_id}.json"  # 未記錄 entry 的是舊格式 (每個聊天固定一個項目)
+
+    def _maybe_compact(self, index: Dict[str, Dict]):
+        if not self.zip_path.exists(): return
+        with zipfile.ZipFile(self.zip_path) as zf:
+            stale = len(zf.namelist()) - len(index)
+        if stale >= COMPACT_MIN_STALE_ENTRIES and stale > len(index): self._compact(index)
+
+    def _compact(self, index: Dict[str, Dict]):
+        if not index:
+            self.zip_path.unlink(missing_ok=True)
+            return
+        keep = {self._entry_name(chat_id, meta) for chat_id, meta in index.items()}
+        tmp_path = self.dir / f".chats.zip.{os.getpid()}.tmp"
+        with zipfile.ZipFile(self.zip_path) as old, zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as out:
+            for info in old.infolist():
+                if info.filename in keep: out.writestr(info, old.read(info))
+        os.replace(tmp_path, self.zip_path)
+
+    def _write_index(self, index: Dict[str, Dict]):
+        if not index:
+            self.index_path.unlink(missing_ok=True)
+            return
+        tmp_path = self.dir / f".{self.index_path.name}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
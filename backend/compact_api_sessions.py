@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+清理公開 API 的一次性 session (Compact One-off Public API Sessions)
+
+公開 API 未帶 session_id 時會產生 api_<用戶>_<毫秒>_<亂數> 的 session；在加入 stateless 模式前，每次呼叫都會
+在 user_specific_chat_data/<用戶>/ 留下一筆 chats_metadata.json 記錄與一個訊息檔。此工具移除符合以下條件的 session：
+- session ID 符合自動產生的格式 (用戶端自行指定的 session 不會被移除)
+- 問答輪數不超過 --max-turns (預設 1；用戶端沿用自動產生的 ID 繼續對話的 session 會保留)
+- 最後更新時間早於 --min-age-hours 小時前
+同時移除沒有元數據記錄的訊息檔 (同樣只限自動產生的 ID 且超過最短保留時間)。問答內容仍保留在 QA 記錄中；
+需要時可用 --archive-dir 先將移除的 session 寫成 JSONL。
+
+預設只列出會移除的內容，加上 --apply 才會實際修改；每個用戶在與伺服器相同的檔案鎖內處理，可在服務運作中執行。
+
+範例：
+    python compact_api_sessions.py                                  # 試算
+    python compact_api_sessions.py --apply --archive-dir api_session_archive
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from filelock import FileLock, Timeout as FileLockTimeout
+
+GENERATED_SESSION_RE = re.compile(r"^api_[^_]{1,10}_\d{13}_\d{5}$")
+
+
+def _write_json_atomic(target: Path, data):
+    tmp_file = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, target)
+
+
+def _load_json(path: Path, default):
+    try:
+        with open(path, encoding="utf-8") as f: return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _age_hours(timestamp: Optional[str], fallback_path: Path, now: float) -> float:
+    try:
+        return (now - datetime.fromisoformat(timestamp).timestamp()) / 3600
+    except (TypeError, ValueError):
+        return (now - fallback_path.stat().st_mtime) / 3600 if fallback_path.exists() else float("inf")
+
+
+def _turns(messages: List[Dict]) -> int:
+    return sum(1 for m in messages if m.get("role") == "user")
+
+
+def find_removable(user_dir: Path, max_turns: int, min_age_hours: float, now: float) -> Dict:
+    metadata = _load_json(user_dir / "chats_metadata.json", {})
+    messages_dir = user_dir / "chat_messages"
+    sessions, skipped = [], {"multi_turn": 0, "too_recent": 0}
+    for session_id, meta in metadata.items():
+        if not GENERATED_SESSION_RE.match(session_id): continue
+        message_file = messages_dir / f"{session_id}.json"
+        messages = _load_json(message_file, [])
+        if _turns(messages) > max_turns:
+            skipped["multi_turn"] += 1
+        elif _age_hours(meta.get("updated_at"), message_file, now) < min_age_hours:
+            skipped["too_recent"] += 1
+        else:
+            sessions.append({"session_id": session_id, "metadata": meta, "messages": messages, "file": message_file})
+    orphans = []
+    if messages_dir.is_dir():
+        for message_file in messages_dir.glob("api_*.json"):
+            session_id = message_file.stem
+            if session_id in metadata or not GENERATED_SESSION_RE.match(session_id): continue
+            if (now - message_file.stat().st_mtime) / 3600 < min_age_hours: continue
+            orphans.append(message_file)
+    return {"metadata": metadata, "sessions": sessions, "orphans": orphans, "skipped": skipped}
+
+
+def archive_sessions(archive_dir: Path, user: str, sessions: List[Dict]):
+    target = archive_dir / user / f"api_sessions_{datetime.now().strftime('%Y-%m-%d')}.jsonl"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target, "a", encoding="utf-8") as f:
+        for s in sessions:
+            f.write(json.dumps({"session_id": s["session_id"], "metadata": s["metadata"], "messages": s["messages"]}, ensure_ascii=False) + "\n")
+
+
+def compact_user(user_dir: Path, args, now: float) -> Dict:
+    found = find_removable(user_dir, args.max_turns, args.min_age_hours, now)
+    sessions, orphans = found["sessions"], found["orphans"]
+    metadata_file = user_dir / "chats_metadata.json"
+    result = {"sessions": len(sessions), "orphan_files": len(orphans), **found["skipped"],
+              "metadata_bytes_before": metadata_file.stat().st_size if metadata_file.exists() else 0,
+              "freed_bytes": sum(s["file"].stat().st_size for s in sessions if s["file"].exists()) + sum(p.stat().st_size for p in orphans)}
+    if not args.apply or not (sessions or orphans): return result
+    if args.archive_dir: archive_sessions(Path(args.archive_dir), user_dir.name, sessions)
+    removed = {s["session_id"] for s in sessions}
+    _write_json_atomic(metadata_file, {k: v for k, v in found["metadata"].items() if k not in removed})
+    for path in [s["file"] for s in sessions] + orphans:
+        path.unlink(missing_ok=True)
+    result["metadata_bytes_after"] = metadata_file.stat().st_size
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="移除公開 API 留下的一次性 session")
+    parser.add_argument("--data-dir", default="user_specific_chat_data")
+    parser.add_argument("--locks-dir", default=os.environ.get("LOCKS_DIR", "locks"), help="與伺服器的 LOCKS_DIR 相同")
+    parser.add_argument("--user-prefix", default="", help="只處理此前綴的用戶 (例如 api_consumer_)；預設全部，只會移除自動產生的 session")
+    parser.add_argument("--max-turns", type=int, default=1, help="問答輪數不超過此值才移除")
+    parser.add_argument("--min-age-hours", type=float, default=24, help="最後更新超過此時數才移除")
+    parser.add_argument("--archive-dir", default=None, help="移除前將 session 寫入 <archive-dir>/<用戶>/api_sessions_<日期>.jsonl")
+    parser.add_argument("--lock-timeout", type=float, default=30)
+    parser.add_argument("--apply", action="store_true", help="實際移除；未指定時只列出")
+    args = parser.parse_args()
+
+    data_dir = Path(args.data_dir)
+    if not data_dir.is_dir():
+        sys.exit(f"❌ 找不到聊天資料夾: {data_dir}")
+    Path(args.locks_dir).mkdir(parents=True, exist_ok=True)
+    now, totals = time.time(), {"users": 0, "sessions": 0, "orphan_files": 0, "freed_bytes": 0}
+    for user_dir in sorted(p for p in data_dir.iterdir() if p.is_dir() and p.name.startswith(args.user_prefix)):
+        try:
+            with FileLock(str(Path(args.locks_dir) / f"chat_{user_dir.name}.lock"), timeout=args.lock_timeout):
+                result = compact_user(user_dir, args, now)
+        except FileLockTimeout:
+            print(f"⚠️ {user_dir.name}: 無法取得檔案鎖，略過", file=sys.stderr)
+            continue
+        if not (result["sessions"] or result["orphan_files"]): continue
+        totals["users"] += 1
+        for key in ("sessions", "orphan_files", "freed_bytes"): totals[key] += result[key]
+        after = f" -> {result['metadata_bytes_after'] / 1024:.1f} KB" if "metadata_bytes_after" in result else ""
+        print(f"{'🧹' if args.apply else '🔍'} {user_dir.name}: session {result['sessions']}、孤立訊息檔 {result['orphan_files']}，"
+              f"保留 (多輪 {result['multi_turn']}、近期 {result['too_recent']})，chats_metadata.json {result['metadata_bytes_before'] / 1024:.1f} KB{after}")
+    print(f"\n{'已移除' if args.apply else '可移除'}: {totals['users']} 個用戶、{totals['sessions']} 個 session、{totals['orphan_files']} 個孤立訊息檔，"
+          f"{totals['freed_bytes'] / 1024 / 1024:.2f} MB")
+    if not args.apply and totals["sessions"] + totals["orphan_files"]: print("加上 --apply 實際移除")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+比較完整版與精簡版提示模板 (Prompt Template Variant Comparison)
+
+對同一批問題、同樣的檢索結果與對話記錄，分別以 full / compact 兩種模板直接呼叫 Ollama，比較：
+- 提示詞 token (prompt_accounting 各區段估計值，以及 Ollama 回報的 prompt_eval_count)
+- 預填時間 (prompt_eval_duration) 與總生成時間
+- 格式遵循率：依模板檢查輸出 (結構化列表的標題與 100 個句點分隔線、層級式的 Markdown 標題與條列、
+  段落風格的表情符號開頭、自訂格式的使用者標籤、研究模式的報告標題)；回答「無法回答」視為遵循
+
+問題來源：--questions 檔案 (每行一題) 或 QA 記錄 (--logs-dir，取最近 --limit 題不重複的問題)。
+檢索與模板直接取自 6_10test (需在後端目錄執行，會載入嵌入模型與向量資料庫)。
+Ollama 會重用相同前綴的 KV cache；預設在提示詞最前面加上隨機字串 (--cache cold)，量到的是完整預填時間。
+
+範例：
+    python compare_prompt_variants.py --model gemma3:12b --limit 30 --repeats 2 --output prompt_variants.json
+"""
+import argparse
+import importlib
+import json
+import random
+import re
+import statistics
+import sys
+import time
+import urllib.request
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from prompt_accounting import prompt_token_breakdown
+from replay_qa_logs import percentile
+
+STRUCTURED_LIST_HEADING = re.compile(r"^\*\*[一二三四五六七八九十]+、.+\*\*$", re.MULTILINE)
+STRUCTURED_LIST_SEPARATOR = re.compile(r"^\.{100}$", re.MULTILINE)
+MARKDOWN_HEADING = re.compile(r"^#{1,3} \S", re.MULTILINE)
+BULLET_LINE = re.compile(r"^\s*(?:[*\-]|\d+\.)\s+\S", re.MULTILINE)
+WORD_CHAR = re.compile(r"[\w「『（(*#\-]")
+FORMAT_LABEL = re.compile(r"^\s*([^\s:：\[\]]{1,20})\s*[:：]", re.MULTILINE)
+ECHO_MARKERS = ("<CONTEXT>", "</CONTEXT>", "<QUESTION>", "**--- ", "👇 **")
+REFUSAL = "無法回答"
+
+
+def check_compliance(template_key: str, answer: str, question: str, format_mode: str) -> bool:
+    answer = answer.strip()
+    if not answer or any(marker in answer for marker in ECHO_MARKERS): return False
+    if REFUSAL in answer[:120]: return True
+    paragraphs = [p.strip() for p in answer.split("\n\n") if p.strip()]
+    if template_key == "structured_list":
+        headings = len(STRUCTURED_LIST_HEADING.findall(answer))
+        return headings > 0 and headings == len(STRUCTURED_LIST_SEPARATOR.findall(answer)) and not MARKDOWN_HEADING.search(answer)
+    if template_key == "hierarchical_bullets":
+        return bool(MARKDOWN_HEADING.search(answer)) and bool(BULLET_LINE.search(answer))
+    if template_key == "paragraph_emoji_lead":
+        return (all(not WORD_CHAR.match(p[0]) for p in paragraphs)
+                and not BULLET_LINE.search(answer) and not MARKDOWN_HEADING.search(answer))
+    if template_key == "custom_format":
+        # 問題中「標籤: 」形式的格式說明，每個標籤都要出現在回答中
+        labels = {label for label in FORMAT_LABEL.findall(question.split("格式", 1)[-1]) if label not in ("格式", "如下")}
+        return all(re.search(rf"^\s*{re.escape(label)}\s*[:：]", answer, re.MULTILINE) for label in labels) if labels else True
+    if template_key == "research":
+        return format_mode == "custom" or bool(MARKDOWN_HEADING.search(answer))
+    return True
+
+
+def load_questions(args) -> List[str]:
+    if args.questions:
+        return [line.strip() for line in Path(args.questions).read_text(encoding="utf-8").splitlines() if line.strip()][:args.limit]
+    seen, questions = set(), []
+    logs_dir = Path(args.logs_dir)
+    files = sorted(logs_dir.glob("*/qa_log_*.jsonl"), key=lambda p: p.name, reverse=True) if logs_dir.is_dir() else []
+    for log_file in files:
+        if log_file.parent.name.startswith(args.exclude_prefix): continue
+        for line in reversed(log_file.read_text(encoding="utf-8").splitlines()):
+            try:
+                question = json.loads(line).get("question")
+            except ValueError:
+                continue
+            if question and question not in seen:
+                seen.add(question)
+                questions.append(question)
+            if len(questions) >= args.limit: return questions
+    return questions
+
+
+def ollama_generate(host: str, model: str, prompt: str, options: Dict, timeout: float) -> Dict:
+    payload = json.dumps({"model": model, "prompt": prompt, "stream": False, "options": options}).encode("utf-8")
+    req = urllib.request.Request(f"{host}/api/generate", data=payload, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+
+def run_case(rag, args, template_key: str, variant: str, template, prompt_input: Dict) -> Dict:
+    prompt = template.format(**prompt_input)
+    if args.cache == "cold": prompt = f"[{uuid.uuid4().hex}]\n{prompt}"
+    stops = (rag.COMPACT_TEMPLATE_STOP_SEQUENCES if variant == "compact" else rag.TEMPLATE_STOP_SEQUENCES)[template_key]
+    options = {**rag.common_llm_config, "num_predict": rag.TEMPLATE_NUM_PREDICT.get(template_key, -1), "stop": stops}
+    start = time.time()
+    result = ollama_generate(args.ollama_host, args.model, prompt, options, args.timeout)
+    answer = rag.post_process_answer(result.get("response", ""), format_mode=prompt_input["format_mode"])
+    return {
+        "template": template_key, "variant": variant,
+        "estimated_prompt_tokens": sum(prompt_token_breakdown(template.template, prompt_input).values()),
+        "prompt_eval_count": result.get("prompt_eval_count"), "prefill_seconds": (result.get("prompt_eval_duration") or 0) / 1e9,
+        "output_tokens": result.get("eval_count"), "seconds": time.time() - start, "done_reason": result.get("done_reason"),
+        "compliant": check_compliance(template_key, answer, prompt_input["question"], prompt_input["format_mode"]),
+        "question": prompt_input["question"], "answer": answer,
+    }
+
+
+def _p50(values: List[float]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 3) if values else None
+
+
+def summarize(results: List[Dict]) -> Dict:
+    grouped = defaultdict(list)
+    for r in results: grouped[(r["template"], r["variant"])].append(r)
+    summary = {}
+    for (template_key, variant), rows in sorted(grouped.items()):
+        summary.setdefault(template_key, {})[variant] = {
+            "runs": len(rows), "estimated_prompt_tokens_p50": _p50([r["estimated_prompt_tokens"] for r in rows]),
+            "prompt_eval_count_p50": _p50([r["prompt_eval_count"] for r in rows]),
+            "prefill_seconds_p50": _p50([r["prefill_seconds"] for r in rows]),
+            "prefill_seconds_p90": round(percentile([r["prefill_seconds"] for r in rows], 0.9), 3),
+            "output_tokens_p50": _p50([r["output_tokens"] for r in rows]), "seconds_p50": _p50([r["seconds"] for r in rows]),
+            "compliance_rate": round(sum(r["compliant"] for r in rows) / len(rows), 3),
+            "truncated": sum(r["done_reason"] == "length" for r in rows),
+            "non_compliant_samples": [{"question": r["question"][:120], "answer": r["answer"][:300]} for r in rows if not r["compliant"]][:3],
+        }
+    return summary
+
+
+def print_report(summary: Dict):
+    print(f"\n{'模板':<22}{'variant':<9}{'runs':>5}{'prompt tok':>11}{'prefill p50':>12}{'out tok':>9}{'total p50':>10}{'遵循率':>8}")
+    for template_key, variants in summary.items():
+        for variant, v in variants.items():
+            print(f"{template_key:<22}{variant:<9}{v['runs']:>5}{str(v['prompt_eval_count_p50']):>11}{str(v['prefill_seconds_p50']):>12}"
+                  f"{str(v['output_tokens_p50']):>9}{str(v['seconds_p50']):>10}{v['compliance_rate']:>9.1%}")
+        full, compact = variants.get("full"), variants.get("compact")
+        if full and compact and full["prefill_seconds_p50"] and compact["prefill_seconds_p50"] is not None:
+            saved = 1 - compact["prefill_seconds_p50"] / full["prefill_seconds_p50"]
+            print(f"{'':<22}→ compact 預填時間節省 {saved:.1%}，遵循率變化 {compact['compliance_rate'] - full['compliance_rate']:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較完整版與精簡版提示模板的預填時間與格式遵循率")
+    parser.add_argument("--questions", default=None, help="問題檔 (每行一題)；未指定時取自 QA 記錄")
+    parser.add_argument("--logs-dir", default="user_specific_qa_logs")
+    parser.add_argument("--exclude-prefix", default="replay_", help="略過此前綴的用戶 (重播產生的記錄)")
+    parser.add_argument("--limit", type=int, default=20, help="問題數")
+    parser.add_argument("--templates", nargs="+", default=None, help="模板 key；預設全部 (custom_format 只用於自訂格式的問題)")
+    parser.add_argument("--model", default=None, help="預設為 6_10test.DEFAULT_MODEL")
+    parser.add_argument("--ollama-host", default=None, help="預設為 OLLAMA_HOST")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--cache", choices=["cold", "warm"], default="cold", help="cold：每次都完整預填；warm：允許重用 KV cache")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="將完整結果寫入 JSON 檔")
+    args = parser.parse_args()
+
+    rag = importlib.import_module("6_10test")
+    args.model = args.model or rag.DEFAULT_MODEL
+    args.ollama_host = (args.ollama_host or rag.OLLAMA_HOST).rstrip("/")
+    templates = {key: template for template, key in rag.TEMPLATE_KEYS if key in rag.COMPACT_TEMPLATE_VARIANTS}
+    selected = args.templates or list(templates)
+    unknown = set(selected) - set(templates)
+    if unknown: sys.exit(f"❌ 未知的模板: {sorted(unknown)}")
+    questions = load_questions(args)
+    if not questions: sys.exit("❌ 沒有可用的問題")
+
+    snapshot_id = rag._initial_snapshot_id()
+    snapshot_dir = rag._resolve_snapshot_dir(snapshot_id)
+    if snapshot_dir is None: sys.exit(f"❌ 找不到向量資料庫快照 '{snapshot_id}'")
+    db = rag._load_vectordb_snapshot(snapshot_dir)
+    print(f"📚 向量資料庫快照: {snapshot_id}，問題數: {len(questions)}，模型: {args.model}，Ollama: {args.ollama_host}，cache: {args.cache}")
+
+    rng = random.Random(args.seed)
+    results = []
+    for index, question in enumerate(questions, 1):
+        docs, _, _ = rag._mmr_search(db, question)
+        format_mode = rag.detect_format_mode(question)
+        prompt_input = {"context": "\n\n".join(d.page_content for d in docs) or "沒有找到相關的背景資料。",
+                        "question": question, "history": "無歷史對話紀錄。", "format_mode": format_mode}
+        for template_key in selected:
+            if (template_key == "custom_format") != (format_mode == "custom") and template_key != "research": continue
+            for _ in range(args.repeats):
+                # 兩種版本的順序隨機，避免固定的先後順序影響量測
+                variants = [("full", templates[template_key]), ("compact", rag.COMPACT_TEMPLATE_VARIANTS[template_key])]
+                rng.shuffle(variants)
+                for variant, template in variants:
+                    try:
+                        results.append(run_case(rag, args, template_key, variant, template, prompt_input))
+                    except Exception as e:
+                        print(f"⚠️ {template_key}/{variant} 失敗: {type(e).__name__}: {e}", file=sys.stderr)
+        print(f"   {index}/{len(questions)} 完成", file=sys.stderr)
+
+    summary = summarize(results)
+    print_report(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "cache": args.cache, "questions": len(questions), "summary": summary, "runs": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+嵌入模型後端 (Embedding Backends)
+
+以環境變數 EMBEDDING_BACKEND 選擇查詢 / 文件嵌入的實作：
+- torch      ：HuggingFaceEmbeddings (sentence-transformers, fp32)，預設值
+- onnx       ：ONNX Runtime 執行匯出的 fp32 模型
+- onnx-int8  ：ONNX Runtime 執行動態量化 (int8) 的模型，適合只有 CPU 的節點
+
+ONNX 模型請先以 export_onnx_embedding.py 匯出至 EMBEDDING_ONNX_DIR。
+EMBEDDING_NUM_THREADS 控制 CPU 推論執行緒數 (torch.set_num_threads / ORT intra-op threads)，
+多 worker 部署時建議設為「核心數 / worker 數」，避免執行緒互相搶佔。
+
+設定 EMBEDDING_SERVICE_URL (例如 http://127.0.0.1:8765) 時改用 embedding_server.py 提供的共用嵌入服務，
+所有 worker 共用同一份模型；服務無法連線時才在本程序內載入模型作為備援。
+"""
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_ONNX_DIR = os.environ.get("EMBEDDING_ONNX_DIR", "onnx_models/bge-m3")
+EMBEDDING_NUM_THREADS = int(os.environ.get("EMBEDDING_NUM_THREADS", "0"))  # 0 = 由函式庫自行決定
+EMBEDDING_MAX_LENGTH = int(os.environ.get("EMBEDDING_MAX_LENGTH", "8192"))  # 與 bge-m3 的 max_seq_length 相同
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_SERVICE_URL = os.environ.get("EMBEDDING_SERVICE_URL", "")
+EMBEDDING_SERVICE_TIMEOUT_SECONDS = float(os.environ.get("EMBEDDING_SERVICE_TIMEOUT_SECONDS", "10"))
+EMBEDDING_SERVICE_RETRY_SECONDS = float(os.environ.get("EMBEDDING_SERVICE_RETRY_SECONDS", "30"))
+SUPPORTED_EMBEDDING_BACKENDS = ["torch", "onnx", "onnx-int8"]
+ONNX_MODEL_FILENAMES = {"onnx": "model.onnx", "onnx-int8": "model_quantized.onnx"}
+
+
+class OnnxEmbeddings(Embeddings):
+    """以 ONNX Runtime 執行 bge-m3 的 dense 嵌入：取 [CLS] 向量並做 L2 正規化，與 sentence-transformers 的設定一致"""
+
+    def __init__(self, model_dir: str, model_filename: str = "model_quantized.onnx", num_threads: int = 0,
+                 max_length: int = EMBEDDING_MAX_LENGTH, batch_size: int = EMBEDDING_BATCH_SIZE):
+        import numpy as np
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = Path(model_dir) / model_filename
+        if not model_path.exists():
+            raise FileNotFoundError(f"找不到 ONNX 模型 {model_path}，請先執行 export_onnx_embedding.py")
+        self._np = np
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(str(Path(model_dir) / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        pad_token = "<pad>" if self.tokenizer.token_to_id("<pad>") is not None else "[PAD]"
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(str(model_path), sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.model_path = model_path
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        np = self._np
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + self.batch_size])
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            }
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+            last_hidden_state = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+            cls = last_hidden_state[:, 0]
+            cls = cls / np.clip(np.linalg.norm(cls, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(cls.astype(np.float32).tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+class RemoteEmbeddings(Embeddings):
+    """透過 embedding_server.py 的 HTTP 服務取得嵌入；服務異常時改用本程序內的模型，並在 retry_seconds 後再試服務"""
+
+    def __init__(self, service_url: str, model_name: str, fallback_factory: Callable[[], Embeddings],
+                 timeout: float = EMBEDDING_SERVICE_TIMEOUT_SECONDS, retry_seconds: float = EMBEDDING_SERVICE_RETRY_SECONDS):
+        self.service_url = service_url.rstrip("/")
+        self.model_name = model_name
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self._fallback_factory = fallback_factory
+        self._fallback: Optional[Embeddings] = None
+        self._fallback_lock = threading.Lock()
+        self._service_down_until = 0.0
+        self.stats = {"remote_calls": 0, "fallback_calls": 0, "remote_errors": 0}
+        health = self.health()
+        if health is None:
+            logger.warning(f"⚠️ 嵌入服務 {self.service_url} 無法連線，將使用本程序內的模型")
+            self._service_down_until = time.time() + self.retry_seconds
+        elif health.get("model") != model_name:
+            # 模型不同時向量空間不相容，寧可使用本地模型也不要混用
+            logger.error(f"❌ 嵌入服務模型 ({health.get('model')}) 與 EMBEDDING_MODEL ({model_name}) 不一致，停用嵌入服務")
+            self._service_down_until = float("inf")
+        else:
+            logger.info(f"✅ 使用共用嵌入服務 {self.service_url} (模型: {health.get('model')}, 後端: {health.get('backend')})")
+
+    def health(self) -> Optional[Dict]:
+        try:
+            with urllib.request.urlopen(f"{self.service_url}/health", timeout=min(self.timeout, 3)) as resp:
+                return json.loads(resp.read())
+        except (urllib.error.URLError, OSError, ValueError):
+            return None
+
+    @property
+    def using_service(self) -> bool:
+        return time.time() >= self._service_down_until
+
+    def _local(self) -> Embeddings:
+        with self._fallback_lock:
+            if self._fallback is None:
+                logger.warning("⚠️ 載入本程序內的嵌入模型作為備援")
+                self._fallback = self._fallback_factory()
+            return self._fallback
+
+    def _remote_embed(self, texts: List[str]) -> List[List[float]]:
+        body = json.dumps({"texts": texts}, ensure_ascii=False).encode("utf-8")
+        req = urllib.request.Request(f"{self.service_url}/embed", data=body, method="POST", headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.loads(resp.read())["embeddings"]
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if self.using_service:
+            try:
+                vectors = self._remote_embed(texts)
+                self.stats["remote_calls"] += 1
+                return vectors
+            except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+                self.stats["remote_errors"] += 1
+                self._service_down_until = time.time() + self.retry_seconds
+                logger.error(f"❌ 嵌入服務呼叫失敗，{self.retry_seconds:.0f}s 內改用本程序內的模型: {e}")
+        self.stats["fallback_calls"] += 1
+        return self._local().embed_documents(texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+def detect_device() -> str:
+    # 只在實際使用 torch 後端時才匯入 torch (onnx / 遠端嵌入服務的 worker 不需要載入 torch)
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
+
+def build_embeddings(model_name: str, device: Optional[str] = None, backend: Optional[str] = None,
+                     num_threads: Optional[int] = None, onnx_dir: Optional[str] = None,
+                     service_url: Optional[str] = None) -> Embeddings:
+    service_url = EMBEDDING_SERVICE_URL if service_url is None else service_url
+    if service_url:
+        return RemoteEmbeddings(service_url, model_name, fallback_factory=lambda: build_embeddings(
+            model_name, device=device, backend=backend, num_threads=num_threads, onnx_dir=onnx_dir, service_url=""))
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    num_threads = EMBEDDING_NUM_THREADS if num_threads is None else num_threads
+    if backend not in SUPPORTED_EMBEDDING_BACKENDS:
+        raise ValueError(f"不支援的 EMBEDDING_BACKEND '{backend}'，可用: {', '.join(SUPPORTED_EMBEDDING_BACKENDS)}")
+    if backend == "torch":
+        import torch
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        device = device or detect_device()
+        if num_threads > 0: torch.set_num_threads(num_threads)
+        logger.info(f"嵌入後端: torch (模型: {model_name}, 設備: {device}, 執行緒: {torch.get_num_threads()})")
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={"device": device},
+            encode_kwargs={"normalize_embeddings": True}
+        )
+    model_dir = onnx_dir or EMBEDDING_ONNX_DIR
+    logger.info(f"嵌入後端: {backend} (模型資料夾: {model_dir}, 執行緒: {num_threads or 'auto'})")
+    return OnnxEmbeddings(model_dir, model_filename=ONNX_MODEL_FILENAMES[backend], num_threads=num_threads)
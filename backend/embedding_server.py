@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+共用嵌入服務 (Shared Embedding Server)
+
+只載入一次嵌入模型，透過 loopback HTTP 提供給同一台機器上的所有 uvicorn worker 使用，
+避免每個 worker 各自持有一份模型。同一時間抵達的請求會合併成一個批次推論 (micro-batching)。
+
+端點：
+- POST /embed   {"texts": [...]} → {"embeddings": [[...], ...], "model": ...}
+- GET  /health  模型、後端、佇列深度與累計統計
+
+範例：
+    EMBEDDING_BACKEND=onnx-int8 EMBEDDING_NUM_THREADS=8 python embedding_server.py --port 8765
+    EMBEDDING_SERVICE_URL=http://127.0.0.1:8765 uvicorn 6_10test:app --workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from embedding_backends import EMBEDDING_BACKEND, build_embeddings
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("embedding_server")
+
+
+class PendingRequest:
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = threading.Event()
+        self.embeddings = None
+        self.error = None
+
+
+class MicroBatcher:
+    """收集 max_wait_ms 內抵達的請求，合併成最多 max_batch 段文字的批次後一次推論"""
+
+    def __init__(self, embedding, max_batch: int, max_wait_ms: float):
+        self.embedding = embedding
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue: "queue.Queue[PendingRequest]" = queue.Queue()
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "errors": 0, "embed_seconds": 0.0}
+        threading.Thread(target=self._run, daemon=True, name="embedding-batcher").start()
+
+    def submit(self, texts: List[str], timeout: float) -> List[List[float]]:
+        pending = PendingRequest(texts)
+        self.queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("embedding request timed out")
+        if pending.error is not None:
+            raise pending.error
+        return pending.embeddings
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0].texts)
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                size += len(pending.texts)
+            texts = [text for pending in batch for text in pending.texts]
+            start = time.time()
+            try:
+                vectors = self.embedding.embed_documents(texts)
+                offset = 0
+                for pending in batch:
+                    pending.embeddings = vectors[offset:offset + len(pending.texts)]
+                    offset += len(pending.texts)
+            except Exception as e:
+                logger.error(f"❌ 批次嵌入失敗 ({len(texts)} 段文字): {e}", exc_info=True)
+                self.stats["errors"] += 1
+                for pending in batch: pending.error = e
+            self.stats["requests"] += len(batch)
+            self.stats["texts"] += len(texts)
+            self.stats["batches"] += 1
+            self.stats["embed_seconds"] += time.time() - start
+            for pending in batch: pending.done.set()
+
+
+def make_handler(batcher: MicroBatcher, model_name: str, backend: str, dimension: int, request_timeout: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/health"):
+                stats = dict(batcher.stats)
+                stats["avg_batch_texts"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else 0
+                self._send_json({"status": "ok", "model": model_name, "backend": backend, "dimension": dimension,
+                                 "queue_depth": batcher.queue.qsize(), "pid": os.getpid(), "stats": stats})
+            else:
+                self._send_json({"error": f"unsupported path {self.path}"}, status=404)
+
+        def do_POST(self):
+            if not self.path.startswith("/embed"):
+                self._send_json({"error": f"unsupported path {self.path}"}, status=404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                texts = json.loads(self.rfile.read(length) or b"{}").get("texts")
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    raise ValueError("texts must be a list of strings")
+            except ValueError as e:
+                self._send_json({"error": str(e)}, status=400)
+                return
+            if not texts:
+                self._send_json({"embeddings": [], "model": model_name})
+                return
+            try:
+                self._send_json({"embeddings": batcher.submit(texts, request_timeout), "model": model_name})
+            except TimeoutError as e:
+                self._send_json({"error": str(e)}, status=504)
+            except Exception as e:
+                self._send_json({"error": str(e)}, status=500)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共用嵌入服務")
+    parser.add_argument("--host", default="127.0.0.1", help="只建議綁定 loopback；此服務沒有驗證機制")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--model", default=os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3"))
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, help="torch / onnx / onnx-int8 (預設: EMBEDDING_BACKEND)")
+    parser.add_argument("--device", default=None, help="預設: 有 CUDA 時使用 cuda")
+    parser.add_argument("--max-batch", type=int, default=64, help="每個批次最多的文字段數")
+    parser.add_argument("--max-wait-ms", type=float, default=5, help="湊批次時最多等待的毫秒數")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    embedding = build_embeddings(args.model, device=args.device, backend=args.backend, service_url="")
+    dimension = len(embedding.embed_query("測試嵌入模型"))
+    batcher = MicroBatcher(embedding, args.max_batch, args.max_wait_ms)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, args.model, args.backend, dimension, args.request_timeout))
+    logger.info(f"🧮 嵌入服務啟動於 http://{args.host}:{args.port} (模型: {args.model}, 後端: {args.backend}, 維度: {dimension})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+模型路由離線評估 (Offline Evaluation of Complexity Routing)
+
+對 user_specific_qa_logs 中的歷史請求套用路由規則，估計「全部送到預設等級的模型」(基準，即未啟用路由時) 與「依規則路由」的延遲差異：
+- 訊號：新記錄帶有 routing_signals；舊記錄由問題、format_mode_detected、prompt_mode_requested 與同 session 先前的記錄數重建
+  (沒有檢索分數，用到 retrieval_* 條件的規則對舊記錄不會符合)
+- 延遲：LLM 時間 = total_processing_time_seconds - retrieval_time_seconds；與記錄中的模型不同時，依兩個模型
+  在同一 prompt_mode 的 LLM 時間中位數比例換算；沒有足夠樣本時沿用記錄值並計入 unestimated
+- 報告：各等級 / 規則的請求數與節省秒數、基準與路由後的 p50 / p90 / p99，以及送往小模型的問題範例 (供人工檢查答案品質)
+
+範例：
+    python evaluate_model_router.py --since 2025-06-01 --rules my_rules.json --samples 10 --output router_eval.json
+"""
+import argparse
+import json
+import statistics
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from model_router import ComplexityRouter, load_rules, question_signals
+from replay_qa_logs import percentile
+
+DEFAULT_TIERS = {"small": "llama3:8b", "large": "gemma3:12b"}
+
+
+def load_qa_records(logs_dir: Path, since: Optional[str], until: Optional[str], exclude_prefix: str) -> List[Dict]:
+    records = []
+    for user_dir in sorted(p for p in logs_dir.iterdir() if p.is_dir()):
+        if exclude_prefix and user_dir.name.startswith(exclude_prefix): continue
+        for log_file in sorted(user_dir.glob("qa_log_*.jsonl")):
+            day = log_file.stem.replace("qa_log_", "")
+            if (since and day < since) or (until and day > until): continue
+            with open(log_file, encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                        record["_time"] = datetime.fromisoformat(record["timestamp"]).timestamp()
+                    except (ValueError, KeyError) as e:
+                        print(f"⚠️ 略過 {log_file}:{line_no}: {e}", file=sys.stderr)
+                        continue
+                    if record.get("cancelled") or not record.get("answer") or not record.get("model"): continue
+                    if record.get("total_processing_time_seconds") is None: continue
+                    record["_user"] = user_dir.name
+                    records.append(record)
+    records.sort(key=lambda r: r["_time"])
+    return records
+
+
+def record_signals(record: Dict, history_pairs: int) -> Dict:
+    if record.get("routing_signals"): return record["routing_signals"]
+    return question_signals(record["question"], record.get("format_mode_detected") or "default",
+                            record.get("prompt_mode_requested") or "default", history_pairs)
+
+
+def llm_seconds(record: Dict) -> float:
+    return max(record["total_processing_time_seconds"] - (record.get("retrieval_time_seconds") or 0.0), 0.0)
+
+
+def model_speed_table(records: List[Dict], min_samples: int) -> Dict:
+    """(模型, prompt_mode) -> LLM 時間中位數"""
+    grouped = defaultdict(list)
+    for record in records:
+        grouped[(record["model"], record.get("prompt_mode_requested") or "default")].append(llm_seconds(record))
+    return {key: statistics.median(values) for key, values in grouped.items() if len(values) >= min_samples}
+
+
+def estimate_seconds(record: Dict, model: str, speeds: Dict) -> Optional[float]:
+    """估計此請求改由 model 處理的總時間；無法換算時回傳 None"""
+    if model == record["model"]: return record["total_processing_time_seconds"]
+    prompt_mode = record.get("prompt_mode_requested") or "default"
+    source_speed, target_speed = speeds.get((record["model"], prompt_mode)), speeds.get((model, prompt_mode))
+    if not source_speed or not target_speed: return None
+    return record["total_processing_time_seconds"] - llm_seconds(record) * (1 - target_speed / source_speed)
+
+
+def _latency_stats(values: List[float]) -> Dict:
+    if not values: return {"count": 0}
+    return {"count": len(values), "mean": round(statistics.mean(values), 2), "p50": round(percentile(values, 0.5), 2),
+            "p90": round(percentile(values, 0.9), 2), "p99": round(percentile(values, 0.99), 2), "total": round(sum(values), 1)}
+
+
+def evaluate(records: List[Dict], router: ComplexityRouter, min_samples: int, samples_per_rule: int) -> Dict:
+    speeds = model_speed_table(records, min_samples)
+    baseline_model = router.tiers[router.default_tier]
+    session_turns = Counter()
+    baseline, routed, tier_counts = [], [], Counter()
+    by_rule = defaultdict(lambda: {"count": 0, "baseline_seconds": 0.0, "routed_seconds": 0.0, "samples": []})
+    unestimated, with_scores = 0, 0
+    for record in records:
+        session_key = (record["_user"], record.get("session_id"))
+        signals = record_signals(record, session_turns[session_key])
+        session_turns[session_key] += 1
+        if "retrieval_top_score" in signals: with_scores += 1
+        tier, target_model, rule = router.route(signals)
+        recorded_total = record["total_processing_time_seconds"]
+        baseline_total = estimate_seconds(record, baseline_model, speeds)
+        routed_total = estimate_seconds(record, target_model, speeds)
+        if baseline_total is None or routed_total is None: unestimated += 1
+        baseline_total = recorded_total if baseline_total is None else baseline_total
+        routed_total = recorded_total if routed_total is None else routed_total
+        baseline.append(baseline_total)
+        routed.append(routed_total)
+        stats = by_rule[f"{tier}:{rule or 'default'}"]
+        stats["count"] += 1
+        stats["baseline_seconds"] += baseline_total
+        stats["routed_seconds"] += routed_total
+        if len(stats["samples"]) < samples_per_rule:
+            stats["samples"].append({"question": record["question"][:120], "recorded_model": record["model"], "routed_model": target_model})
+        tier_counts[tier] += 1
+    top_scores = [r["routing_signals"]["retrieval_top_score"] for r in records if (r.get("routing_signals") or {}).get("retrieval_top_score") is not None]
+    return {
+        "baseline_model": baseline_model, "records": len(records), "records_with_retrieval_scores": with_scores, "unestimated": unestimated,
+        "tiers": {tier: {"count": n, "share": round(n / len(records), 3)} for tier, n in tier_counts.items()},
+        "baseline_latency": _latency_stats(baseline), "routed_latency": _latency_stats(routed),
+        "seconds_saved": round(sum(baseline) - sum(routed), 1),
+        "model_llm_seconds_p50": {f"{model}|{mode}": round(v, 2) for (model, mode), v in sorted(speeds.items())},
+        "retrieval_top_score_quantiles": {f"p{int(q * 100)}": round(percentile(top_scores, q), 3) for q in (0.1, 0.25, 0.5, 0.75, 0.9)} if top_scores else None,
+        "rules": {name: {**v, "baseline_seconds": round(v["baseline_seconds"], 1), "routed_seconds": round(v["routed_seconds"], 1),
+                         "seconds_saved": round(v["baseline_seconds"] - v["routed_seconds"], 1)} for name, v in sorted(by_rule.items())},
+    }
+
+
+def print_report(report: Dict):
+    print(f"\n📊 基準模型: {report['baseline_model']}，記錄數: {report['records']} (含檢索分數: {report['records_with_retrieval_scores']}, 無法換算延遲: {report['unestimated']})")
+    for tier, v in sorted(report["tiers"].items()): print(f"   {tier:<8} {v['count']:>6} ({v['share']:.1%})")
+    b, r = report["baseline_latency"], report["routed_latency"]
+    if b["count"]:
+        print(f"{'':<10}{'mean':>8}{'p50':>8}{'p90':>8}{'p99':>8}")
+        print(f"{'基準':<8}{b['mean']:>8}{b['p50']:>8}{b['p90']:>8}{b['p99']:>8}")
+        print(f"{'路由後':<7}{r['mean']:>8}{r['p50']:>8}{r['p90']:>8}{r['p99']:>8}")
+    print(f"⏱️ 估計節省: {report['seconds_saved']}s")
+    print("\n規則:")
+    for name, v in report["rules"].items():
+        print(f"   {name:<28} {v['count']:>6} 請求  節省 {v['seconds_saved']:>8}s")
+        for sample in v["samples"]: print(f"      - [{sample['recorded_model']} -> {sample['routed_model']}] {sample['question']}")
+    if report["retrieval_top_score_quantiles"]: print(f"\nretrieval_top_score 分位數: {report['retrieval_top_score_quantiles']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 QA 記錄離線評估模型路由規則")
+    parser.add_argument("--logs-dir", default="user_specific_qa_logs")
+    parser.add_argument("--since", default=None, help="YYYY-MM-DD (含)")
+    parser.add_argument("--until", default=None, help="YYYY-MM-DD (含)")
+    parser.add_argument("--rules", default="", help="規則 JSON 字串或檔案；預設使用 model_router.DEFAULT_RULES")
+    parser.add_argument("--tiers", default=json.dumps(DEFAULT_TIERS), help="等級 -> 模型 (JSON)")
+    parser.add_argument("--default-tier", default="large")
+    parser.add_argument("--exclude-prefix", default="replay_", help="略過此前綴的用戶 (重播產生的記錄)")
+    parser.add_argument("--min-samples", type=int, default=5, help="估計模型速度所需的最少樣本數")
+    parser.add_argument("--samples", type=int, default=5, help="每條規則列出的問題範例數")
+    parser.add_argument("--output", default=None, help="將完整報告寫入 JSON 檔")
+    args = parser.parse_args()
+
+    logs_dir = Path(args.logs_dir)
+    if not logs_dir.is_dir():
+        sys.exit(f"❌ 找不到 QA 記錄資料夾: {logs_dir}")
+    router = ComplexityRouter(json.loads(args.tiers), load_rules(args.rules), default_tier=args.default_tier)
+    records = load_qa_records(logs_dir, args.since, args.until, args.exclude_prefix)
+    if not records:
+        sys.exit("❌ 沒有可評估的記錄")
+    report = evaluate(records, router, args.min_samples, args.samples)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump({"router": router.describe(), **report}, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 報告已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+匯出 / 量化嵌入模型為 ONNX (Export & Quantize Embedding Model)
+
+將 EMBEDDING_MODEL (預設 BAAI/bge-m3) 匯出為 ONNX，並以 ONNX Runtime 動態量化產生 int8 版本，
+供 EMBEDDING_BACKEND=onnx / onnx-int8 使用。需要額外安裝：
+    pip install "optimum[onnxruntime]"
+
+範例：
+    python export_onnx_embedding.py --output-dir onnx_models/bge-m3
+    EMBEDDING_BACKEND=onnx-int8 EMBEDDING_ONNX_DIR=onnx_models/bge-m3 EMBEDDING_NUM_THREADS=4 uvicorn 6_10test:app
+"""
+import argparse
+import logging
+import os
+import time
+from pathlib import Path
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("export_onnx_embedding")
+
+QUANTIZATION_TARGETS = ["avx512_vnni", "avx512", "avx2", "arm64"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匯出嵌入模型為 ONNX 並進行 int8 動態量化")
+    parser.add_argument("--model", default=os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3"))
+    parser.add_argument("--output-dir", default=os.environ.get("EMBEDDING_ONNX_DIR", "onnx_models/bge-m3"))
+    parser.add_argument("--target", choices=QUANTIZATION_TARGETS, default="avx512_vnni",
+                        help="量化設定對應的 CPU 指令集 (請依部署節點選擇)")
+    parser.add_argument("--per-channel", action="store_true", help="逐通道量化 (精度較高、速度略慢)")
+    parser.add_argument("--skip-quantize", action="store_true", help="只匯出 fp32 ONNX")
+    args = parser.parse_args()
+
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+    except ImportError:
+        parser.error('缺少 optimum，請先執行: pip install "optimum[onnxruntime]"')
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.time()
+    logger.info(f"📦 匯出 {args.model} 為 ONNX → {output_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(args.model, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(args.model).save_pretrained(output_dir)
+    logger.info(f"✅ fp32 ONNX 匯出完成 ({time.time() - start:.1f}s): {output_dir / 'model.onnx'}")
+    if args.skip_quantize:
+        return
+
+    start = time.time()
+    quantization_config = getattr(AutoQuantizationConfig, args.target)(is_static=False, per_channel=args.per_channel)
+    quantizer = ORTQuantizer.from_pretrained(output_dir, file_name="model.onnx")
+    # bge-m3 的 fp32 權重超過 2GB，需要以 external data 格式儲存
+    quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config, use_external_data_format=True)
+    logger.info(f"✅ int8 動態量化完成 ({time.time() - start:.1f}s): {output_dir / 'model_quantized.onnx'}")
+    logger.info("💡 請執行 benchmark_embedding_backends.py 確認與向量資料庫中 fp32 嵌入的一致性")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+替身 Ollama 伺服器 (Stand-in Ollama Server)
+
+不需要 GPU 與真實模型，用於壓力測試、流量重播與多後端測試。實作 Ollama 的
+/api/generate (串流 NDJSON)、/api/tags、/api/ps 與 /api/version，並模擬：
+- 預填 (prefill) 與逐 token 的生成延遲
+- 切換模型時的載入延遲 (同一時間只有 --max-loaded 個模型常駐)
+- options.num_predict 上限 (done_reason = "length") 與 options.stop
+- format (結構化輸出)：回覆精簡 JSON 範例；--invalid-json-rate 模擬模型輸出無法解析的情況
+
+範例：
+    python fake_ollama.py --port 11435 --token-ms 20 --load-ms 3000
+    OLLAMA_HOST=http://127.0.0.1:11435 uvicorn 6_10test:app --port 8000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_MODELS = ["qwen3:14b", "gemma3:12b", "gemma3:12b-it-q4_K_M", "qwen2.5:14b-instruct-q5_K_M", "llama3:8b", "qwen:4b"]
+CANNED_ANSWER = (
+    "小港空污USR計畫已展現出一定的成效 ✅，主要體現在提升社區居民對空污議題的認知。\n\n"
+    "**一、社區參與與教育推廣**\n計畫團隊深入小港區的學校 🏫 與社區 👥，舉辦各類環境與健康教育活動。\n"
+    "....................................................................................................\n\n"
+    "**二、針對特定族群的健康促進**\n計畫特別針對兒童與高齡者等敏感族群進行衛教 ❤️。\n"
+    "....................................................................................................\n"
+)
+CANNED_COMPACT_ANSWER = json.dumps({
+    "title": "小港空污USR計畫成效", "intro": "小港空污USR計畫已展現出一定的成效，主要體現在提升社區居民對空污議題的認知。",
+    "sections": [
+        {"title": "社區參與與教育推廣", "emoji": "🏫", "points": ["計畫團隊深入小港區的學校與社區，舉辦各類環境與健康教育活動。"]},
+        {"title": "針對特定族群的健康促進", "emoji": "❤️", "points": ["計畫特別針對兒童與高齡者等敏感族群進行衛教。"]},
+    ],
+}, ensure_ascii=False)
+
+
+class FakeOllamaState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.loaded = OrderedDict()  # model -> 最後使用時間
+        self.stats = {"requests": 0, "swaps": 0, "cancelled": 0, "inflight": 0}
+
+    def ensure_loaded(self, model: str) -> float:
+        """回傳模擬的載入時間 (秒)；必要時淘汰最久未使用的模型"""
+        with self.lock:
+            if model in self.loaded:
+                self.loaded.move_to_end(model)
+                self.loaded[model] = time.time()
+                return 0.0
+            while len(self.loaded) >= self.args.max_loaded:
+                self.loaded.popitem(last=False)
+            self.loaded[model] = time.time()
+            self.stats["swaps"] += 1
+        return self.args.load_ms / 1000.0
+
+
+def make_handler(state: FakeOllamaState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            if state.args.verbose: super().log_message(fmt, *args)
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/api/tags"):
+                self._send_json({"models": [{"name": m, "model": m, "size": 0} for m in state.args.models]})
+            elif self.path.startswith("/api/ps"):
+                with state.lock: loaded = list(state.loaded)
+                self._send_json({"models": [{"name": m, "model": m, "size_vram": 0} for m in loaded]})
+            elif self.path.startswith("/api/version"):
+                self._send_json({"version": "0.0.0-fake"})
+            elif self.path.startswith("/stats"):
+                with state.lock: self._send_json(dict(state.stats, loaded=list(state.loaded)))
+            else:
+                self._send_json({"status": "Ollama is running"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.startswith("/api/generate"):
+                self._send_json({"error": f"unsupported path {self.path}"}, status=404)
+                return
+            model = req.get("model", "")
+            if model not in state.args.models:
+                self._send_json({"error": f"model '{model}' not found"}, status=404)
+                return
+            if state.args.error_rate and random.random() < state.args.error_rate:
+                self._send_json({"error": "simulated failure"}, status=500)
+                return
+            options = req.get("options") or {}
+            num_predict = options.get("num_predict") or -1
+            stop = options.get("stop") or []
+            with state.lock:
+                state.stats["requests"] += 1
+                state.stats["inflight"] += 1
+            try:
+                load_seconds = state.ensure_loaded(model)
+                time.sleep(load_seconds)
+                prompt = req.get("prompt", "")
+                prompt_tokens = max(1, len(prompt) // 2)
+                prefill_seconds = state.args.prefill_ms / 1000.0 + prompt_tokens * state.args.prefill_ms_per_token / 1000.0
+                time.sleep(prefill_seconds)
+                if req.get("format"):
+                    text = CANNED_COMPACT_ANSWER
+                    if state.args.invalid_json_rate and random.random() < state.args.invalid_json_rate: text = text[:len(text) // 2]
+                else:
+                    text = state.args.answer or CANNED_ANSWER
+                for s in stop:
+                    if s and s in text: text = text.split(s, 1)[0]
+                tokens = [text[i:i + 2] for i in range(0, len(text), 2)]
+                done_reason = "stop"
+                if 0 < num_predict < len(tokens):
+                    tokens, done_reason = tokens[:num_predict], "length"
+                stream = req.get("stream", True)
+                final = {
+                    "model": model, "done": True, "done_reason": done_reason,
+                    "total_duration": 0, "load_duration": int(load_seconds * 1e9),
+                    "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prefill_seconds * 1e9),
+                    "eval_count": len(tokens), "eval_duration": int(len(tokens) * state.args.token_ms * 1e6),
+                }
+                if not stream:
+                    time.sleep(len(tokens) * state.args.token_ms / 1000.0)
+                    self._send_json({**final, "response": "".join(tokens)})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for token in tokens:
+                    time.sleep(state.args.token_ms / 1000.0)
+                    self._write_chunk({"model": model, "response": token, "done": False})
+                self._write_chunk({**final, "response": ""})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # 客戶端中斷連線時，真實的 Ollama 也會停止生成
+                with state.lock: state.stats["cancelled"] += 1
+            finally:
+                with state.lock: state.stats["inflight"] -= 1
+
+        def _write_chunk(self, payload):
+            data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="替身 Ollama 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, help="此後端提供的模型清單")
+    parser.add_argument("--max-loaded", type=int, default=1, help="同時常駐的模型數量")
+    parser.add_argument("--load-ms", type=float, default=0, help="切換模型時的載入延遲 (毫秒)")
+    parser.add_argument("--prefill-ms", type=float, default=50, help="每次請求固定的預填延遲 (毫秒)")
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.0, help="每個 prompt token 額外的預填延遲 (毫秒)")
+    parser.add_argument("--token-ms", type=float, default=10, help="每個輸出 token 的延遲 (毫秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模擬失敗的比例 (0~1)")
+    parser.add_argument("--answer", default=None, help="固定回覆內容 (預設為結構化列表範例)")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0, help="結構化輸出回覆不完整 JSON 的比例 (0~1)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(FakeOllamaState(args)))
+    print(f"🦙 Fake Ollama listening on http://{args.host}:{args.port} (models: {', '.join(args.models)})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+向量資料庫建置 / 增量更新工具 (Corpus Ingestion CLI)
+
+讀取結構化 JSON / JSONL 文件（欄位：title、content、doc_id、source），
+以 process pool 平行切段後，使用與後端相同的嵌入模型批次嵌入並 upsert 至 Chroma。
+
+- QA 文件：完整保留問答對，不切段。
+- 長文：先依標題切割段落，再依語意斷句組成 chunk_size / chunk_overlap 的片段。
+- 以 doc_id 的內容雜湊判斷是否變更，只重新嵌入有變動的文件；
+  進度寫入 <persist_dir>/ingest_manifest.json，中斷後重新執行即可從上次進度繼續。
+- --shards N：依 doc_id 雜湊分到 N 個 collection (見 sharded_search.py)，後端會平行查詢各分片；
+  分片數寫入 <persist_dir>/shards.json，之後的增量更新沿用，變更分片數需建到新的資料夾。
+
+範例：
+    python ingest_corpus.py data/*.json --persist-dir 6_12 --workers 8 --batch-size 256
+    python ingest_corpus.py archive/*.jsonl --persist-dir vectordb_snapshots/20250801 --shards 4
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("ingest_corpus")
+
+MANIFEST_FILENAME = "ingest_manifest.json"
+HEADING_PATTERN = re.compile(r"^(#{1,6}\s+.+|[一二三四五六七八九十]+、.+|第[一二三四五六七八九十百0-9]+[章節條].*)$")
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[。！？!?；;])|\n+")
+
+
+def load_documents(input_paths: List[str]) -> List[Dict]:
+    """讀取輸入檔；doc_id 重複時拋出 ValueError (片段 ID 由 doc_id 產生，重複的文件會互相覆蓋)"""
+    docs, seen = [], {}
+    for pattern in input_paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, "r", encoding="utf-8") as f:
+                if path.endswith(".jsonl"):
+                    records = [json.loads(line) for line in f if line.strip()]
+                else:
+                    data = json.load(f)
+                    records = data if isinstance(data, list) else [data]
+            for record in records:
+                if not record.get("doc_id") or not record.get("content"):
+                    logger.warning(f"⚠️ 略過缺少 doc_id 或 content 的文件 (檔案: {path})")
+                    continue
+                doc_id = str(record["doc_id"])
+                if doc_id in seen:
+                    raise ValueError(f"doc_id 重複: {doc_id} (檔案: {seen[doc_id]}、{path})")
+                seen[doc_id] = path
+                docs.append(record)
+    return docs
+
+
+def is_qa_document(doc: Dict, qa_source_pattern: str) -> bool:
+    if doc.get("doc_type"):
+        return str(doc["doc_type"]).lower() == "qa"
+    return re.search(qa_source_pattern, str(doc.get("source", ""))) is not None
+
+
+def document_hash(doc: Dict, chunk_size: int, chunk_overlap: int) -> str:
+    # 切段參數也納入雜湊，參數改變時會自動重新切段與嵌入
+    payload = json.dumps({"title": doc.get("title", ""), "content": doc["content"], "source": doc.get("source", ""),
+                          "doc_type": doc.get("doc_type", ""), "chunk_size": chunk_size, "chunk_overlap": chunk_overlap},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def split_by_heading(content: str) -> List[Tuple[str, str]]:
+    sections, heading, lines = [], "", []
+    for line in content.splitlines():
+        if HEADING_PATTERN.match(line.strip()):
+            if any(l.strip() for l in lines):
+                sections.append((heading, "\n".join(lines).strip()))
+            heading, lines = line.strip().lstrip("#").strip(), []
+        else:
+            lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append((heading, "\n".join(lines).strip()))
+    return sections
+
+
+def split_sentences_into_chunks(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    sentences = [s.strip() for s in SENTENCE_SPLIT_PATTERN.split(text) if s and s.strip()]
+    chunks, current, carried = [], [], 0  # carried：current 開頭從上一個片段帶過來的重疊句子數
+
+    def flush() -> List[str]:
+        # 輸出目前的片段，回傳要帶到下一個片段的重疊句子
+        chunks.append("".join(current))
+        overlap, overlap_len = [], 0
+        for s in reversed(current):
+            if overlap_len + len(s) > chunk_overlap: break
+            overlap.insert(0, s); overlap_len += len(s)
+        return overlap
+
+    for sentence in sentences:
+        if len(sentence) > chunk_size:
+            # 單一句子超過 chunk_size 時先輸出目前的片段再硬切，剩餘部分成為下一個片段的開頭
+            if len(current) > carried: flush()
+            while len(sentence) > chunk_size:
+                chunks.append(sentence[:chunk_size])
+                sentence = sentence[chunk_size - chunk_overlap:]
+            current, carried = [sentence], 0
+            continue
+        if current and sum(len(s) for s in current) + len(sentence) > chunk_size:
+            current = flush()
+            carried = len(current)
+        current.append(sentence)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def chunk_document(doc: Dict, chunk_size: int, chunk_overlap: int, qa_source_pattern: str) -> Tuple[str, List[Tuple[str, str, Dict]]]:
+    """在 worker process 中執行：回傳 (doc_id, [(chunk_id, text, metadata), ...])"""
+    doc_id = str(doc["doc_id"])
+    base_meta = {"doc_id": doc_id, "title": str(doc.get("title", "")), "source": str(doc.get("source", ""))}
+    if is_qa_document(doc, qa_source_pattern):
+        return doc_id, [(f"{doc_id}::0", doc["content"].strip(), {**base_meta, "doc_type": "qa", "chunk_index": 0, "section": ""})]
+    chunks = []
+    for heading, body in split_by_heading(doc["content"]) or [("", doc["content"])]:
+        for piece in split_sentences_into_chunks(body, chunk_size, chunk_overlap):
+            text = f"{heading}\n{piece}" if heading else piece
+            index = len(chunks)
+            chunks.append((f"{doc_id}::{index}", text, {**base_meta, "doc_type": "longform", "chunk_index": index, "section": heading}))
+    return doc_id, chunks
+
+
+def load_manifest(persist_dir: Path) -> Dict[str, Dict]:
+    manifest_file = persist_dir / MANIFEST_FILENAME
+    if manifest_file.exists():
+        with open(manifest_file, "r", encoding="utf-8") as f: return json.load(f)
+    return {}
+
+
+def save_manifest(persist_dir: Path, manifest: Dict[str, Dict]):
+    manifest_file = persist_dir / MANIFEST_FILENAME
+    tmp_file = manifest_file.with_suffix(".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f: json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_file, manifest_file)
+
+
+def build_vectordb(persist_dir: Path, encode_batch_size: int, collection_name: Optional[str] = None, num_shards: int = 0):
+    import torch
+    from langchain_chroma import Chroma
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    embedding_model_name = os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3")
+    logger.info(f"正在載入嵌入模型: {embedding_model_name} (設備: {device})")
+    embedding = HuggingFaceEmbeddings(
+        model_name=embedding_model_name,
+        model_kwargs={"device": device},
+        encode_kwargs={"normalize_embeddings": True, "batch_size": encode_batch_size},
+    )
+    if num_shards:
+        from sharded_search import DEFAULT_COLLECTION, ShardedVectorStore, write_shard_layout
+        return ShardedVectorStore(persist_dir, embedding, write_shard_layout(persist_dir, num_shards, collection_name or DEFAULT_COLLECTION))
+    kwargs = {"collection_name": collection_name} if collection_name else {}
+    return Chroma(persist_directory=str(persist_dir), embedding_function=embedding, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="平行、增量地建置 RAG 向量資料庫")
+    parser.add_argument("inputs", nargs="+", help="結構化 JSON / JSONL 檔案 (可使用萬用字元)")
+    parser.add_argument("--persist-dir", default=os.environ.get("VECTORDB_PATH", "6_12"), help="Chroma 資料夾 (預設: VECTORDB_PATH 或 6_12)")
+    parser.add_argument("--collection-name", default=None, help="Chroma collection 名稱 (預設使用 langchain 預設值)")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--qa-source-pattern", default=r"(?i)qa", help="source 符合此正規表示式的文件視為 QA，不切段")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="切段用的 process 數量")
+    parser.add_argument("--batch-size", type=int, default=256, help="每次 upsert 的片段數量")
+    parser.add_argument("--encode-batch-size", type=int, default=64, help="嵌入模型每次推論的批次大小")
+    parser.add_argument("--prune", action="store_true", help="刪除已不在輸入檔中的 doc_id")
+    parser.add_argument("--shards", type=int, default=None, help="依 doc_id 分成幾個 collection (預設沿用 shards.json；沒有時不分片)")
+    args = parser.parse_args()
+    if args.chunk_overlap >= args.chunk_size:
+        parser.error("--chunk-overlap 必須小於 --chunk-size")
+
+    persist_dir = Path(args.persist_dir)
+    persist_dir.mkdir(parents=True, exist_ok=True)
+    from sharded_search import load_shard_layout
+    layout = load_shard_layout(persist_dir)
+    manifest = load_manifest(persist_dir)
+    current_shards = layout["num_shards"] if layout else None  # None：未分片
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards 必須 >= 1")
+    if (manifest or layout) and args.shards is not None and args.shards != current_shards:
+        parser.error(f"{persist_dir} 已有{f' {current_shards} 個分片' if current_shards else '未分片'}的資料，變更分片方式請建置到新的資料夾")
+    num_shards = args.shards if args.shards is not None else (current_shards or 0)
+    try:
+        docs = load_documents(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+    hashes = {str(doc["doc_id"]): document_hash(doc, args.chunk_size, args.chunk_overlap) for doc in docs}
+    changed_docs = [doc for doc in docs if manifest.get(str(doc["doc_id"]), {}).get("hash") != hashes[str(doc["doc_id"])]]
+    removed_doc_ids = [doc_id for doc_id in manifest if doc_id not in hashes] if args.prune else []
+    logger.info(f"📄 共 {len(docs)} 份文件，需更新 {len(changed_docs)} 份，已是最新 {len(docs) - len(changed_docs)} 份，需刪除 {len(removed_doc_ids)} 份")
+    if not changed_docs and not removed_doc_ids:
+        logger.info("✅ 向量資料庫已是最新狀態，無需更新")
+        return
+
+    vectordb = build_vectordb(persist_dir, args.encode_batch_size, args.collection_name, num_shards)
+
+    if removed_doc_ids:
+        stale_ids = [cid for doc_id in removed_doc_ids for cid in manifest[doc_id].get("chunk_ids", [])]
+        if stale_ids: vectordb.delete(ids=stale_ids)
+        for doc_id in removed_doc_ids: del manifest[doc_id]
+        save_manifest(persist_dir, manifest)
+        logger.info(f"🗑️ 已刪除 {len(removed_doc_ids)} 份文件 ({len(stale_ids)} 個片段)")
+
+    start = time.time()
+    done_docs, done_chunks = 0, 0
+    pending_docs: List[Tuple[str, List[Tuple[str, str, Dict]]]] = []
+
+    def flush():
+        nonlocal done_docs, done_chunks, pending_docs
+        if not pending_docs: return
+        ids = [cid for _, chunks in pending_docs for cid, _, _ in chunks]
+        texts = [text for _, chunks in pending_docs for _, text, _ in chunks]
+        metadatas = [{**meta, "content_hash": hashes[doc_id]} for doc_id, chunks in pending_docs for _, _, meta in chunks]
+        # 先刪除文件變短後多出來的舊片段，再 upsert 新片段
+        stale_ids = [cid for doc_id, chunks in pending_docs
+                     for cid in manifest.get(doc_id, {}).get("chunk_ids", []) if cid not in {c[0] for c in chunks}]
+        if stale_ids: vectordb.delete(ids=stale_ids)
+        if ids: vectordb.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+        for doc_id, chunks in pending_docs:
+            manifest[doc_id] = {"hash": hashes[doc_id], "chunk_ids": [cid for cid, _, _ in chunks]}
+        save_manifest(persist_dir, manifest)
+        done_docs += len(pending_docs); done_chunks += len(ids)
+        elapsed = max(time.time() - start, 1e-6)
+        logger.info(f"⏱️ 進度 {done_docs}/{len(changed_docs)} 份文件, {done_chunks} 個片段 | {done_docs / elapsed:.1f} docs/s, {done_chunks / elapsed:.1f} chunks/s")
+        pending_docs = []
+
+    chunk_fn = partial(chunk_document, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, qa_source_pattern=args.qa_source_pattern)
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        for doc_id, chunks in executor.map(chunk_fn, changed_docs, chunksize=max(1, len(changed_docs) // (args.workers * 4) or 1)):
+            pending_docs.append((doc_id, chunks))
+            if sum(len(c) for _, c in pending_docs) >= args.batch_size:
+                flush()
+        flush()
+
+    elapsed = time.time() - start
+    logger.info(f"✅ 完成：{done_docs} 份文件, {done_chunks} 個片段, 耗時 {elapsed:.1f}s ({done_docs / max(elapsed, 1e-6):.1f} docs/s)")
+
+
+if __name__ == "__main__":
+    main()
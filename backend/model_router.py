@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+問題複雜度路由 (Complexity-based Model Routing)
+
+用戶端未指定模型 (或指定 "auto") 時，以便宜的訊號估計問題難度並選擇模型等級 (tier)：
+- question_chars           問題長度 (字元)
+- question_kind            definition (是什麼 / 定義 ...)、analytical (比較 / 為什麼 / 建議 ...) 或 other
+- format_mode              detect_format_mode 的結果；custom 代表使用者指定了輸出格式
+- prompt_mode              default / research
+- history_pairs            本 session 已有的問答輪數 (追問需要理解上下文)
+- retrieval_top_score      最相關片段與問題的 cosine 相似度
+- retrieval_score_spread   最相關片段與其餘片段中位數的差距；差距大代表答案集中在少數片段
+
+規則依序比對，第一條符合的規則決定等級，都不符合時使用 default_tier：
+    {"name": "short_lookup", "tier": "small", "when": {"question_chars_max": 40, "retrieval_top_score_min": 0.5}}
+條件鍵為 <訊號>_max / <訊號>_min (數值) 或 <訊號> (值或值的清單)；訊號缺少時條件視為不符合 (偏向大模型)。
+門檻與嵌入模型有關，調整前先以 evaluate_model_router.py 對 QA 記錄離線評估。
+"""
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+DEFINITION_PATTERNS = re.compile(r"是什麼|是甚麼|什麼是|甚麼是|是指|的定義|定義|的意思|什麼意思|全名|縮寫|\bwhat is\b|\bdefine\b|\bmeaning of\b", re.IGNORECASE)
+ANALYTICAL_PATTERNS = re.compile(
+    r"比較|差異|差別|不同|為什麼|為何|原因|如何|怎麼|怎樣|分析|評估|影響|建議|策略|優缺點|利弊|趨勢|關係|機制|預測|"
+    r"\bwhy\b|\bhow\b|\bcompare\b|\bdifference\b|\banaly[sz]e\b|\bimpact\b", re.IGNORECASE)
+
+DEFAULT_RULES: List[Dict] = [
+    {"name": "research_mode", "tier": "large", "when": {"prompt_mode": "research"}},
+    {"name": "custom_format", "tier": "large", "when": {"format_mode": "custom"}},
+    {"name": "analytical", "tier": "large", "when": {"question_kind": "analytical"}},
+    {"name": "long_follow_up", "tier": "large", "when": {"history_pairs_min": 3}},
+    {"name": "definition", "tier": "small", "when": {"question_kind": "definition", "question_chars_max": 60}},
+    {"name": "short_lookup", "tier": "small", "when": {"question_chars_max": 30, "retrieval_top_score_min": 0.6, "retrieval_score_spread_min": 0.05}},
+]
+
+
+def question_kind(question: str) -> str:
+    # 同時出現時以分析型為準，例如「PM2.5 是什麼？對健康有什麼影響？」
+    if ANALYTICAL_PATTERNS.search(question): return "analytical"
+    if DEFINITION_PATTERNS.search(question): return "definition"
+    return "other"
+
+
+def question_signals(question: str, format_mode: str, prompt_mode: str, history_pairs: int,
+                     retrieval_scores: Optional[List[float]] = None) -> Dict:
+    signals = {"question_chars": len(question.strip()), "question_kind": question_kind(question),
+               "format_mode": format_mode, "prompt_mode": prompt_mode, "history_pairs": history_pairs}
+    if retrieval_scores:
+        ordered = sorted(retrieval_scores, reverse=True)
+        rest = ordered[1:] or ordered
+        signals["retrieval_top_score"] = round(ordered[0], 4)
+        signals["retrieval_score_spread"] = round(ordered[0] - rest[len(rest) // 2], 4)
+    return signals
+
+
+def load_rules(spec: str) -> List[Dict]:
+    """spec 可以是 JSON 字串或 JSON 檔案路徑；空字串使用 DEFAULT_RULES"""
+    spec = (spec or "").strip()
+    if not spec: return [dict(rule) for rule in DEFAULT_RULES]
+    rules = json.loads(spec if spec.startswith("[") else Path(spec).read_text(encoding="utf-8"))
+    for index, rule in enumerate(rules):
+        if "tier" not in rule: raise ValueError(f"路由規則 #{index} 缺少 tier")
+        rule.setdefault("name", f"rule_{index}")
+        rule.setdefault("when", {})
+    return rules
+
+
+def _condition_matches(key: str, expected, signals: Dict) -> bool:
+    if key.endswith(("_max", "_min")):
+        value = signals.get(key[:-4])
+        if value is None: return False
+        return value <= expected if key.endswith("_max") else value >= expected
+    value = signals.get(key)
+    if value is None: return False
+    return value in expected if isinstance(expected, list) else value == expected
+
+
+class ComplexityRouter:
+    def __init__(self, tiers: Dict[str, str], rules: Optional[List[Dict]] = None, default_tier: str = "large",
+                 enabled: bool = True):
+        self.tiers = tiers
+        self.rules = rules if rules is not None else load_rules("")
+        self.default_tier = default_tier
+        self.enabled = enabled
+        unknown = {rule["tier"] for rule in self.rules} - set(tiers) | ({default_tier} - set(tiers))
+        if unknown: raise ValueError(f"路由規則使用了未定義的等級: {sorted(unknown)}")
+
+    def route(self, signals: Dict) -> Tuple[str, str, Optional[str]]:
+        """回傳 (等級, 模型, 符合的規則名稱)；沒有規則符合時規則名稱為 None"""
+        for rule in self.rules:
+            if all(_condition_matches(key, expected, signals) for key, expected in rule["when"].items()):
+                return rule["tier"], self.tiers[rule["tier"]], rule["name"]
+        return self.default_tier, self.tiers[self.default_tier], None
+
+    def describe(self) -> Dict:
+        return {"enabled": self.enabled, "tiers": self.tiers, "default_tier": self.default_tier, "rules": self.rules}
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+模型親和排程 (Model-Affinity Scheduling)
+
+同一台 GPU 上交錯請求不同模型時，Ollama 會反覆卸載 / 載入權重，每次切換都要數秒才開始產生 token。
+此排程器讓生成請求先取得「執行名額」：
+- 常駐中的模型 (由 Ollama /api/ps 得知，加上本程序剛送出的模型) 優先放行，每個模型最多 slots_per_model 個同時執行
+  (None = 不限制，由 Ollama 自己排隊)
+- 需要載入的新模型，只有在「會被淘汰的模型」已沒有執行中的請求時才放行，也就是先把目前模型的這一批排空再切換
+- 公平性上限：其他模型的請求等待超過 max_wait_seconds 時，不再放行常駐模型的新請求，讓它排空後立即切換
+
+排程只在單一程序 (單一事件迴圈) 內生效；多 worker 部署時各 worker 各自排程，但都以 /api/ps 的常駐模型為準。
+"""
+import asyncio
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Waiter:
+    __slots__ = ("model", "future", "enqueued_at")
+
+    def __init__(self, model: str, future: asyncio.Future):
+        self.model = model
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class ModelAffinityScheduler:
+    def __init__(self, ollama_host: str, slots_per_model: Optional[int] = None, max_resident: int = 1, max_wait_seconds: float = 20.0,
+                 ps_refresh_seconds: float = 5.0, load_threshold_seconds: float = 0.5, enabled: bool = True,
+                 metric: Optional[Callable] = None):
+        self.ollama_host = ollama_host.rstrip("/")
+        self.slots_per_model = max(slots_per_model, 1) if slots_per_model else None
+        self.max_resident = max(max_resident, 1)
+        self.max_wait_seconds = max_wait_seconds
+        self.ps_refresh_seconds = ps_refresh_seconds
+        self.load_threshold_seconds = load_threshold_seconds
+        self.enabled = enabled
+        self._metric = metric or (lambda name, value=1.0, labels=None: None)
+        self.running: Dict[str, int] = {}
+        self.waiting: Dict[str, deque] = {}
+        self.resident: "OrderedDict[str, float]" = OrderedDict()  # 模型 -> 最後使用時間 (LRU 順序)
+        self.ollama_resident: List[str] = []
+        self._ps_checked_at = 0.0
+        self._ps_refreshing = False
+        self.swap_events: deque = deque(maxlen=2000)  # (time, from_model, to_model)
+        self.load_events: deque = deque(maxlen=2000)  # (time, model, load_seconds)
+        self.stats = {"admitted": 0, "resident_hits": 0, "swaps": 0, "fairness_holds": 0, "wait_seconds": 0.0,
+                      "observed_loads": 0, "load_seconds": 0.0, "cancelled_while_waiting": 0}
+
+    # --- 常駐模型 ---
+    def _fetch_ps(self) -> Optional[List[str]]:
+        try:
+            with urllib.request.urlopen(f"{self.ollama_host}/api/ps", timeout=2) as resp:
+                return [m.get("name") or m.get("model") for m in json.loads(resp.read()).get("models", [])]
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            logger.debug(f"讀取 Ollama /api/ps 失敗: {e}")
+            return None
+
+    async def _refresh_resident(self):
+        try:
+            models = await asyncio.to_thread(self._fetch_ps)
+        finally:
+            self._ps_refreshing = False
+        self._ps_checked_at = time.monotonic()
+        if models is None: return
+        self.ollama_resident = models
+        # 以 Ollama 實際常駐的模型為準；本程序正在執行 (可能還在載入中) 的模型保留
+        for model in list(self.resident):
+            if model not in models and not self.running.get(model): del self.resident[model]
+        for model in models:
+            if model not in self.resident:
+                # 由其他 worker 載入的模型視為最久未使用
+                self.resident[model] = 0.0
+                self.resident.move_to_end(model, last=False)
+        self._dispatch()
+
+    def _maybe_refresh_resident(self):
+        if self._ps_refreshing or time.monotonic() - self._ps_checked_at < self.ps_refresh_seconds: return
+        self._ps_refreshing = True
+        asyncio.get_running_loop().create_task(self._refresh_resident())
+
+    @property
+    def capacity(self) -> int:
+        # /api/ps 顯示同時常駐的模型比設定多時，代表 VRAM 放得下，以觀察值為準
+        return max(self.max_resident, len(self.ollama_resident))
+
+    def _eviction_victim(self) -> Optional[str]:
+        """載入新模型時會被淘汰的模型；None 代表不需淘汰"""
+        if len(self.resident) < self.capacity: return None
+        # 優先淘汰最久未使用且沒有執行中請求的模型
+        return next((m for m in self.resident if not self.running.get(m)), next(iter(self.resident)))
+
+    def _has_slot(self, model: str) -> bool:
+        return self.slots_per_model is None or self.running.get(model, 0) < self.slots_per_model
+
+    def _can_load(self) -> bool:
+        victim = self._eviction_victim()
+        return victim is None or not self.running.get(victim)
+
+    # --- 排程 ---
+    def _dispatch(self):
+        now = time.monotonic()
+        while True:
+            heads = [queue[0] for queue in self.waiting.values() if queue]
+            if not heads: return
+            starving = [w for w in heads if w.model not in self.resident and now - w.enqueued_at >= self.max_wait_seconds]
+            if starving:
+                chosen = min(starving, key=lambda w: w.enqueued_at)
+                if not self._can_load():
+                    # 暫停放行常駐模型的新請求，等目前這批執行完就切換
+                    self.stats["fairness_holds"] += 1
+                    return
+            else:
+                candidates = [w for w in heads if w.model in self.resident and self._has_slot(w.model)]
+                loads = [w for w in heads if w.model not in self.resident]
+                # 還有空間常駐時載入不會淘汰任何模型；否則只在沒有常駐命中可放行時才切換到等待最久的模型，
+                # 之後它的請求都是常駐命中，會整批處理
+                if loads and (self._eviction_victim() is None or (not candidates and self._can_load())):
+                    candidates += loads
+                if not candidates: return
+                chosen = min(candidates, key=lambda w: w.enqueued_at)
+            self.waiting[chosen.model].popleft()
+            self._admit(chosen, now)
+
+    def _admit(self, waiter: _Waiter, now: float):
+        model = waiter.model
+        swapped = model not in self.resident
+        if swapped:
+            victim = self._eviction_victim()
+            if victim is not None: del self.resident[victim]
+            self.stats["swaps"] += 1
+            self.swap_events.append((time.time(), victim, model))
+            self._metric("llm_model_swaps_total", labels={"from": str(victim), "to": model})
+            logger.info(f"🔄 模型排程: 切換至 '{model}' (淘汰: {victim}, 等待 {now - waiter.enqueued_at:.2f}s)")
+        else:
+            self.stats["resident_hits"] += 1
+        self.resident[model] = time.time()
+        self.resident.move_to_end(model)
+        self.running[model] = self.running.get(model, 0) + 1
+        self.stats["admitted"] += 1
+        self.stats["wait_seconds"] += now - waiter.enqueued_at
+        self._metric("llm_scheduler_wait_seconds_total", now - waiter.enqueued_at, labels={"model": model})
+        if not waiter.future.done(): waiter.future.set_result(swapped)
+
+    async def acquire(self, model: str) -> bool:
+        """等待執行名額；回傳此請求是否觸發模型切換"""
+        if not self.enabled: return False
+        self._maybe_refresh_resident()
+        waiter = _Waiter(model, asyncio.get_running_loop().create_future())
+        self.waiting.setdefault(model, deque()).append(waiter)
+        self._dispatch()
+        try:
+            return await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已取得名額但在恢復執行前被取消
+                self.release(model)
+            else:
+                try: self.waiting[model].remove(waiter)
+                except ValueError: pass
+                self.stats["cancelled_while_waiting"] += 1
+                self._dispatch()
+            raise
+
+    def release(self, model: str):
+        if not self.enabled: return
+        self.running[model] = max(self.running.get(model, 0) - 1, 0)
+        if model in self.resident:
+            self.resident[model] = time.time()
+            self.resident.move_to_end(model)
+        self._dispatch()
+
+    def record_load(self, model: str, load_seconds: float):
+        """以 Ollama 回應中的 load_duration 統計實際的模型載入 (切換) 耗時"""
+        if load_seconds < self.load_threshold_seconds: return
+        self.stats["observed_loads"] += 1
+        self.stats["load_seconds"] += load_seconds
+        self.load_events.append((time.time(), model, load_seconds))
+        self._metric("llm_model_loads_total", labels={"model": model})
+        self._metric("llm_model_load_seconds_total", load_seconds, labels={"model": model})
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+
+        def _window(minutes: int) -> Dict:
+            cutoff = now - minutes * 60
+            loads = [seconds for ts, _, seconds in self.load_events if ts >= cutoff]
+            return {"swaps_per_minute": round(sum(1 for ts, _, _ in self.swap_events if ts >= cutoff) / minutes, 3),
+                    "observed_loads_per_minute": round(len(loads) / minutes, 3), "load_seconds": round(sum(loads), 2)}
+
+        monotonic_now = time.monotonic()
+        return {
+            "enabled": self.enabled, "slots_per_model": self.slots_per_model, "max_resident": self.max_resident,
+            "max_wait_seconds": self.max_wait_seconds, "resident": list(self.resident), "ollama_resident": self.ollama_resident,
+            "running": {m: n for m, n in self.running.items() if n},
+            "waiting": {m: {"count": len(q), "oldest_wait_seconds": round(monotonic_now - q[0].enqueued_at, 2)} for m, q in self.waiting.items() if q},
+            "stats": {k: round(v, 2) if isinstance(v, float) else v for k, v in self.stats.items()},
+            "last_1m": _window(1), "last_10m": _window(10), "last_60m": _window(60),
+            "recent_swaps": [{"time": time.strftime("%H:%M:%S", time.localtime(ts)), "from": src, "to": dst} for ts, src, dst in list(self.swap_events)[-10:]],
+        }
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+多 Ollama 後端負載平衡 (Ollama Backend Pool)
+
+OLLAMA_BACKENDS 設定多台推論主機，每台可指定提供的模型清單：
+- 逗號分隔的網址：OLLAMA_BACKENDS="http://gpu1:11434,http://gpu2:11434" (模型清單由 /api/tags 自動取得)
+- JSON：OLLAMA_BACKENDS='[{"url": "http://gpu1:11434", "models": ["qwen3:14b"]}, "http://gpu2:11434"]'
+
+路由：在「未被剔除且提供該模型」的後端中，選擇進行中請求 (含在排程器中排隊的) 最少者；同分時優先選模型已常駐的後端。
+健康檢查：背景執行緒每 health_check_seconds 以 /api/tags 檢查各後端，並更新未明確設定的模型清單。
+剔除：連續失敗 max_failures 次 (請求或健康檢查) 即剔除；eject_seconds 秒後健康檢查成功才恢復。
+全部後端都被剔除時仍會送到最早到期的後端，不會讓服務完全停擺。
+"""
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OLLAMA_PORT = 11434
+
+
+def normalize_ollama_url(host: str) -> str:
+    """與 ollama client 解析 OLLAMA_HOST 的方式一致：補上 http:// 與預設埠"""
+    host = (host or "").strip().rstrip("/") or f"127.0.0.1:{DEFAULT_OLLAMA_PORT}"
+    scheme_given = "://" in host
+    parts = urlsplit(host if scheme_given else f"http://{host}")
+    port = parts.port or ((443 if parts.scheme == "https" else 80) if scheme_given else DEFAULT_OLLAMA_PORT)
+    return f"{parts.scheme}://{parts.hostname or '127.0.0.1'}:{port}{parts.path.rstrip('/')}"
+
+
+class NoBackendAvailableError(Exception):
+    pass
+
+
+class OllamaBackend:
+    def __init__(self, url: str, models: Optional[Iterable[str]] = None, scheduler=None):
+        self.url = normalize_ollama_url(url)
+        self.name = urlsplit(self.url).netloc
+        self.configured_models = set(models) if models else None
+        self.models: Optional[set] = set(self.configured_models) if self.configured_models else None  # None 代表尚未知道，任何模型都可送
+        self.scheduler = scheduler
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected = False
+        self.ejected_until = 0.0
+        self.last_error: Optional[str] = None
+        self.last_health_check: Optional[float] = None
+        self.latencies: deque = deque(maxlen=200)
+        self.stats = {"requests": 0, "ok": 0, "failures": 0, "cancelled": 0, "ejections": 0, "failovers_from": 0}
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def has_resident(self, model: str) -> bool:
+        return self.scheduler is not None and model in self.scheduler.resident
+
+    def snapshot(self) -> Dict:
+        latencies = sorted(self.latencies)
+        return {
+            "url": self.url, "ejected": self.ejected,
+            "ejected_for_seconds": round(max(self.ejected_until - time.monotonic(), 0), 1) if self.ejected else 0,
+            "outstanding": self.outstanding, "consecutive_failures": self.consecutive_failures,
+            "models": sorted(self.models) if self.models is not None else None,
+            "models_configured": self.configured_models is not None,
+            "resident": list(self.scheduler.resident) if self.scheduler is not None else [],
+            "p50_latency_seconds": round(latencies[len(latencies) // 2], 2) if latencies else None,
+            "p95_latency_seconds": round(latencies[int(len(latencies) * 0.95)], 2) if latencies else None,
+            "last_error": self.last_error,
+            "last_health_check": time.strftime("%H:%M:%S", time.localtime(self.last_health_check)) if self.last_health_check else None,
+            "stats": dict(self.stats),
+        }
+
+
+class OllamaBackendPool:
+    def __init__(self, backends: List[OllamaBackend], max_failures: int = 3, eject_seconds: float = 30.0,
+                 health_check_seconds: float = 10.0, metric: Optional[Callable] = None):
+        if not backends: raise ValueError("至少需要一個 Ollama 後端")
+        self.backends = backends
+        self.max_failures = max(max_failures, 1)
+        self.eject_seconds = eject_seconds
+        self.health_check_seconds = health_check_seconds
+        self._metric = metric or (lambda name, value=1.0, labels=None: None)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, spec: str, default_host: str, scheduler_factory: Optional[Callable] = None, **kwargs) -> "OllamaBackendPool":
+        """spec 為空時只有 default_host 一個後端 (與未設定 OLLAMA_BACKENDS 前相同)"""
+        spec = (spec or "").strip()
+        if spec.startswith("["):
+            entries = [e if isinstance(e, dict) else {"url": e} for e in json.loads(spec)]
+        else:
+            entries = [{"url": url.strip()} for url in spec.split(",") if url.strip()] or [{"url": default_host}]
+        backends = []
+        for entry in entries:
+            url = normalize_ollama_url(entry["url"])
+            backends.append(OllamaBackend(url, entry.get("models"), scheduler_factory(url) if scheduler_factory else None))
+        return cls(backends, **kwargs)
+
+    # --- 路由 ---
+    def ranked(self, model: str, exclude: Iterable[OllamaBackend] = ()) -> List[OllamaBackend]:
+        """依路由偏好排序的候選後端"""
+        candidates = [b for b in self.backends if b not in exclude and b.serves(model)]
+        available = [b for b in candidates if not b.ejected]
+        if not available and candidates:
+            # 全部被剔除：送到最早到期的後端，等同探測
+            available = [min(candidates, key=lambda b: b.ejected_until)]
+        return sorted(available, key=lambda b: (b.outstanding, not b.has_resident(model), random.random()))
+
+    def pick(self, model: str, exclude: Iterable[OllamaBackend] = ()) -> Optional[OllamaBackend]:
+        ranked = self.ranked(model, exclude)
+        return ranked[0] if ranked else None
+
+    def capacity(self, model: str) -> int:
+        """可處理該模型的後端數，用於估計排隊時間"""
+        return max(sum(1 for b in self.backends if not b.ejected and b.serves(model)), 1)
+
+    @contextmanager
+    def track(self, backend: OllamaBackend, model: str):
+        """包住送到某個後端的一次生成；取消不計入成敗"""
+        backend.outstanding += 1
+        backend.stats["requests"] += 1
+        start, outcome = time.monotonic(), "error"
+        try:
+            yield
+            outcome = "ok"
+        except Exception as e:
+            self.record_failure(backend, e, model)
+            raise
+        except BaseException:
+            outcome = "cancelled"
+            raise
+        finally:
+            backend.outstanding -= 1
+            backend.stats[{"ok": "ok", "error": "failures", "cancelled": "cancelled"}[outcome]] += 1
+            if outcome == "ok":
+                backend.latencies.append(time.monotonic() - start)
+                self.record_success(backend)
+            self._metric("ollama_backend_requests_total", labels={"backend": backend.name, "outcome": outcome})
+
+    def record_success(self, backend: OllamaBackend):
+        with self._lock:
+            backend.consecutive_failures = 0
+            if backend.ejected and time.monotonic() >= backend.ejected_until:
+                backend.ejected = False
+                logger.info(f"✅ Ollama 後端 {backend.name} 已恢復")
+
+    def record_failure(self, backend: OllamaBackend, error: BaseException, model: Optional[str] = None):
+        status_code = getattr(error, "status_code", None)
+        if status_code == 404:
+            # 模型不在此後端：從自動取得的清單移除 (下次健康檢查會重新取得)，不算後端故障
+            if model and backend.configured_models is None and backend.models is not None:
+                backend.models.discard(model)
+            return
+        if status_code is not None and 400 <= status_code < 500: return
+        with self._lock:
+            backend.consecutive_failures += 1
+            backend.last_error = f"{type(error).__name__}: {error}"[:300]
+            if backend.consecutive_failures >= self.max_failures:
+                if not backend.ejected:
+                    backend.stats["ejections"] += 1
+                    self._metric("ollama_backend_ejections_total", labels={"backend": backend.name})
+                    logger.warning(f"🚫 Ollama 後端 {backend.name} 連續失敗 {backend.consecutive_failures} 次，剔除 {self.eject_seconds:.0f}s: {backend.last_error}")
+                backend.ejected = True
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+
+    @staticmethod
+    def is_retryable(error: BaseException) -> bool:
+        """連線錯誤 / 5xx / 模型不在此後端 才值得換後端重試；其他 4xx 換後端也一樣會失敗"""
+        status_code = getattr(error, "status_code", None)
+        return status_code is None or status_code == 404 or status_code >= 500
+
+    # --- 健康檢查 ---
+    def _probe(self, backend: OllamaBackend):
+        try:
+            with urllib.request.urlopen(f"{backend.url}/api/tags", timeout=3) as resp:
+                models = {m.get("name") or m.get("model") for m in json.loads(resp.read()).get("models", [])}
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            backend.last_health_check = time.time()
+            self.record_failure(backend, e)
+            return
+        backend.last_health_check = time.time()
+        if backend.configured_models is None: backend.models = models
+        self.record_success(backend)
+
+    def _health_loop(self):
+        while not self._stop_event.is_set():
+            for backend in self.backends: self._probe(backend)
+            self._stop_event.wait(self.health_check_seconds)
+
+    def start(self):
+        if self.health_check_seconds <= 0 or (self._thread and self._thread.is_alive()): return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._health_loop, name="ollama-health-check", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def snapshot(self) -> Dict:
+        return {"max_failures": self.max_failures, "eject_seconds": self.eject_seconds,
+                "health_check_seconds": self.health_check_seconds,
+                "backends": {b.name: b.snapshot() for b in self.backends}}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+依 metadata 分區檢索 (Partitioned Retrieval)
+
+語料中混合了三種片段 (見 ingest_corpus.py 與回饋匯入)：
+- doc_type=qa        完整問答對，數量少、精準度高
+- doc_type=longform  長文切段，數量多且同一文件的相鄰片段內容重疊
+- source=user_feedback  使用者回饋的問答對
+
+其他片段 (例如舊版建置、沒有 doc_type 的片段) 由 other 分區承接，不會因為啟用分區而從檢索結果中消失。
+
+單一 MMR (fetch_k=30) 時長文片段佔據大部分候選，QA 與回饋常被擠出提示詞。分區檢索對每個分區各自做 MMR
+(各有自己的 k / fetch_k，可平行查詢)，再依名額合併：
+    {"name": "qa", "where": {"doc_type": "qa"}, "k": 3, "fetch_k": 8, "quota": 2}
+- where        Chroma metadata 條件 (欄位: 值，或 {"$eq" | "$ne" | "$in" | "$nin": 值})；多個欄位以 $and 合併
+- k / fetch_k  該分區 MMR 選出的片段數 / 候選數 (fetch_k 預設 3k)
+- quota        合併時保留給該分區的名額 (依相似度取前幾名)；其餘名額由所有分區剩下的片段依相似度競爭
+- max_per_doc  同一 doc_id 最多取幾個片段 (長文分區用來避免同一文件的重疊片段塞滿提示詞)
+合併後的片段依相似度由高到低排列，總數不超過 max_docs；同一片段 ID 只取一次。
+"""
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PARTITIONS: List[Dict] = [
+    {"name": "qa", "where": {"doc_type": "qa"}, "k": 3, "fetch_k": 8, "quota": 2},
+    {"name": "feedback", "where": {"source": "user_feedback"}, "k": 2, "fetch_k": 4, "quota": 1},
+    {"name": "longform", "where": {"doc_type": "longform"}, "k": 6, "fetch_k": 20, "quota": 3, "max_per_doc": 2},
+    # 不屬於上面任何分區的片段；Chroma 的 $nin / $ne 也會符合沒有該欄位的片段。k / fetch_k 與單一 MMR 相同，
+    # 整個快照都沒有 doc_type 時結果與停用分區時一致
+    {"name": "other", "where": {"doc_type": {"$nin": ["qa", "longform"]}, "source": {"$ne": "user_feedback"}}, "k": 10, "fetch_k": 30, "quota": 0},
+]
+FILTER_KEYS = ("doc_type", "source", "doc_id", "title", "section")
+_FILTER_OPERATORS = ("$eq", "$ne", "$in", "$nin")
+_SCALAR_TYPES = (str, int, float, bool)
+
+
+def combine_where(*clauses: Optional[Dict]) -> Optional[Dict]:
+    """把多個條件以 $and 合併 (Chroma 的 where 每層只能有一個鍵)"""
+    flattened = []
+    for clause in clauses:
+        if not clause: continue
+        if len(clause) == 1: flattened.append(clause)
+        else: flattened.extend({key: value} for key, value in clause.items())
+    if not flattened: return None
+    return flattened[0] if len(flattened) == 1 else {"$and": flattened}
+
+
+def normalize_metadata_filter(flt: Optional[Dict], keys: Optional[Iterable[str]] = FILTER_KEYS) -> Optional[Dict]:
+    """驗證並轉成 Chroma 的 where 條件；keys 為 None 時不限制欄位。格式錯誤時拋出 ValueError"""
+    if not flt: return None
+    if not isinstance(flt, dict): raise ValueError("metadata_filter 必須是物件")
+    clauses = []
+    for key, condition in flt.items():
+        if key in ("$and", "$or"):
+            if not isinstance(condition, list) or not condition: raise ValueError(f"{key} 必須是非空的條件陣列")
+            subs = [normalize_metadata_filter(sub, keys) for sub in condition]
+            subs = [sub for sub in subs if sub]
+            if subs: clauses.append({key: subs} if len(subs) > 1 else subs[0])
+            continue
+        if keys is not None and key not in keys: raise ValueError(f"不支援的 metadata 欄位: {key} (可用: {', '.join(keys)})")
+        if isinstance(condition, dict):
+            if len(condition) != 1 or next(iter(condition)) not in _FILTER_OPERATORS:
+                raise ValueError(f"{key} 的條件必須是單一運算子: {', '.join(_FILTER_OPERATORS)}")
+            op, value = next(iter(condition.items()))
+        else:
+            op, value = "$eq", condition
+        if op in ("$in", "$nin"):
+            if not isinstance(value, list) or not value or not all(isinstance(v, _SCALAR_TYPES) for v in value):
+                raise ValueError(f"{key} 的 {op} 必須是非空的值陣列")
+        elif not isinstance(value, _SCALAR_TYPES):
+            raise ValueError(f"{key} 的條件值必須是字串、數字或布林值")
+        clauses.append({key: {op: value}})
+    return combine_where(*clauses)
+
+
+def load_partitions(spec: str) -> List[Dict]:
+    """spec：空字串停用分區 (單一 MMR)；"default" 使用 DEFAULT_PARTITIONS；否則為 JSON 字串或 JSON 檔案路徑"""
+    spec = (spec or "").strip()
+    if not spec: return []
+    if spec == "default": partitions = [dict(p) for p in DEFAULT_PARTITIONS]
+    else: partitions = json.loads(spec if spec.startswith("[") else Path(spec).read_text(encoding="utf-8"))
+    names = set()
+    for index, partition in enumerate(partitions):
+        name = partition.setdefault("name", f"partition_{index}")
+        if name in names: raise ValueError(f"分區名稱重複: {name}")
+        names.add(name)
+        if not partition.get("where"): raise ValueError(f"分區 {name} 缺少 where 條件")
+        partition["where"] = normalize_metadata_filter(partition["where"], keys=None)
+        partition["k"] = int(partition.get("k", 4))
+        partition["fetch_k"] = int(partition.get("fetch_k", 3 * partition["k"]))
+        partition["quota"] = int(partition.get("quota", 0))
+        if partition["k"] < 1 or partition["fetch_k"] < partition["k"]: raise ValueError(f"分區 {name} 需滿足 1 <= k <= fetch_k")
+        if not 0 <= partition["quota"] <= partition["k"]: raise ValueError(f"分區 {name} 需滿足 0 <= quota <= k")
+        if partition.get("max_per_doc") is not None and int(partition["max_per_doc"]) < 1: raise ValueError(f"分區 {name} 的 max_per_doc 必須 >= 1")
+    return partitions
+
+
+def merge_partition_results(results: Dict[str, List[Tuple[object, float]]], partitions: List[Dict], max_docs: int) -> List[Tuple[object, float, str]]:
+    """results：分區名稱 -> [(片段, 相似度)]。片段需有 id 與 metadata 屬性 (langchain Document)。
+    回傳 [(片段, 相似度, 分區名稱)]，依相似度由高到低"""
+    selected, seen_ids, per_doc = [], set(), {}
+
+    def take(partition: Dict, doc, score: float) -> bool:
+        doc_key = (partition["name"], (doc.metadata or {}).get("doc_id"))
+        chunk_id = getattr(doc, "id", None)
+        if chunk_id is not None and chunk_id in seen_ids: return False
+        if partition.get("max_per_doc") and doc_key[1] is not None and per_doc.get(doc_key, 0) >= int(partition["max_per_doc"]): return False
+        if chunk_id is not None: seen_ids.add(chunk_id)
+        per_doc[doc_key] = per_doc.get(doc_key, 0) + 1
+        selected.append((doc, score, partition["name"]))
+        return True
+
+    remaining = []
+    for partition in partitions:
+        reserved = 0
+        for doc, score in sorted(results.get(partition["name"], []), key=lambda item: item[1], reverse=True):
+            if reserved < partition["quota"] and len(selected) < max_docs:
+                if take(partition, doc, score): reserved += 1
+            else:
+                remaining.append((score, partition, doc))
+    for score, partition, doc in sorted(remaining, key=lambda item: item[0], reverse=True):
+        if len(selected) >= max_docs: break
+        take(partition, doc, score)
+    selected.sort(key=lambda item: item[1], reverse=True)
+    return selected
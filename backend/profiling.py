@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+效能剖析 (Profiling Hooks)
+
+供 /api/admin/profiling 使用，設計上可長期在正式環境開啟：
+- SamplingProfiler   ：指定時間窗內以 sys._current_frames() 取樣所有執行緒的呼叫堆疊 (只在請求時執行)，
+                       輸出 self / cumulative 熱點與 collapsed stacks (可丟給 flamegraph.pl / speedscope)
+- SlowRequestRecorder：trace 結束時若超過 SLOW_REQUEST_SECONDS，保留各階段耗時、prompt 大小與模板 (只讀已存在的 span)
+- MemorySampler      ：每 MEMORY_SNAPSHOT_INTERVAL_SECONDS 記錄 RSS 與 Python heap；
+                       tracemalloc 額外負擔較大，需以 PROFILING_TRACEMALLOC=1 或管理 API 手動開啟才會記錄 top allocators
+"""
+import gc
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MIN_INTERVAL_MS = 1.0
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "20"))
+SLOW_REQUEST_MAX_ENTRIES = int(os.environ.get("SLOW_REQUEST_MAX_ENTRIES", "200"))
+SLOW_REQUEST_LOG_PATH = os.environ.get("SLOW_REQUEST_LOG_PATH", "")  # 設定時另外附加寫入 jsonl (由背景執行緒寫入)
+SLOW_REQUEST_LOG_QUEUE_SIZE = int(os.environ.get("SLOW_REQUEST_LOG_QUEUE_SIZE", "1000"))
+MEMORY_SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get("MEMORY_SNAPSHOT_INTERVAL_SECONDS", "60"))
+MEMORY_SNAPSHOT_MAX_ENTRIES = int(os.environ.get("MEMORY_SNAPSHOT_MAX_ENTRIES", "360"))
+PROFILING_TRACEMALLOC = os.environ.get("PROFILING_TRACEMALLOC", "false").lower() in ("1", "true", "yes")
+TRACEMALLOC_FRAMES = int(os.environ.get("TRACEMALLOC_FRAMES", "1"))
+TRACEMALLOC_TOP_N = 15
+# 葉節點為這些 (函式, 檔案) 時視為閒置中的執行緒 (等待鎖 / 佇列 / I/O 事件)；
+# uvloop 的事件迴圈在 C 層等待時 Python 堆疊只會停在 asyncio.runners.run
+IDLE_LEAF_FRAMES = {("wait", "threading.py"), ("_wait_for_tstate_lock", "threading.py"), ("_worker", "thread.py"),
+                    ("get", "queue.py"), ("select", "selectors.py"), ("run", "runners.py"), ("serve_forever", "socketserver.py")}
+SLOW_REQUEST_EXCLUDED_PREFIXES = ("/api/admin/profiling",)
+
+
+def current_rss_mb() -> Optional[float]:
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / 1024 / 1024, 1)
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _is_idle(frame) -> bool:
+    return (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in IDLE_LEAF_FRAMES
+
+
+class SamplingProfiler:
+    """同一時間只允許一個剖析；取樣執行緒本身不列入結果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, seconds: float, interval_ms: float = 10.0, top: int = 30,
+                thread_filter: Optional[str] = None, include_idle: bool = False) -> Dict:
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+        interval = max(interval_ms, PROFILE_MIN_INTERVAL_MS) / 1000.0
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("another profile is already running")
+        try:
+            return self._sample(seconds, interval, top, thread_filter, include_idle)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds: float, interval: float, top: int, thread_filter: Optional[str], include_idle: bool) -> Dict:
+        own_ident = threading.get_ident()
+        thread_names = {}
+        stacks: Counter = Counter()
+        self_counts: Counter = Counter()
+        cumulative_counts: Counter = Counter()
+        thread_counts: Counter = Counter()
+        samples = active_samples = idle_samples = 0
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            if len(thread_names) != threading.active_count():
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread_name = thread_names.get(ident, str(ident))
+                if ident == own_ident or (thread_filter and thread_filter not in thread_name): continue
+                if not include_idle and _is_idle(frame):
+                    idle_samples += 1
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.reverse()
+                active_samples += 1
+                thread_counts[thread_name] += 1
+                stacks[";".join([thread_name] + labels)] += 1
+                self_counts[labels[-1]] += 1
+                for label in set(labels): cumulative_counts[label] += 1
+            samples += 1
+            time.sleep(interval)
+        elapsed = time.perf_counter() - start
+
+        def _top(counts: Counter) -> List[Dict]:
+            # ratio 以「非閒置的執行緒樣本數」為分母
+            return [{"frame": k, "samples": v, "ratio": round(v / active_samples, 4)} for k, v in counts.most_common(top)]
+
+        return {
+            "seconds": round(elapsed, 3), "samples": samples, "active_thread_samples": active_samples, "idle_thread_samples": idle_samples,
+            "effective_interval_ms": round(elapsed / samples * 1000, 3) if samples else None,
+            "threads": dict(thread_counts.most_common()),
+            "top_self": _top(self_counts) if active_samples else [],
+            "top_cumulative": _top(cumulative_counts) if active_samples else [],
+            "collapsed": stacks,
+        }
+
+
+def collapsed_text(collapsed: Dict[str, int]) -> str:
+    """flamegraph.pl / speedscope 可直接讀取的 collapsed stack 格式"""
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(collapsed.items())) + "\n"
+
+
+class SlowRequestRecorder:
+    """以 tracing 的 trace listener 取得已結束的 trace，只在超過門檻時整理各階段耗時；
+    listener 在請求執行緒上呼叫，jsonl 檔案改由背景執行緒從佇列寫入，佇列滿時丟棄並計數"""
+
+    def __init__(self, threshold_seconds: float = SLOW_REQUEST_SECONDS, max_entries: int = SLOW_REQUEST_MAX_ENTRIES,
+                 log_path: str = SLOW_REQUEST_LOG_PATH, excluded_prefixes=SLOW_REQUEST_EXCLUDED_PREFIXES):
+        self.threshold_seconds = threshold_seconds
+        self.excluded_prefixes = tuple(excluded_prefixes)
+        self.entries: deque = deque(maxlen=max_entries)
+        self.log_path = Path(log_path) if log_path else None
+        self.seen = 0
+        self.log_dropped = 0
+        self._lock = threading.Lock()
+        self._log_queue: "queue.Queue[Dict]" = queue.Queue(maxsize=SLOW_REQUEST_LOG_QUEUE_SIZE)
+        self._writer: Optional[threading.Thread] = None
+
+    def __call__(self, root) -> None:
+        with self._lock:
+            self.seen += 1
+        if root.duration_seconds < self.threshold_seconds: return
+        if str(root.attributes.get("http.target", "")).startswith(self.excluded_prefixes): return
+        entry = self.breakdown(root)
+        with self._lock:
+            self.entries.append(entry)
+            if self.log_path:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(target=self._write_log, daemon=True, name="slow-request-writer")
+                    self._writer.start()
+                try:
+                    self._log_queue.put_nowait(entry)
+                except queue.Full:
+                    self.log_dropped += 1
+        logger.warning(f"🐢 慢請求 {root.name} {root.duration_seconds:.2f}s (trace {root.trace_id}): "
+                       + ", ".join(f"{k}={v}s" for k, v in entry["stage_seconds"].items()))
+
+    def _write_log(self):
+        while True:
+            batch = [self._log_queue.get()]
+            while True:
+                try:
+                    batch.append(self._log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+            except OSError as e:
+                logger.error(f"❌ 寫入慢請求記錄失敗: {e}")
+
+    @staticmethod
+    def breakdown(root) -> Dict:
+        spans = sorted(root.trace.spans, key=lambda s: s.start_ns)
+        stage_seconds: Dict[str, float] = {}
+        stages = []
+        for s in spans:
+            if s is root: continue
+            duration = (s.end_ns - s.start_ns) / 1e9
+            stages.append({"name": s.name, "offset_ms": round((s.start_ns - root.start_ns) / 1e6, 1),
+                           "duration_ms": round(duration * 1000, 1), "parent": "root" if s.parent_id == root.span_id else s.parent_id,
+                           "attributes": s.attributes, **({"error": s.status_message} if s.status_message else {})})
+            if s.parent_id == root.span_id:
+                stage_seconds[s.name] = round(stage_seconds.get(s.name, 0.0) + duration, 3)
+        # 根 span 中沒有被任何階段涵蓋的時間：middleware、排隊、序列化等 Python 開銷
+        stage_seconds["unaccounted"] = round(max(root.duration_seconds - sum(stage_seconds.values()), 0.0), 3)
+        return {
+            "trace_id": root.trace_id, "name": root.name, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(root.start_ns / 1e9)),
+            "duration_seconds": round(root.duration_seconds, 3), "attributes": root.attributes,
+            "stage_seconds": stage_seconds, "spans": stages,
+        }
+
+    def recent(self, limit: int) -> List[Dict]:
+        with self._lock:
+            return list(self.entries)[-limit:][::-1]
+
+
+class MemorySampler:
+    def __init__(self, interval_seconds: float = MEMORY_SNAPSHOT_INTERVAL_SECONDS, max_entries: int = MEMORY_SNAPSHOT_MAX_ENTRIES):
+        self.interval_seconds = interval_seconds
+        self.snapshots: deque = deque(maxlen=max_entries)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if PROFILING_TRACEMALLOC: self.start_tracemalloc(TRACEMALLOC_FRAMES)
+
+    @property
+    def tracemalloc_enabled(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start_tracemalloc(self, nframes: int = TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(nframes, 1))
+            logger.info(f"🧠 tracemalloc 已啟用 (nframes={max(nframes, 1)})")
+
+    def stop_tracemalloc(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("🧠 tracemalloc 已停用")
+
+    def snapshot(self, top: int = TRACEMALLOC_TOP_N) -> Dict:
+        entry = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "rss_mb": current_rss_mb(),
+            "python_allocated_blocks": sys.getallocatedblocks(), "gc_counts": gc.get_count(),
+            "threads": threading.active_count(), "tracemalloc": None,
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+            ]).statistics("lineno")
+            entry["tracemalloc"] = {
+                "current_mb": round(current / 1024 / 1024, 2), "peak_mb": round(peak / 1024 / 1024, 2),
+                "top_allocators": [{"location": str(stat.traceback[0]), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                                   for stat in stats[:top]],
+            }
+        return entry
+
+    def start(self):
+        if self.interval_seconds <= 0 or (self._thread and self._thread.is_alive()): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="memory-sampler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.snapshots.append(self.snapshot())
+            except Exception as e:
+                logger.error(f"❌ 記憶體快照失敗: {e}", exc_info=True)
+            self._stop.wait(self.interval_seconds)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+提示詞 token 統計 (Prompt Token Accounting)
+
+把一次請求的提示詞依來源拆成五個區段並估計 token 數：
+- instructions  模板中的指示文字 (角色、規則、格式指南、結尾指示)
+- example       模板中的輸出範例 (「**--- 輸出範例」、「**--- 範例」、「**範例格式」到下一個區段標題或「👇」為止)
+- history / context / question  填入 {history}、{context}、{question} 的內容
+
+估計方式：中日韓文字與全形標點每字約 1 token，表情符號約 2 token，其餘 (英數、空白、Markdown 符號) 約 4 字元 1 token。
+Ollama 回傳的 prompt_eval_count 是「實際預填」的 token 數；相同前綴會重用 KV cache，因此可能小於估計總和，兩者分開記錄。
+"""
+import re
+from functools import lru_cache
+from typing import Dict
+
+SECTIONS = ("instructions", "example", "history", "context", "question")
+VARIABLE_SECTIONS = ("history", "context", "question")
+EXAMPLE_HEADER = re.compile(r"^\*\*(?:--- )?(?:輸出)?範例")
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_EMOJI_RE = re.compile(r"[\U0001f000-\U0001faff\u2600-\u27bf]")
+_PLACEHOLDER_RE = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text: return 0
+    cjk = len(_CJK_RE.findall(text))
+    emoji = len(_EMOJI_RE.findall(text))
+    other = len(text) - cjk - emoji
+    return cjk + 2 * emoji + (other + 3) // 4
+
+
+@lru_cache(maxsize=64)
+def static_sections(template_text: str) -> Dict[str, int]:
+    """模板固定文字 (不含變數內容) 中 instructions / example 的估計 token 數"""
+    parts = {"instructions": [], "example": []}
+    in_example = False
+    for line in template_text.splitlines(keepends=True):
+        stripped = line.strip()
+        if EXAMPLE_HEADER.match(stripped): in_example = True
+        elif stripped.startswith(("**--- ", "👇")): in_example = False
+        line = _PLACEHOLDER_RE.sub("", line).replace("{{", "{").replace("}}", "}")
+        parts["example" if in_example else "instructions"].append(line)
+    return {section: estimate_tokens("".join(lines)) for section, lines in parts.items()}
+
+
+def prompt_token_breakdown(template_text: str, prompt_input: Dict[str, str]) -> Dict[str, int]:
+    """各區段的估計 token 數；模板沒有使用的變數計為 0"""
+    breakdown = dict(static_sections(template_text))
+    for section in VARIABLE_SECTIONS:
+        breakdown[section] = estimate_tokens(prompt_input.get(section) or "") if f"{{{section}}}" in template_text else 0
+    return breakdown
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+以 QA 記錄重播真實流量 (Traffic Replay from QA Logs)
+
+讀取 user_specific_qa_logs/<user>/qa_log_*.jsonl，依原始的到達時間間隔與問題組合 (問題、模型、prompt_mode、session)
+對「正在執行中」的後端送出請求 (open-loop：不會因為後端變慢而延後送出)，並比較記錄中的延遲與重播時的延遲。
+
+- 到達時間：QA 記錄的 timestamp 是處理完成的時間，因此以 timestamp - total_processing_time_seconds 還原
+- --speedup 可一次給多個倍率 (例如 1 2 4)，依序重播並輸出比較表
+- --max-gap-seconds 會壓縮過長的閒置時間 (例如夜間)，先壓縮再套用 speedup
+- 每次重播使用獨立的用戶名稱 (--username-prefix) 與 session，不會寫入真實用戶的聊天記錄；
+  以此前綴開頭的用戶記錄 (也就是先前重播產生的記錄) 不會再被重播
+
+建議搭配替身 Ollama：
+    python fake_ollama.py --port 11435 --token-ms 20
+    RATE_LIMIT_PER_MINUTE=100000 OLLAMA_HOST=http://127.0.0.1:11435 uvicorn 6_10test:app --port 8000
+    python replay_qa_logs.py --base-url http://127.0.0.1:8000 --since 2025-06-01 --speedup 1 4 16 --max-gap-seconds 60
+
+注意：速率限制以 IP 計算，重播前請調高 RATE_LIMIT_PER_MINUTE。
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def load_records(logs_dir: Path, users: Optional[List[str]], since: Optional[str], until: Optional[str],
+                 exclude_prefix: str, include_cancelled: bool) -> List[Dict]:
+    records = []
+    for user_dir in sorted(p for p in logs_dir.iterdir() if p.is_dir()):
+        if users and user_dir.name not in users: continue
+        if exclude_prefix and user_dir.name.startswith(exclude_prefix): continue
+        for log_file in sorted(user_dir.glob("qa_log_*.jsonl")):
+            day = log_file.stem.replace("qa_log_", "")
+            if (since and day < since) or (until and day > until): continue
+            with open(log_file, encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                        finished = datetime.fromisoformat(record["timestamp"]).timestamp()
+                    except (ValueError, KeyError) as e:
+                        print(f"⚠️ 略過 {log_file}:{line_no}: {e}", file=sys.stderr)
+                        continue
+                    if not record.get("question") or (record.get("cancelled") and not include_cancelled): continue
+                    recorded = record.get("total_processing_time_seconds")
+                    records.append({
+                        "arrival": finished - (recorded or 0), "user": user_dir.name,
+                        "source": record.get("username_source_type", "frontend_user"),
+                        "session_id": record.get("session_id") or "replay", "question": record["question"],
+                        "model": record.get("model_requested") or record.get("model"),
+                        "prompt_mode": record.get("prompt_mode_requested") or "default",
+                        "recorded_seconds": recorded, "recorded_cancelled": bool(record.get("cancelled")),
+                    })
+    records.sort(key=lambda r: r["arrival"])
+    return records
+
+
+def build_schedule(records: List[Dict], speedup: float, max_gap_seconds: Optional[float]) -> List[float]:
+    """回傳每個請求相對於重播開始的送出時間 (秒)"""
+    offsets, offset, previous = [], 0.0, None
+    for record in records:
+        if previous is not None:
+            gap = record["arrival"] - previous
+            offset += min(gap, max_gap_seconds) if max_gap_seconds else gap
+        previous = record["arrival"]
+        offsets.append(offset / speedup)
+    return offsets
+
+
+def send(args, record: Dict, run_id: str) -> Dict:
+    # 每次重播使用獨立的 session，對話歷史的長度會與原始 session 一樣逐步增加
+    session_id = f"{run_id}_{record['session_id']}"[:120]
+    use_public_api = record["source"] == "api_call" and args.api_key
+    payload = {"session_id": session_id, "question": record["question"], "prompt_mode": record["prompt_mode"]}
+    if record["model"]: payload["model"] = record["model"]
+    headers = {"Content-Type": "application/json"}
+    if args.request_timeout: headers["X-Request-Timeout"] = str(args.request_timeout)
+    if use_public_api:
+        path = "/api/v1/public/rag/ask"
+        headers["X-API-Key"] = args.api_key
+        payload["sources_mode"] = "ids"
+    else:
+        path = "/chat"
+        headers["X-Username"] = f"{args.username_prefix}{record['user']}"[:64]
+    req = urllib.request.Request(args.base_url.rstrip("/") + path, data=json.dumps(payload).encode("utf-8"), method="POST", headers=headers)
+    start = time.time()
+    status, model_used, trace_id = None, None, None
+    try:
+        with urllib.request.urlopen(req, timeout=args.client_timeout) as resp:
+            status, trace_id = resp.status, resp.headers.get("X-Trace-Id")
+            model_used = json.loads(resp.read() or b"{}").get("model_used")
+    except urllib.error.HTTPError as e:
+        status, trace_id = e.code, e.headers.get("X-Trace-Id")
+    except Exception as e:
+        status = type(e).__name__
+    return {"status": status, "replayed_seconds": time.time() - start, "model_used": model_used, "trace_id": trace_id}
+
+
+def replay(args, records: List[Dict], speedup: float) -> Dict:
+    offsets = build_schedule(records, speedup, args.max_gap_seconds)
+    run_id = f"replay{int(time.time())}x{speedup:g}"
+    results: List[Optional[Dict]] = [None] * len(records)
+    inflight = {"now": 0, "peak": 0}
+    lock = threading.Lock()
+
+    def run_one(i: int, dispatch_lag: float):
+        with lock:
+            inflight["now"] += 1
+            inflight["peak"] = max(inflight["peak"], inflight["now"])
+        try:
+            results[i] = {**send(args, records[i], run_id), "dispatch_lag": dispatch_lag}
+        finally:
+            with lock: inflight["now"] -= 1
+
+    print(f"▶️ 重播 {len(records)} 個請求，speedup x{speedup:g}，預計送出時間 {offsets[-1]:.1f}s (run: {run_id})")
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.max_inflight) as executor:
+        for i, offset in enumerate(offsets):
+            delay = start + offset - time.time()
+            if delay > 0: time.sleep(delay)
+            # 執行緒池已滿時送出會延後，dispatch_lag 過大代表是重播工具本身而非後端成為瓶頸
+            executor.submit(run_one, i, max(0.0, time.time() - start - offset))
+    elapsed = time.time() - start
+    return summarize(records, results, speedup, offsets, elapsed, inflight["peak"])
+
+
+def _latency_stats(values: List[float]) -> Dict:
+    if not values: return {"n": 0}
+    return {"n": len(values), "p50": round(percentile(values, 0.5), 2), "p90": round(percentile(values, 0.9), 2),
+            "p99": round(percentile(values, 0.99), 2), "mean": round(statistics.mean(values), 2)}
+
+
+def summarize(records: List[Dict], results: List[Dict], speedup: float, offsets: List[float], elapsed: float, peak_inflight: int) -> Dict:
+    statuses: Dict[str, int] = {}
+    for r in results: statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    ok = [(rec, res) for rec, res in zip(records, results) if res["status"] == 200]
+    comparable = [(rec, res) for rec, res in ok if rec["recorded_seconds"] and not rec["recorded_cancelled"]]
+    groups: Dict[str, List] = {}
+    for rec, res in comparable:
+        groups.setdefault(f"{rec['model']}|{rec['prompt_mode']}", []).append((rec, res))
+    return {
+        "speedup": speedup, "requests": len(records), "statuses": statuses, "elapsed_seconds": round(elapsed, 1),
+        "offered_rps": round(len(records) / offsets[-1], 3) if offsets[-1] > 0 else None,
+        "achieved_rps": round(len(ok) / elapsed, 3) if elapsed > 0 else None, "peak_inflight": peak_inflight,
+        "dispatch_lag_p99": round(percentile([r["dispatch_lag"] for r in results], 0.99), 3),
+        "recorded": _latency_stats([rec["recorded_seconds"] for rec, _ in comparable]),
+        "replayed": _latency_stats([res["replayed_seconds"] for _, res in comparable]),
+        # 每個請求的「重播 / 記錄」延遲比，中位數 > 1 代表目前的設定比記錄當時慢
+        "ratio": _latency_stats([res["replayed_seconds"] / rec["recorded_seconds"] for rec, res in comparable]),
+        "model_substituted": sum(1 for rec, res in ok if res["model_used"] and rec["model"] and res["model_used"] != rec["model"]),
+        "by_model_prompt_mode": {key: {"recorded": _latency_stats([rec["recorded_seconds"] for rec, _ in pairs]),
+                                       "replayed": _latency_stats([res["replayed_seconds"] for _, res in pairs])}
+                                 for key, pairs in sorted(groups.items())},
+        "slowest": sorted(({"question": rec["question"][:60], "recorded": rec["recorded_seconds"], "replayed": round(res["replayed_seconds"], 2),
+                            "trace_id": res["trace_id"]} for rec, res in ok), key=lambda x: -x["replayed"])[:5],
+    }
+
+
+def print_report(reports: List[Dict]):
+    print(f"\n{'speedup':>8} {'reqs':>6} {'ok':>6} {'offered/s':>10} {'achieved/s':>10} {'inflight':>8} "
+          f"{'rec p50':>8} {'rec p99':>8} {'rep p50':>8} {'rep p99':>8} {'ratio p50':>9} {'ratio p90':>9}")
+    for r in reports:
+        rec, rep, ratio = r["recorded"], r["replayed"], r["ratio"]
+        print(f"{r['speedup']:>8g} {r['requests']:>6} {r['statuses'].get('200', 0):>6} {str(r['offered_rps']):>10} {str(r['achieved_rps']):>10} "
+              f"{r['peak_inflight']:>8} {str(rec.get('p50', '-')):>8} {str(rec.get('p99', '-')):>8} {str(rep.get('p50', '-')):>8} "
+              f"{str(rep.get('p99', '-')):>8} {str(ratio.get('p50', '-')):>9} {str(ratio.get('p90', '-')):>9}")
+    for r in reports:
+        other = {k: v for k, v in r["statuses"].items() if k != "200"}
+        if other: print(f"⚠️ x{r['speedup']:g} 非 200 的回應: {other}")
+        if r["dispatch_lag_p99"] > 1: print(f"⚠️ x{r['speedup']:g} 送出延遲 p99 {r['dispatch_lag_p99']}s，請調高 --max-inflight")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 QA 記錄重播真實流量並比較延遲")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--logs-dir", default="user_specific_qa_logs")
+    parser.add_argument("--users", nargs="*", default=None, help="只重播這些用戶的記錄")
+    parser.add_argument("--since", default=None, help="YYYY-MM-DD (含)")
+    parser.add_argument("--until", default=None, help="YYYY-MM-DD (含)")
+    parser.add_argument("--speedup", type=float, nargs="+", default=[1.0], help="到達速度倍率，可給多個依序重播")
+    parser.add_argument("--max-gap-seconds", type=float, default=None, help="壓縮超過此秒數的閒置間隔")
+    parser.add_argument("--limit", type=int, default=None, help="只重播最早的 N 個請求")
+    parser.add_argument("--include-cancelled", action="store_true", help="一併重播當時被取消的請求")
+    parser.add_argument("--username-prefix", default="replay_", help="重播用戶名稱前綴，避免寫入真實用戶的聊天記錄")
+    parser.add_argument("--api-key", default=None, help="提供時 api_call 的記錄改打公開 API，否則一律打 /chat")
+    parser.add_argument("--max-inflight", type=int, default=256, help="重播工具同時進行中的請求上限")
+    parser.add_argument("--request-timeout", type=float, default=None, help="以 X-Request-Timeout 傳給後端的期限 (秒)")
+    parser.add_argument("--client-timeout", type=float, default=900)
+    parser.add_argument("--dry-run", action="store_true", help="只輸出重播排程的統計，不送出請求")
+    parser.add_argument("--output", default=None, help="將完整報告寫入 JSON 檔")
+    args = parser.parse_args()
+
+    logs_dir = Path(args.logs_dir)
+    if not logs_dir.is_dir():
+        parser.error(f"找不到 QA 記錄資料夾 {logs_dir}")
+    records = load_records(logs_dir, args.users, args.since, args.until, args.username_prefix, args.include_cancelled)
+    if args.limit: records = records[:args.limit]
+    if not records:
+        print("❌ 沒有可重播的記錄")
+        sys.exit(1)
+
+    span_seconds = records[-1]["arrival"] - records[0]["arrival"]
+    mix: Dict[str, int] = {}
+    for record in records: mix[f"{record['model']}|{record['prompt_mode']}"] = mix.get(f"{record['model']}|{record['prompt_mode']}", 0) + 1
+    print(f"📼 {len(records)} 個請求，{len({r['user'] for r in records})} 位用戶，原始時間跨度 {span_seconds / 3600:.2f} 小時")
+    print(f"   問題組合 (model|prompt_mode): {mix}")
+    if args.dry_run:
+        for speedup in args.speedup:
+            offsets = build_schedule(records, speedup, args.max_gap_seconds)
+            print(f"   x{speedup:g}: 重播時間 {offsets[-1]:.1f}s，平均 {len(records) / max(offsets[-1], 1e-6):.3f} req/s")
+        return
+
+    reports = [replay(args, records, speedup) for speedup in args.speedup]
+    print_report(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"📝 完整報告: {args.output}")
+    if any(r["statuses"].get("200", 0) == 0 for r in reports): sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+分片向量檢索 (Sharded Vector Search)
+
+語料大到單一 collection 的 HNSW 查詢跟不上延遲目標時，ingest_corpus.py --shards N 會把片段依 doc_id 的雜湊
+分到同一個 Chroma 資料夾中的 N 個 collection (<collection>_shard_00 ...)，並寫入 shards.json 記錄分片方式；
+後端載入快照時看到 shards.json 即改用 ShardedVectorStore：
+
+- 查詢：同一個查詢向量送到所有分片平行查詢，各分片取 top fetch_k 候選後依 cosine 相似度合併成全域 top fetch_k，
+  再交給呼叫端做 MMR；同一份文件的片段都在同一個分片，合併結果與單一 collection 的候選相同 (差異只來自 HNSW 的近似誤差)
+  - processes > 0：spawn 的 process pool，每個子程序各自開啟所有分片 (只匯入本模組與 chromadb，不會載入嵌入模型)
+  - processes = 0：本程序內以執行緒查詢，直接使用寫入時的同一組 collection
+- 寫入 (回饋匯入、增量建置)：依 metadata 的 doc_id 寫到對應分片；刪除時對所有分片執行。
+  子程序的 Chroma client 不會看到其他程序的寫入，因此每次寫入後遞增 generation，
+  子程序收到較新的 generation 時重新開啟分片 (重新載入索引，適合批次寫入而非逐筆寫入)
+- get(ids)：依序查詢所有分片
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+SHARD_LAYOUT_FILENAME = "shards.json"
+DEFAULT_COLLECTION = "langchain"  # langchain_chroma 的預設 collection 名稱
+
+
+def shard_for_doc(doc_id: str, num_shards: int) -> int:
+    return int(hashlib.sha1(str(doc_id).encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+
+def shard_collection_name(collection_name: str, index: int) -> str:
+    return f"{collection_name}_shard_{index:02d}"
+
+
+def load_shard_layout(persist_dir: Path) -> Optional[Dict]:
+    layout_file = Path(persist_dir) / SHARD_LAYOUT_FILENAME
+    if not layout_file.exists(): return None
+    with open(layout_file, encoding="utf-8") as f: return json.load(f)
+
+
+def write_shard_layout(persist_dir: Path, num_shards: int, collection_name: str = DEFAULT_COLLECTION) -> Dict:
+    layout = {"num_shards": num_shards, "collection_name": collection_name,
+              "collections": [shard_collection_name(collection_name, i) for i in range(num_shards)]}
+    tmp_file = Path(persist_dir) / f".{SHARD_LAYOUT_FILENAME}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f: json.dump(layout, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, Path(persist_dir) / SHARD_LAYOUT_FILENAME)
+    return layout
+
+
+# --- 在子程序中執行的分片查詢；collection 依 (路徑, 名稱) 快取，並記錄開啟時的 generation ---
+_shard_collections: Dict[tuple, tuple] = {}
+
+
+def _open_shard(persist_dir: str, collection_name: str, generation: int = 0):
+    key = (persist_dir, collection_name)
+    cached = _shard_collections.get(key)
+    if cached is not None and cached[0] >= generation: return cached[1]
+    import chromadb
+    if cached is not None:
+        # 父程序寫入過：丟棄此子程序的所有 client 快取，重新從磁碟開啟 (子程序只開啟分片，不影響其他 client)
+        from chromadb.api.client import SharedSystemClient
+        _shard_collections.clear()
+        SharedSystemClient.clear_system_cache()
+    collection = chromadb.PersistentClient(path=persist_dir).get_or_create_collection(collection_name)
+    _shard_collections[key] = (generation, collection)
+    return collection
+
+
+def _open_all_shards(persist_dir: str, collection_names: List[str]):
+    # process pool 的 initializer：子程序啟動時先開啟所有分片，第一個查詢不必承擔開啟成本
+    for name in collection_names: _open_shard(persist_dir, name)
+
+
+def _query_collection(collection, query_embedding: List[float], n_results: int, where: Optional[Dict]) -> Dict:
+    results = collection.query(query_embeddings=[query_embedding], n_results=n_results, where=where, include=["metadatas", "documents", "embeddings"])
+    embeddings = results["embeddings"][0] if results["embeddings"] else []
+    return {"ids": list(results["ids"][0]), "documents": list(results["documents"][0]), "metadatas": list(results["metadatas"][0]),
+            "embeddings": np.asarray(embeddings, dtype=np.float32)}
+
+
+def query_shard(persist_dir: str, collection_name: str, query_embedding: List[float], n_results: int, where: Optional[Dict] = None,
+                generation: int = 0) -> Dict:
+    return _query_collection(_open_shard(persist_dir, collection_name, generation), query_embedding, n_results, where)
+
+
+def merge_shard_candidates(query_embedding: List[float], shard_results: List[Dict], n_results: int) -> Dict:
+    """合併各分片的候選，依與查詢的 cosine 相似度取前 n_results；回傳與 Chroma collection.query 相同的格式"""
+    shard_results = [r for r in shard_results if len(r["ids"])]
+    if not shard_results: return {"ids": [[]], "documents": [[]], "metadatas": [[]], "embeddings": []}
+    embeddings = np.vstack([r["embeddings"] for r in shard_results])
+    query = np.asarray(query_embedding, dtype=np.float32)
+    similarities = embeddings @ query / np.maximum(np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query), 1e-12)
+    order = np.argsort(-similarities, kind="stable")[:n_results]
+    ids = [i for r in shard_results for i in r["ids"]]
+    documents = [d for r in shard_results for d in r["documents"]]
+    metadatas = [m for r in shard_results for m in r["metadatas"]]
+    return {"ids": [[ids[i] for i in order]], "documents": [[documents[i] for i in order]],
+            "metadatas": [[metadatas[i] for i in order]], "embeddings": [embeddings[order]]}
+
+
+class ShardedVectorStore:
+    """提供後端使用到的 Chroma 介面 (embeddings、add_texts、get、delete、similarity_search) 與 query_candidates"""
+
+    def __init__(self, persist_dir: Path, embedding_function, layout: Dict, processes: int = 0):
+        from langchain_chroma import Chroma
+        self.persist_dir = str(persist_dir)
+        self.embeddings = embedding_function
+        self.collection_names: List[str] = layout["collections"]
+        self.num_shards = len(self.collection_names)
+        self.shards = [Chroma(persist_directory=self.persist_dir, embedding_function=embedding_function, collection_name=name)
+                       for name in self.collection_names]
+        self.processes = processes
+        self.generation = 0  # 每次寫入後遞增，子程序據此重新開啟分片
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        # processes=0 時在本程序以執行緒查詢；否則用 spawn 的 process pool (不繼承父程序的 Chroma / torch 狀態)
+        if self._executor is None:
+            self._executor = (ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=_open_all_shards, initargs=(self.persist_dir, self.collection_names))
+                              if self.processes > 0 else ThreadPoolExecutor(max_workers=self.num_shards, thread_name_prefix="vector-shard"))
+        return self._executor
+
+    def warm_up(self):
+        """啟動查詢的執行緒 / 子程序並送出探測查詢。子程序在 initializer 中開啟所有分片後才接受查詢，
+        但 process pool 可能按需啟動子程序，此處不保證所有子程序都已啟動"""
+        dim_probe = self.shards[0]._collection.peek(1).get("embeddings")
+        if dim_probe is None or len(dim_probe) == 0: return
+        probe = [float(x) for x in dim_probe[0]]
+        for _ in range(max(self.processes, 1)): self.query_candidates(probe, 1)
+
+    def query_candidates(self, query_embedding: List[float], n_results: int, where: Optional[Dict] = None) -> Dict:
+        query_embedding = [float(x) for x in query_embedding]
+        if self.processes > 0:
+            futures = [self.executor.submit(query_shard, self.persist_dir, name, query_embedding, n_results, where, self.generation)
+                       for name in self.collection_names]
+        else:
+            futures = [self.executor.submit(_query_collection, shard._collection, query_embedding, n_results, where) for shard in self.shards]
+        return merge_shard_candidates(query_embedding, [future.result() for future in futures], n_results)
+
+    def similarity_search(self, query: str, k: int = 4):
+        from langchain_core.documents import Document
+        results = self.query_candidates(self.embeddings.embed_query(query), k)
+        return [Document(page_content=content, metadata=metadata or {}, id=doc_id)
+                for doc_id, content, metadata in zip(results["ids"][0], results["documents"][0], results["metadatas"][0])]
+
+    def add_texts(self, texts: List[str], metadatas: List[Dict], ids: List[str]) -> List[str]:
+        groups: Dict[int, List[int]] = {}
+        for position, metadata in enumerate(metadatas):
+            groups.setdefault(shard_for_doc((metadata or {}).get("doc_id", ids[position]), self.num_shards), []).append(position)
+        try:
+            for shard, positions in groups.items():
+                self.shards[shard].add_texts(texts=[texts[p] for p in positions], metadatas=[metadatas[p] for p in positions], ids=[ids[p] for p in positions])
+        finally:
+            self.generation += 1
+        return ids
+
+    def delete(self, ids: List[str]):
+        try:
+            for shard in self.shards: shard.delete(ids=ids)
+        finally:
+            self.generation += 1
+
+    def get(self, ids: List[str], include: Optional[List[str]] = None) -> Dict:
+        merged = {"ids": [], "documents": [], "metadatas": []}
+        for shard in self.shards:
+            found = shard.get(ids=ids, include=include or ["documents", "metadatas"])
+            for key in merged: merged[key].extend(found.get(key) or [])
+        return merged
+
+    def count(self) -> int:
+        return sum(shard._collection.count() for shard in self.shards)
+
+    def close(self, release_clients: bool = True):
+        """release_clients=False 時只停止查詢的執行緒 / 子程序，分片的 Chroma client 交給 GC (同路徑已重新開啟時使用)"""
+        if self._executor is not None: self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        for key in [key for key in _shard_collections if key[0] == self.persist_dir]: _shard_collections.pop(key, None)
+        if not release_clients: return
+        for shard in self.shards:
+            close = getattr(getattr(shard, "_client", None), "close", None)
+            if callable(close): close()
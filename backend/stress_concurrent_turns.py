@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+多 worker 併發寫入壓力測試 (Concurrent Turns Stress Test)
+
+對「正在執行中」的後端，同時對同一個 session_id 送出多個 /chat 回合，
+結束後讀回訊息記錄，確認每一個成功的回合都留下了一組 user / assistant 訊息（沒有遺失）。
+
+建議搭配替身 Ollama 與多個 uvicorn worker：
+    python fake_ollama.py --port 11435 --token-ms 5
+    MULTI_WORKER_MODE=true OLLAMA_HOST=http://127.0.0.1:11435 uvicorn 6_10test:app --workers 4 --port 8000
+    python stress_concurrent_turns.py --base-url http://127.0.0.1:8000 --turns 40 --concurrency 16
+
+注意：預設速率限制為每 IP 每分鐘 30 次，壓測時請調高 RATE_LIMIT_PER_MINUTE。
+"""
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def call(base_url: str, method: str, path: str, username: str, payload=None, timeout: float = 600):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(base_url.rstrip("/") + path, data=data, method=method,
+                                 headers={"Content-Type": "application/json", "X-Username": username})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        body = resp.read()
+        return resp.status, json.loads(body) if body else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同一 session 的併發回合壓力測試")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", default="stress_tester")
+    parser.add_argument("--session-id", default=None, help="預設為 stress_<timestamp>")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--model", default=None)
+    args = parser.parse_args()
+
+    session_id = args.session_id or f"stress_{int(time.time() * 1000)}"
+    status_code, before = call(args.base_url, "GET", "/api/chats", args.username)
+    existing = 0
+    if any(chat["id"] == session_id for chat in before or []):
+        _, messages = call(args.base_url, "GET", f"/api/chats/{session_id}/messages", args.username)
+        existing = len(messages)
+
+    def one_turn(i: int):
+        payload = {"session_id": session_id, "question": f"壓力測試第 {i} 回合：小港空污的健康影響？"}
+        if args.model: payload["model"] = args.model
+        start = time.time()
+        try:
+            status_code, body = call(args.base_url, "POST", "/chat", args.username, payload)
+            return i, status_code, time.time() - start
+        except urllib.error.HTTPError as e:
+            return i, e.code, time.time() - start
+        except Exception as e:
+            print(f"⚠️ 回合 {i} 失敗: {e}", file=sys.stderr)
+            return i, None, time.time() - start
+
+    start_all = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one_turn, range(args.turns)))
+    elapsed = time.time() - start_all
+
+    succeeded = [r for r in results if r[1] == 200]
+    _, messages = call(args.base_url, "GET", f"/api/chats/{session_id}/messages", args.username)
+    stored_turns = {m["content"] for m in messages[existing:] if m["role"] == "user"}
+    expected_turns = {f"壓力測試第 {i} 回合：小港空污的健康影響？" for i, *_ in succeeded}
+    lost = expected_turns - stored_turns
+    statuses = {}
+    for _, code, _ in results: statuses[code] = statuses.get(code, 0) + 1
+
+    print(f"Session: {session_id}")
+    print(f"回合數: {args.turns}, 併發: {args.concurrency}, 耗時: {elapsed:.1f}s, 狀態碼分布: {statuses}")
+    print(f"訊息數: 預期 {existing + 2 * len(succeeded)}, 實際 {len(messages)}; 遺失回合: {len(lost)}")
+    if lost or len(messages) != existing + 2 * len(succeeded):
+        print("❌ 偵測到遺失或多餘的訊息")
+        sys.exit(1)
+    print("✅ 沒有遺失任何回合")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from answer_rendering import STRUCTURED_LIST_SEPARATOR, compact_styles, parse_compact_answer, render_compact_answer  # noqa: E402
+
+ANSWER = {
+    "title": "PM2.5 概說", "intro": "PM2.5 是細懸浮微粒。",
+    "sections": [{"title": "來源", "emoji": "🏭", "points": ["交通排放", "工業燃燒。"]},
+                 {"title": "影響", "points": ["  深入肺部\n造成傷害 "]}],
+    "conclusion": "應減少暴露。",
+}
+
+
+def test_parse_strips_code_fence_and_normalizes():
+    answer = parse_compact_answer("```json\n" + json.dumps(ANSWER, ensure_ascii=False) + "\n```")
+    assert answer["sections"][1] == {"title": "影響", "emoji": "", "points": ["深入肺部 造成傷害"]}
+    assert answer["title"] == "PM2.5 概說"
+
+
+@pytest.mark.parametrize("text", ["", "不是 JSON", '{"sections": "x"}', '{"title": "只有標題"}', '{"sections": [1]}'])
+def test_parse_rejects_unusable_output(text):
+    assert parse_compact_answer(text) is None
+
+
+def test_render_structured_list():
+    rendered = render_compact_answer(parse_compact_answer(json.dumps(ANSWER)), "structured_list")
+    assert rendered == (f"PM2.5 是細懸浮微粒。\n\n**一、來源**\n交通排放。工業燃燒。 🏭\n{STRUCTURED_LIST_SEPARATOR}\n\n"
+                        f"**二、影響**\n深入肺部 造成傷害。\n{STRUCTURED_LIST_SEPARATOR}\n\n應減少暴露。")
+
+
+def test_render_hierarchical_bullets():
+    rendered = render_compact_answer(parse_compact_answer(json.dumps(ANSWER)), "hierarchical_bullets")
+    assert rendered == ("# PM2.5 概說\nPM2.5 是細懸浮微粒。\n\n## 一、來源\n*   交通排放\n*   工業燃燒。\n\n"
+                        "## 二、影響\n*   深入肺部 造成傷害\n\n應減少暴露。")
+
+
+def test_render_paragraph_emoji_lead():
+    rendered = render_compact_answer(parse_compact_answer(json.dumps(ANSWER)), "paragraph_emoji_lead")
+    assert rendered == "💡 PM2.5 是細懸浮微粒。\n\n🏭 交通排放。工業燃燒。\n\n🔹 深入肺部 造成傷害。\n\n✅ 應減少暴露。"
+
+
+def test_answer_without_sections_renders_intro_only():
+    answer = parse_compact_answer('{"intro": "資料不足，無法回答。", "sections": []}')
+    assert all(render_compact_answer(answer, style) == "資料不足，無法回答。" for style in compact_styles())
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import chat_archive  # noqa: E402
+from chat_archive import ChatArchive  # noqa: E402
+
+
+def _chat(title, count=2):
+    return {"title": title, "created_at": "2025-01-01T00:00:00"}, [{"role": "user", "content": f"{title} {i}"} for i in range(count)]
+
+
+def _entries(archive):
+    with zipfile.ZipFile(archive.zip_path) as zf: return zf.namelist()
+
+
+def test_archive_appends_and_loads(tmp_path):
+    archive = ChatArchive(tmp_path)
+    archive.archive({"c1": _chat("一")})
+    archive.archive({"c2": _chat("二", 3)})
+    assert len(_entries(archive)) == 2
+    assert archive.index()["c2"]["messages"] == 3
+    assert "c1" in archive and "c3" not in archive
+    assert archive.load("c1") == _chat("一")
+    assert archive.load("c3") is None
+
+
+def test_rearchive_replaces_index_entry(tmp_path):
+    archive = ChatArchive(tmp_path)
+    archive.archive({"c1": _chat("舊")})
+    archive.archive({"c1": _chat("新", 5)})
+    # 舊項目留在 zip 中，直到累積足夠的過時項目才壓縮
+    assert len(_entries(archive)) == 2
+    assert archive.load("c1") == _chat("新", 5)
+
+
+def test_restore_then_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat_archive, "COMPACT_MIN_STALE_ENTRIES", 2)
+    archive = ChatArchive(tmp_path)
+    archive.archive({f"c{i}": _chat(str(i)) for i in range(3)})
+    assert archive.discard("c0") and not archive.discard("c0")
+    assert len(_entries(archive)) == 3
+    archive.discard("c1")
+    # 過時項目 (2) 達到門檻且多於存活項目 (1)，重寫 zip
+    assert [name.split(".")[0] for name in _entries(archive)] == ["c2"]
+    assert archive.load("c2") == _chat("2")
+    archive.discard("c2")
+    # 只剩一個過時項目，未達門檻不重寫；索引清空時移除索引檔
+    assert not archive.index_path.exists() and len(_entries(archive)) == 1
+
+
+def test_purge_rewrites_immediately(tmp_path):
+    archive = ChatArchive(tmp_path)
+    archive.archive({"c1": _chat("一"), "c2": _chat("二")})
+    archive.discard("c1", purge=True)
+    assert [name.split(".")[0] for name in _entries(archive)] == ["c2"]
+    assert archive.sizes()["chats"] == 1
+
+
+def test_legacy_entry_without_timestamp(tmp_path):
+    archive = ChatArchive(tmp_path)
+    archive.dir.mkdir()
+    meta, messages = _chat("舊格式")
+    with zipfile.ZipFile(archive.zip_path, "w") as zf:
+        zf.writestr("c1.json", json.dumps({"metadata": meta, "messages": messages}, ensure_ascii=False))
+    archive.index_path.write_text(json.dumps({"c1": {"title": "舊格式"}}, ensure_ascii=False), encoding="utf-8")
+    assert archive.load("c1") == (meta, messages)
+    archive.archive({"c2": _chat("二")})
+    archive.discard("c2", purge=True)
+    assert _entries(archive) == ["c1.json"]
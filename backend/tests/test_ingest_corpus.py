@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ingest_corpus import load_documents, split_sentences_into_chunks  # noqa: E402
+
+
+@pytest.mark.parametrize("overlap", [0, 4])
+def test_long_sentence_keeps_document_order(overlap):
+    chunks = split_sentences_into_chunks("短句一。" + "長" * 25 + "。尾。", 10, overlap)
+    assert chunks[0] == "短句一。"
+    assert all(set(chunk) <= {"長"} for chunk in chunks[1:-1])
+    assert chunks[-1].endswith("。尾。")
+    assert all(len(chunk) <= 10 for chunk in chunks)
+
+
+def test_overlap_between_regular_chunks():
+    assert split_sentences_into_chunks("一二三。四五六。七八九。", 8, 4) == ["一二三。四五六。", "四五六。七八九。"]
+
+
+def test_duplicate_doc_id_is_rejected(tmp_path):
+    for name in ("a.json", "b.json"):
+        (tmp_path / name).write_text(json.dumps({"doc_id": "d1", "content": name}), encoding="utf-8")
+    with pytest.raises(ValueError, match="d1"):
+        load_documents([str(tmp_path / "*.json")])
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from model_router import ComplexityRouter, load_rules, question_signals  # noqa: E402
+
+TIERS = {"small": "qwen3:4b", "large": "qwen3:32b"}
+
+
+def _signals(question, **kwargs):
+    return question_signals(question, kwargs.pop("format_mode", "default"), kwargs.pop("prompt_mode", "default"),
+                            kwargs.pop("history_pairs", 0), **kwargs)
+
+
+def test_first_matching_rule_wins():
+    rules = load_rules(json.dumps([
+        {"name": "short", "tier": "small", "when": {"question_chars_max": 20}},
+        {"name": "definition", "tier": "large", "when": {"question_kind": "definition"}},
+    ]))
+    router = ComplexityRouter(TIERS, rules)
+    assert router.route(_signals("PM2.5 是什麼？")) == ("small", "qwen3:4b", "short")
+    assert router.route(_signals("請說明空氣品質指標 AQI 的定義與各等級的意思是什麼")) == ("large", "qwen3:32b", "definition")
+    assert router.route(_signals("列出今年所有的空氣品質監測站的名稱與所在地")) == ("large", "qwen3:32b", None)
+
+
+def test_default_rules_prefer_large_for_analytical_questions():
+    router = ComplexityRouter(TIERS)
+    # 同時符合定義型與分析型時以分析型為準
+    assert router.route(_signals("PM2.5 是什麼？對健康有什麼影響？"))[2] == "analytical"
+    assert router.route(_signals("PM2.5 是什麼？"))[:2] == ("small", "qwen3:4b")
+    assert router.route(_signals("PM2.5 是什麼？", prompt_mode="research"))[2] == "research_mode"
+
+
+def test_missing_signal_does_not_match():
+    router = ComplexityRouter(TIERS)
+    # 沒有檢索分數時 short_lookup 不成立，偏向大模型
+    assert router.route(_signals("空品站清單"))[2] is None
+    assert router.route(_signals("空品站清單", retrieval_scores=[0.8, 0.5, 0.4]))[2] == "short_lookup"
+
+
+def test_rules_with_unknown_tier_are_rejected(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([{"tier": "medium", "when": {}}]), encoding="utf-8")
+    assert load_rules(str(path))[0]["name"] == "rule_0"
+    with pytest.raises(ValueError, match="medium"):
+        ComplexityRouter(TIERS, load_rules(str(path)))
+    with pytest.raises(ValueError, match="tier"):
+        load_rules('[{"when": {}}]')
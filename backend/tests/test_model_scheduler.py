@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from model_scheduler import ModelAffinityScheduler  # noqa: E402
+
+
+def _scheduler(**kwargs) -> ModelAffinityScheduler:
+    # 不向 Ollama 查詢 /api/ps，常駐模型只由排程器自己決定
+    kwargs.setdefault("ps_refresh_seconds", float("inf"))
+    return ModelAffinityScheduler("http://ollama.invalid", **kwargs)
+
+
+async def _pending(scheduler, model):
+    task = asyncio.ensure_future(scheduler.acquire(model))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_resident_model_is_admitted_before_older_swap():
+    async def scenario():
+        scheduler = _scheduler(max_wait_seconds=60)
+        assert await scheduler.acquire("a") is True
+        b = await _pending(scheduler, "b")
+        # b 需要淘汰執行中的 a，先放行常駐模型 a 的後續請求
+        assert await scheduler.acquire("a") is False
+        assert not b.done()
+        scheduler.release("a")
+        scheduler.release("a")
+        assert await b is True
+        assert list(scheduler.resident) == ["b"]
+        assert scheduler.stats["swaps"] == 2 and scheduler.stats["resident_hits"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_starving_model_holds_resident_requests_after_max_wait():
+    async def scenario():
+        scheduler = _scheduler(max_wait_seconds=60)
+        await scheduler.acquire("a")
+        b = await _pending(scheduler, "b")
+        scheduler.waiting["b"][0].enqueued_at = time.monotonic() - 61
+        a2 = await _pending(scheduler, "a")
+        # 超過等待上限後不再放行 a 的新請求，a 排空後立刻切換到 b
+        assert not a2.done() and not b.done()
+        assert scheduler.stats["fairness_holds"] >= 1
+        scheduler.release("a")
+        assert await b is True
+        assert not a2.done()
+        scheduler.release("b")
+        assert await a2 is True
+
+    asyncio.run(scenario())
+
+
+def test_slots_per_model_limits_concurrency():
+    async def scenario():
+        scheduler = _scheduler(slots_per_model=1)
+        await scheduler.acquire("a")
+        second = await _pending(scheduler, "a")
+        assert not second.done()
+        scheduler.release("a")
+        assert await second is False
+
+        unlimited = _scheduler()
+        for _ in range(4): await unlimited.acquire("a")
+        assert unlimited.running["a"] == 4
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_is_removed_from_queue():
+    async def scenario():
+        scheduler = _scheduler()
+        await scheduler.acquire("a")
+        b = await _pending(scheduler, "b")
+        b.cancel()
+        await asyncio.gather(b, return_exceptions=True)
+        assert not scheduler.waiting["b"]
+        assert scheduler.stats["cancelled_while_waiting"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from partitioned_retrieval import combine_where, load_partitions, merge_partition_results, normalize_metadata_filter  # noqa: E402
+
+
+def _doc(chunk_id, doc_id=None):
+    return SimpleNamespace(id=chunk_id, metadata={"doc_id": doc_id} if doc_id else {})
+
+
+def _partitions(**overrides):
+    spec = [{"name": "qa", "where": {"doc_type": "qa"}, "k": 3, "quota": 1},
+            {"name": "longform", "where": {"doc_type": "longform"}, "k": 4, "quota": 2, "max_per_doc": 2}]
+    for partition in spec: partition.update(overrides.get(partition["name"], {}))
+    return load_partitions(json.dumps(spec))
+
+
+def test_quota_is_reserved_before_global_ranking():
+    results = {"qa": [(_doc("q1"), 0.9), (_doc("q2"), 0.85), (_doc("q3"), 0.8)],
+               "longform": [(_doc("l1", "d1"), 0.5), (_doc("l2", "d2"), 0.4), (_doc("l3", "d3"), 0.3)]}
+    merged = merge_partition_results(results, _partitions(), max_docs=4)
+    # longform 的兩個保留名額即使分數較低也會入選，剩下的名額依分數分配
+    assert [(doc.id, name) for doc, _, name in merged] == [("q1", "qa"), ("q2", "qa"), ("l1", "longform"), ("l2", "longform")]
+
+
+def test_max_per_doc_caps_chunks_from_one_document():
+    results = {"longform": [(_doc("l1", "d1"), 0.9), (_doc("l2", "d1"), 0.8), (_doc("l3", "d1"), 0.7), (_doc("l4", "d2"), 0.2)]}
+    merged = merge_partition_results(results, _partitions(), max_docs=4)
+    assert [doc.id for doc, _, _ in merged] == ["l1", "l2", "l4"]
+    # 沒有 doc_id 的片段不受上限影響
+    results = {"longform": [(_doc(f"x{i}"), 1 - i / 10) for i in range(3)]}
+    assert len(merge_partition_results(results, _partitions(), max_docs=4)) == 3
+
+
+def test_duplicate_chunks_across_partitions_are_taken_once():
+    shared = _doc("c1", "d1")
+    results = {"qa": [(shared, 0.9)], "longform": [(shared, 0.9), (_doc("l2", "d2"), 0.3)]}
+    merged = merge_partition_results(results, _partitions(), max_docs=4)
+    assert [(doc.id, name) for doc, _, name in merged] == [("c1", "qa"), ("l2", "longform")]
+
+
+def test_default_partitions_include_catch_all():
+    partitions = load_partitions("default")
+    assert partitions[-1]["name"] == "other" and partitions[-1]["quota"] == 0
+    assert all(p["where"] for p in partitions)
+
+
+@pytest.mark.parametrize("spec, match", [
+    ('[{"name": "a"}]', "where"),
+    ('[{"name": "a", "where": {"doc_type": "qa"}}, {"name": "a", "where": {"doc_type": "x"}}]', "重複"),
+    ('[{"name": "a", "where": {"doc_type": "qa"}, "k": 2, "quota": 3}]', "quota"),
+])
+def test_invalid_partitions_are_rejected(spec, match):
+    with pytest.raises(ValueError, match=match):
+        load_partitions(spec)
+
+
+def test_metadata_filter_normalization():
+    assert normalize_metadata_filter({"doc_type": "qa", "source": {"$ne": "user_feedback"}}) == \
+        {"$and": [{"doc_type": {"$eq": "qa"}}, {"source": {"$ne": "user_feedback"}}]}
+    assert combine_where(None, {"doc_type": {"$eq": "qa"}}) == {"doc_type": {"$eq": "qa"}}
+    with pytest.raises(ValueError, match="secret"):
+        normalize_metadata_filter({"secret": "x"})
+    with pytest.raises(ValueError, match=r"\$in"):
+        normalize_metadata_filter({"doc_type": {"$in": []}})
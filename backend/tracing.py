@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+請求追蹤 (Per-request Tracing)
+
+以 contextvars 追蹤每個請求的階段 span (驗證、載入對話、檢索、LLM 生成...)，
+結束時以 OTLP/JSON (ExportTraceServiceRequest) 格式匯出：
+- TRACE_EXPORT_PATH      ：每行一個 JSON 批次的檔案，與 OpenTelemetry Collector 的 file exporter / otlpjsonfile receiver 相容；預設空字串 (停用)。
+                           超過 TRACE_EXPORT_MAX_BYTES 時輪替為 .1 ... .N (保留 TRACE_EXPORT_BACKUP_COUNT 個)；
+                           多 worker (MULTI_WORKER_MODE=true) 時檔名加上 PID (spans.otlp.<pid>.jsonl)，避免多個程序寫入同一個檔案
+- OTLP_TRACES_ENDPOINT   ：另外以 OTLP/HTTP JSON POST 到 collector (例如 http://127.0.0.1:4318/v1/traces)
+- TRACE_SAMPLE_RATE      ：一般請求的取樣率；錯誤或超過 TRACE_SLOW_SECONDS 的請求一律保留 (tail sampling)
+
+asyncio.to_thread 會複製 context，因此在執行緒中建立的 span 仍會掛在同一個 trace 下。
+
+範例：
+    with start_trace("POST /chat", trace_id=incoming_id) as root:
+        with span("retrieval", k=10) as s:
+            ...
+            s.set_attribute("retrieved_count", len(docs))
+"""
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "kmu-air-pollution-rag")
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")  # 例如 traces/spans.otlp.jsonl
+TRACE_EXPORT_MAX_BYTES = int(os.environ.get("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_EXPORT_BACKUP_COUNT = int(os.environ.get("TRACE_EXPORT_BACKUP_COUNT", "5"))
+TRACE_EXPORT_PER_PROCESS = os.environ.get("MULTI_WORKER_MODE", "false").lower() == "true"
+OTLP_TRACES_ENDPOINT = os.environ.get("OTLP_TRACES_ENDPOINT", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", "30"))
+TRACE_EXPORT_BATCH_SIZE = int(os.environ.get("TRACE_EXPORT_BATCH_SIZE", "64"))
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get("TRACE_EXPORT_QUEUE_SIZE", "2048"))
+TRACE_MAX_SPANS_PER_TRACE = 256
+TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER = 1, 2
+
+
+def _new_id(nbytes: int) -> str:
+    return random.getrandbits(nbytes * 8).to_bytes(nbytes, "big").hex()
+
+
+class _Trace:
+    """同一個 trace 已結束的 span；根 span 結束時才決定是否匯出"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, finished: "Span"):
+        with self.lock:
+            if len(self.spans) < TRACE_MAX_SPANS_PER_TRACE: self.spans.append(finished)
+            else: self.dropped += 1
+
+
+class Span:
+    def __init__(self, name: str, trace: _Trace, parent_id: Optional[str] = None, kind: int = SPAN_KIND_INTERNAL,
+                 attributes: Optional[Dict] = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes: Dict = {k: v for k, v in (attributes or {}).items() if v is not None}
+        self.events: List[Dict] = []
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration_seconds(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value):
+        if value is not None: self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items(): self.set_attribute(key, value)
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def set_error(self, message: str):
+        self.status, self.status_message = STATUS_ERROR, message
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.trace.add(self)
+
+
+class _NoopSpan:
+    """沒有進行中的 trace 時回傳，呼叫端不需判斷"""
+    trace_id = None
+    duration_seconds = 0.0
+    def set_attribute(self, key, value): pass
+    def set_attributes(self, **attributes): pass
+    def add_event(self, name, **attributes): pass
+    def set_error(self, message): pass
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_trace_listeners: List[Callable[[Span], None]] = []
+
+
+def add_trace_listener(listener: Callable[[Span], None]):
+    """根 span 結束時 (取樣決定前) 以根 span 呼叫，例如慢請求記錄；不應做阻塞 I/O"""
+    _trace_listeners.append(listener)
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def current_trace_id() -> Optional[str]:
+    active = _current_span.get()
+    return active.trace_id if active else None
+
+
+def parse_traceparent(header: Optional[str]):
+    """解析 W3C traceparent 標頭，回傳 (trace_id, parent_span_id)；格式不符時回傳 (None, None)"""
+    match = TRACEPARENT_RE.match((header or "").strip().lower())
+    if not match or set(match.group(1)) == {"0"}:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+def _run_span(active: Span):
+    token = _current_span.set(active)
+    try:
+        yield active
+    except BaseException as e:
+        active.set_error(f"{type(e).__name__}: {getattr(e, 'detail', None) or e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        active.end()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """在目前的 trace 下建立子 span；沒有進行中的 trace 時不做任何事"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    yield from _run_span(Span(name, parent.trace, parent.span_id, attributes=attributes))
+
+
+@contextmanager
+def start_trace(name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None, **attributes):
+    """建立根 span；結束時依錯誤 / 延遲 / 取樣率決定是否匯出整個 trace"""
+    root = Span(name, _Trace(trace_id or _new_id(16)), parent_id, kind=SPAN_KIND_SERVER, attributes=attributes)
+    try:
+        yield from _run_span(root)
+    finally:
+        for listener in _trace_listeners:
+            try:
+                listener(root)
+            except Exception as e:
+                logger.error(f"❌ trace listener {listener!r} 失敗: {e}", exc_info=True)
+        errored = any(s.status == STATUS_ERROR for s in root.trace.spans)
+        if errored or root.duration_seconds >= TRACE_SLOW_SECONDS or random.random() < TRACE_SAMPLE_RATE:
+            exporter.submit(root.trace)
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool): return {"boolValue": value}
+    if isinstance(value, int): return {"intValue": str(value)}
+    if isinstance(value, float): return {"doubleValue": value}
+    if isinstance(value, (list, tuple)): return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()]
+
+
+def _otlp_span(s: Span) -> Dict:
+    payload = {
+        "traceId": s.trace_id, "spanId": s.span_id, "name": s.name, "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.end_ns),
+        "attributes": _otlp_attributes(s.attributes),
+        "status": {"code": s.status, **({"message": s.status_message} if s.status_message else {})},
+    }
+    if s.parent_id: payload["parentSpanId"] = s.parent_id
+    if s.events:
+        payload["events"] = [{"name": e["name"], "timeUnixNano": str(e["time_ns"]), "attributes": _otlp_attributes(e["attributes"])} for e in s.events]
+    return payload
+
+
+def to_otlp_json(traces: List[_Trace]) -> Dict:
+    spans = [_otlp_span(s) for t in traces for s in t.spans]
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME, "process.pid": os.getpid()})},
+        "scopeSpans": [{"scope": {"name": "6_10test"}, "spans": spans}],
+    }]}
+
+
+class TraceExporter:
+    """背景執行緒批次匯出，避免在請求路徑上做檔案 / 網路 I/O；佇列滿時丟棄並計數"""
+
+    def __init__(self, path: str, endpoint: str):
+        self.path = Path(path) if path else None
+        self.endpoint = endpoint
+        self.queue: "queue.Queue[_Trace]" = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+        self.stats = {"traces_exported": 0, "spans_exported": 0, "traces_dropped": 0, "export_errors": 0}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.endpoint)
+
+    def submit(self, trace: _Trace):
+        if not self.enabled: return
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.stats["traces_dropped"] += 1
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name="trace-exporter")
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < TRACE_EXPORT_BATCH_SIZE:
+                try: batch.append(self.queue.get_nowait())
+                except queue.Empty: break
+            self.export(batch)
+
+    def _file_path(self) -> Path:
+        # 在寫入時才取 PID：uvicorn --workers 的每個 worker 各自寫入自己的檔案
+        if not TRACE_EXPORT_PER_PROCESS: return self.path
+        return self.path.with_name(f"{self.path.stem}.{os.getpid()}{self.path.suffix}")
+
+    def _rotate(self, path: Path, incoming: int):
+        if TRACE_EXPORT_MAX_BYTES <= 0 or not path.exists() or path.stat().st_size + incoming <= TRACE_EXPORT_MAX_BYTES: return
+        if TRACE_EXPORT_BACKUP_COUNT <= 0:
+            path.unlink()
+            return
+        for index in range(TRACE_EXPORT_BACKUP_COUNT - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{index}")
+            if older.exists(): os.replace(older, path.with_name(f"{path.name}.{index + 1}"))
+        os.replace(path, path.with_name(f"{path.name}.1"))
+
+    def export(self, batch: List[_Trace]):
+        body = json.dumps(to_otlp_json(batch), ensure_ascii=False)
+        try:
+            if self.path:
+                path = self._file_path()
+                path.parent.mkdir(parents=True, exist_ok=True)
+                self._rotate(path, len(body.encode("utf-8")) + 1)
+                with open(path, "a", encoding="utf-8") as f: f.write(body + "\n")
+            if self.endpoint:
+                req = urllib.request.Request(self.endpoint, data=body.encode("utf-8"), method="POST", headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(req, timeout=5).close()
+            self.stats["traces_exported"] += len(batch)
+            self.stats["spans_exported"] += sum(len(t.spans) for t in batch)
+        except (OSError, urllib.error.URLError) as e:
+            self.stats["export_errors"] += 1
+            logger.error(f"❌ 匯出 {len(batch)} 個 trace 失敗: {e}")
+
+
+exporter = TraceExporter(TRACE_EXPORT_PATH, OTLP_TRACES_ENDPOINT)
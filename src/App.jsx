@@ -129,6 +129,10 @@ function UsernameModal({ onSetUsername }) {
 // --- Modal 組件定義結束 ---
 
 const API_BASE_URL = "http://163.15.172.93:8000";
+const CHAT_PAGE_SIZE = 30;
+const MESSAGE_PAGE_SIZE = 40;
+const PREFETCH_DEBOUNCE_MS = 600;
+const PREFETCH_MIN_CHARS = 4;
 
 export default function App() {
   const CONTROL_HEIGHT = 56;
@@ -145,6 +149,13 @@ export default function App() {
   const [isChatsOpen, setIsChatsOpen] = useState(true);
   const [chatHistory, setChatHistory] = useState([]);
   const [isLoadingHistory, setIsLoadingHistory] = useState(false);
+  const [chatListCursor, setChatListCursor] = useState(null);
+  const [olderMessagesCursor, setOlderMessagesCursor] = useState(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
+  const messageCacheRef = useRef({});
+  const chatListSyncedAtRef = useRef(null);
+  const skipAutoScrollRef = useRef(false);
+  const lastPrefetchRef = useRef("");
   const [isFeedbackOpen, setIsFeedbackOpen] = useState(false);
   const [menuOpenForChat, setMenuOpenForChat] = useState(null);
   const menuRef = useRef(null);
@@ -163,19 +174,28 @@ export default function App() {
   useEffect(() => {
     if (!username) return;
     const fetchChatHistory = async () => {
-      setIsLoadingHistory(true); setChatHistory([]); setCurrentChatId(null); setMessages([]);
-      try { const response = await apiClient.get(`/api/chats`); setChatHistory(response.data || []); }
+      setIsLoadingHistory(true); setChatHistory([]); setCurrentChatId(null); setMessages([]); setChatListCursor(null); messageCacheRef.current = {};
+      try { const response = await apiClient.get(`/api/chats`, { params: { limit: CHAT_PAGE_SIZE } }); setChatHistory(response.data || []); setChatListCursor(response.headers["x-next-cursor"] || null); chatListSyncedAtRef.current = response.headers["x-sync-watermark"] ?? ""; }
       catch (error) { console.error("Failed to fetch chat history:", error); setChatHistory([]); }
       finally { setIsLoadingHistory(false); }
     };
     fetchChatHistory();
   // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [username]);
+  // 切回分頁時只抓取其他分頁 / 裝置更新過的對話，不重新下載整份清單
+  useEffect(() => {
+    if (!username) return;
+    const syncChangedChats = async () => { if (document.visibilityState !== "visible" || chatListSyncedAtRef.current === null) return; const since = chatListSyncedAtRef.current; try { const response = await apiClient.get(`/api/chats`, { params: since ? { updated_since: since } : {} }); chatListSyncedAtRef.current = response.headers["x-sync-watermark"] ?? since; const changed = response.data || []; if (changed.length > 0) { setChatHistory(prevHistory => [...changed, ...prevHistory.filter(chat => !changed.some(c => c.id === chat.id))].sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at))); } } catch (error) { console.error("Failed to sync chat list:", error); } };
+    document.addEventListener("visibilitychange", syncChangedChats);
+    return () => document.removeEventListener("visibilitychange", syncChangedChats);
+  // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [username]);
+  useEffect(() => { if (currentChatId) { messageCacheRef.current[currentChatId] = { messages, olderCursor: olderMessagesCursor }; } }, [currentChatId, messages, olderMessagesCursor]);
   useEffect(() => { if (username && !isLoadingHistory && currentChatId === null && chatHistory.length === 0) { handleNewChat(); } // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [username, isLoadingHistory, currentChatId, chatHistory.length]);
 
   const handleSetUsername = (newUsername) => { const sanitizedUsername = newUsername.replace(/[^a-zA-Z0-9_-]/g, '').toLowerCase() || `user_${Date.now()}`; setUsername(sanitizedUsername); localStorage.setItem("chatAppUsername", sanitizedUsername); setShowUsernameModal(false); if (window.innerWidth < 1024) { setIsSidebarOpen(false); } else { setIsSidebarOpen(true); } };
-  const handleLogout = () => { localStorage.removeItem("chatAppUsername"); setUsername(null); setShowUsernameModal(true); setMessages([]); setChatHistory([]); setCurrentChatId(null); setInput(""); setIsLoadingHistory(false); setIsSidebarOpen(false); };
+  const handleLogout = () => { localStorage.removeItem("chatAppUsername"); setUsername(null); setShowUsernameModal(true); setMessages([]); setChatHistory([]); setChatListCursor(null); setOlderMessagesCursor(null); messageCacheRef.current = {}; setCurrentChatId(null); setInput(""); setIsLoadingHistory(false); setIsSidebarOpen(false); };
   const adjustTextAreaHeight = () => { const textArea = textAreaRef.current; if (textArea) { textArea.style.height = "auto"; const minHeight = 100; const maxHeight = 400; const scrollHeight = textArea.scrollHeight; let newHeight = scrollHeight; if (scrollHeight <= minHeight) newHeight = minHeight; else if (scrollHeight > maxHeight) newHeight = maxHeight; textArea.style.overflowY = scrollHeight > maxHeight ? 'auto' : 'hidden'; textArea.style.height = `${newHeight}px`; } };
   const handleScroll = (e) => { const ta = e.target; const maxScroll = ta.scrollHeight - ta.clientHeight - CONTROL_HEIGHT; if (ta.scrollTop > maxScroll) ta.scrollTop = maxScroll; };
 
@@ -185,7 +205,7 @@ export default function App() {
     let chatIdToUse = currentChatId;
     if (!chatIdToUse) { alert("請先選擇或建立一個新的對話。"); return; }
     setMessages((prev) => [...prev, { role: "user", content: input, isMarkdown: false }]);
-    const currentInput = input; setInput(""); setLoading(true);
+    const currentInput = input; setInput(""); setLoading(true); lastPrefetchRef.current = "";
     try {
       const res = await apiClient.post(`/chat`, { session_id: chatIdToUse, question: currentInput, model: selectedModel, prompt_mode: promptMode, });
       setMessages((prev) => [...prev, { role: "assistant", content: res.data.answer, isMarkdown: true }]);
@@ -195,12 +215,18 @@ export default function App() {
 
   const submitFeedback = async () => { if (!username) { alert("請先設置您的用戶名称。"); setShowUsernameModal(true); return; } if (!expectedAnswer.trim() && !expectedQuestion.trim()) { alert("請至少輸入問題或預期回答。"); return; } let lastUserMessage = null, lastAssistantMessage = null; for (let i = messages.length - 1; i >= 0; i--) { if (messages[i].role === 'assistant') { lastAssistantMessage = messages[i]; if (i > 0 && messages[i-1].role === 'user') lastUserMessage = messages[i-1]; break; } } const questionForFeedback = lastUserMessage ? lastUserMessage.content : "用戶未提問或來自新對話"; const originalAnswerForFeedback = lastAssistantMessage ? lastAssistantMessage.content : "無原始回答或來自新對話"; const chatIdToUse = currentChatId; if (!chatIdToUse) { alert("無法確定當前對話以提交回饋。"); return; } try { await apiClient.post(`/feedback`, { session_id: chatIdToUse, question: questionForFeedback, model: selectedModel, original_answer: originalAnswerForFeedback, user_expected_question: expectedQuestion, user_expected_answer: expectedAnswer, }); alert("✅ 已送出回饋，感謝您的建議！"); setExpectedQuestion(""); setExpectedAnswer(""); setIsFeedbackOpen(false); } catch (err) { console.error("Submit feedback error:", err); alert("❌ 無法提交回饋，請稍後再試。"); } };
   const handleKeyDown = (e) => { if (e.key === "Enter" && !e.shiftKey) { e.preventDefault(); sendMessage(); } };
-  useEffect(() => { bottomRef.current?.scrollIntoView({ behavior: "smooth" }); }, [messages]);
+  useEffect(() => { if (skipAutoScrollRef.current) { skipAutoScrollRef.current = false; return; } bottomRef.current?.scrollIntoView({ behavior: "smooth" }); }, [messages]);
   useEffect(() => { adjustTextAreaHeight(); }, [input]);
+  // 使用者停止輸入後先行檢索，送出時 /chat 可直接沿用結果
+  useEffect(() => { const draft = input.trim(); if (!username || !currentChatId || loading || draft.length < PREFETCH_MIN_CHARS) return; const prefetchKey = `${currentChatId}|${draft.replace(/\s+/g, " ")}`; if (prefetchKey === lastPrefetchRef.current) return; const timer = setTimeout(() => { lastPrefetchRef.current = prefetchKey; apiClient.post(`/chat/prefetch`, { session_id: currentChatId, question: draft }).catch((error) => { console.debug("Prefetch failed:", error); lastPrefetchRef.current = ""; }); }, PREFETCH_DEBOUNCE_MS); return () => clearTimeout(timer); // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [input, currentChatId, username, loading]);
   useEffect(() => { const handleClickOutside = (event) => { if (menuRef.current && !menuRef.current.contains(event.target)) { setMenuOpenForChat(null); } }; if (menuOpenForChat) document.addEventListener("mousedown", handleClickOutside); else document.removeEventListener("mousedown", handleClickOutside); return () => document.removeEventListener("mousedown", handleClickOutside); }, [menuOpenForChat]);
 
-  const handleNewChat = async () => { if (!username) { return; } setMessages([]); const newChatId = `chat_${Date.now()}`; const newChatTitle = `新對話 ${chatHistory.filter(chat => chat.title.startsWith("新對話")).length + 1}`; const newChatOptimistic = { id: newChatId, title: newChatTitle, updated_at: new Date().toISOString() }; setChatHistory(prevHistory => [newChatOptimistic, ...prevHistory].sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at))); setCurrentChatId(newChatId); setInput(""); if (window.innerWidth < 1024) { setIsSidebarOpen(false); } try { const response = await apiClient.post(`/api/chats`, { id: newChatId, title: newChatTitle }); const actualChat = response.data; setChatHistory(prevHistory => prevHistory.map(chat => (chat.id === newChatId ? actualChat : chat)).sort((a,b) => new Date(b.updated_at) - new Date(a.updated_at))); } catch (error) { console.error("Failed to create new chat on backend:", error); setChatHistory(prevHistory => prevHistory.filter(chat => chat.id !== newChatId)); if (currentChatId === newChatId) { const nextChat = chatHistory.length > 0 ? chatHistory[0] : null; if (nextChat) { handleSelectChat(nextChat.id, false); } else { setCurrentChatId(null); setMessages([]); } } } };
-  const handleSelectChat = async (chatId, userInitiated = true) => { if (!username) return; if (currentChatId === chatId && messages.length > 0 && userInitiated) { setMenuOpenForChat(null); return; } if (currentChatId === chatId && !userInitiated && messages.length > 0) { setMenuOpenForChat(null); return; } setMessages([]); setCurrentChatId(chatId); setInput(""); setMenuOpenForChat(null); setLoading(true); if (window.innerWidth < 1024) { setIsSidebarOpen(false); } try { const response = await apiClient.get(`/api/chats/${chatId}/messages`); const loadedMessages = (response.data || []).map(msg => ({ ...msg, isMarkdown: msg.role === 'assistant' })); setMessages(loadedMessages); } catch (error) { console.error(`Failed to fetch messages for chat ${chatId}:`, error); setMessages([{ role: "assistant", content: "❌ 載入對話記錄失敗。", isMarkdown: false }]); } finally { setLoading(false); } };
+  const handleNewChat = async () => { if (!username) { return; } setMessages([]); setOlderMessagesCursor(null); const newChatId = `chat_${Date.now()}`; const newChatTitle = `新對話 ${chatHistory.filter(chat => chat.title.startsWith("新對話")).length + 1}`; const newChatOptimistic = { id: newChatId, title: newChatTitle, updated_at: new Date().toISOString() }; setChatHistory(prevHistory => [newChatOptimistic, ...prevHistory].sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at))); setCurrentChatId(newChatId); setInput(""); if (window.innerWidth < 1024) { setIsSidebarOpen(false); } try { const response = await apiClient.post(`/api/chats`, { id: newChatId, title: newChatTitle }); const actualChat = response.data; setChatHistory(prevHistory => prevHistory.map(chat => (chat.id === newChatId ? actualChat : chat)).sort((a,b) => new Date(b.updated_at) - new Date(a.updated_at))); } catch (error) { console.error("Failed to create new chat on backend:", error); setChatHistory(prevHistory => prevHistory.filter(chat => chat.id !== newChatId)); if (currentChatId === newChatId) { const nextChat = chatHistory.length > 0 ? chatHistory[0] : null; if (nextChat) { handleSelectChat(nextChat.id, false); } else { setCurrentChatId(null); setMessages([]); } } } };
+  const toDisplayMessages = (data) => (data || []).map(msg => ({ ...msg, isMarkdown: msg.role === 'assistant' }));
+  const handleSelectChat = async (chatId, userInitiated = true) => { if (!username) return; if (currentChatId === chatId && messages.length > 0 && userInitiated) { setMenuOpenForChat(null); return; } if (currentChatId === chatId && !userInitiated && messages.length > 0) { setMenuOpenForChat(null); return; } const cached = messageCacheRef.current[chatId]; const cachedMessages = cached ? cached.messages.filter(msg => msg.index !== undefined && msg.index !== null) : []; setMessages(cachedMessages); setOlderMessagesCursor(cached ? cached.olderCursor : null); setCurrentChatId(chatId); setInput(""); setMenuOpenForChat(null); setLoading(true); if (window.innerWidth < 1024) { setIsSidebarOpen(false); } try { if (cached) { const lastIndex = cachedMessages.length > 0 ? cachedMessages[cachedMessages.length - 1].index : (cached.olderCursor !== null ? cached.olderCursor - 1 : -1); const response = await apiClient.get(`/api/chats/${chatId}/messages`, { params: { after: lastIndex } }); const newMessages = toDisplayMessages(response.data); if (newMessages.length > 0) setMessages([...cachedMessages, ...newMessages]); } else { const response = await apiClient.get(`/api/chats/${chatId}/messages`, { params: { limit: MESSAGE_PAGE_SIZE } }); setMessages(toDisplayMessages(response.data)); const nextCursor = response.headers["x-next-cursor"]; setOlderMessagesCursor(nextCursor !== undefined ? Number(nextCursor) : null); } } catch (error) { console.error(`Failed to fetch messages for chat ${chatId}:`, error); delete messageCacheRef.current[chatId]; setOlderMessagesCursor(null); setMessages([{ role: "assistant", content: "❌ 載入對話記錄失敗。", isMarkdown: false }]); } finally { setLoading(false); } };
+  const loadOlderMessages = async () => { if (!currentChatId || olderMessagesCursor === null || isLoadingOlder) return; const chatId = currentChatId; setIsLoadingOlder(true); try { const response = await apiClient.get(`/api/chats/${chatId}/messages`, { params: { before: olderMessagesCursor, limit: MESSAGE_PAGE_SIZE } }); const nextCursor = response.headers["x-next-cursor"]; skipAutoScrollRef.current = true; setMessages(prev => [...toDisplayMessages(response.data), ...prev]); setOlderMessagesCursor(nextCursor !== undefined ? Number(nextCursor) : null); } catch (error) { console.error(`Failed to fetch older messages for chat ${chatId}:`, error); alert("載入更早的訊息失敗。"); } finally { setIsLoadingOlder(false); } };
+  const loadMoreChats = async () => { if (!chatListCursor || isLoadingHistory) return; try { const response = await apiClient.get(`/api/chats`, { params: { limit: CHAT_PAGE_SIZE, cursor: chatListCursor } }); const page = response.data || []; setChatHistory(prevHistory => [...prevHistory, ...page.filter(chat => !prevHistory.some(c => c.id === chat.id))]); setChatListCursor(response.headers["x-next-cursor"] || null); } catch (error) { console.error("Failed to fetch more chats:", error); alert("載入更多對話失敗。"); } };
   const handleToggleChatMenu = (chatId, event) => { event.stopPropagation(); setMenuOpenForChat(prevOpenChatId => (prevOpenChatId === chatId ? null : chatId)); };
   const handleRenameChat = (chatId) => { setMenuOpenForChat(null); const chatToRename = chatHistory.find(chat => chat.id === chatId); if (chatToRename) { setModalState({ type: 'rename', chatId: chatId, currentTitle: chatToRename.title }); } };
   const handleDeleteChat = (chatId) => { setMenuOpenForChat(null); setModalState({ type: 'delete', chatId: chatId }); };
@@ -316,6 +342,7 @@ export default function App() {
                         </li>
                         ))
                     )}
+                    {!isLoadingHistory && chatListCursor && ( <li> <button onClick={loadMoreChats} className="w-full px-2 py-1.5 text-left text-xs text-gray-500 rounded hover:bg-gray-200 hover:text-gray-800"> 載入更多對話... </button> </li> )}
                   </ul>
                 )}
               </div>
@@ -354,8 +381,9 @@ export default function App() {
           </header>
           <main className="flex-1 overflow-y-auto px-4 py-6 space-y-4 flex flex-col font-serif">
              {loading && messages.length === 0 && currentChatId && ( <div className="flex justify-center items-center h-full"> <p className="text-gray-500">正在載入對話內容...</p> </div> )}
+             {olderMessagesCursor !== null && messages.length > 0 && ( <div className="flex justify-center"> <button onClick={loadOlderMessages} disabled={isLoadingOlder} className="px-3 py-1 text-xs text-gray-500 border border-gray-300 rounded-full hover:bg-gray-100 disabled:opacity-50"> {isLoadingOlder ? "載入中..." : "載入更早的訊息"} </button> </div> )}
              {messages.map((msg, i) => (
-                <div key={i} className="flex justify-center">
+                <div key={msg.index ?? `local-${i}`} className="flex justify-center">
                     <div className="flex items-start gap-2 w-full max-w-3xl">
                         {msg.role === "user" && ( <img src="/images/KMU_logo.png" alt="KMU" className="w-6 h-6 mt-1 rounded-full object-contain shrink-0" /> )}
                         <div
@@ -373,6 +401,7 @@ export default function App() {
               <div className="absolute bottom-[20px] right-12 md:right-[60px] z-10" style={{ backgroundColor: 'transparent', boxShadow: 'none' }}>
                 <div className="relative w-auto md:w-[320px]" style={{ backgroundColor: 'transparent' }}>
                   <select value={selectedModel} onChange={(e) => setSelectedModel(e.target.value)} className="appearance-none bg-transparent text-black text-xs sm:text-sm pr-8 py-2 rounded-md w-full focus:outline-none focus:ring-0 focus:border-0 hover:ring-0 hover:bg-transparent transition-all" style={{ textAlignLast: "right", backgroundColor: 'transparent', boxShadow: 'none', border: 'none' }}>
+                      <option value="auto">自動選擇</option>
                       <option value="gemma3:12b-it-q4_K_M">gemma3:12b-it-q4_K_M</option>
                       <option value="gemma3:12b">Gemma 3 12B</option>
                       <option value="qwen3:14b">Qwen 3 14B</option>